@@ -1,6 +1,5 @@
 import collections
 import json
-import os.path
 import re
 import typing
 
@@ -12,13 +11,32 @@ from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import Mapped
 from sqlalchemy.sql import select
 
-from matcher import database, model, wikidata, wikidata_api
+from matcher import (
+    database,
+    geodesy,
+    item_grid,
+    item_isa,
+    item_marker,
+    model,
+    place_stats,
+    presets,
+    simplify,
+    tile_cache,
+    wikidata,
+    wikidata_api,
+)
 from matcher.planet import line, point, polygon
 
+osm_geometry = model.OsmGeometry.__table__
+
 TagsType = dict[str, str]
 
 srid = 4326
 re_point = re.compile(r"^POINT\((.+) (.+)\)$")
+
+# Bounding boxes larger than this (square degrees) can be shown as clusters.
+cluster_min_area = 4.0
+
 entity_keys = {"labels", "sitelinks", "aliases", "claims", "descriptions", "lastrevid"}
 
 tag_prefixes = {
@@ -43,13 +61,8 @@ skip_tags = {
 }
 
 
-def get_country_iso3166_1(lat: float, lon: float) -> set[str]:
-    """For a given lat/lon return a set of ISO country codes.
-
-    Also cache the country code in the global object.
-
-    Normally there should be only one country.
-    """
+def country_codes(lat: float, lon: float) -> set[str]:
+    """ISO country codes of the countries that cover a lat/lon."""
     point = sqlalchemy.func.ST_SetSRID(sqlalchemy.func.ST_MakePoint(lon, lat), srid)
     alpha2_codes: set[str] = set()
     q = model.Polygon.query.filter(
@@ -61,31 +74,41 @@ def get_country_iso3166_1(lat: float, lon: float) -> set[str]:
         if not alpha2:
             continue
         alpha2_codes.add(alpha2)
+    return alpha2_codes
+
 
+def get_country_iso3166_1(lat: float, lon: float) -> set[str]:
+    """For a given lat/lon return a set of ISO country codes.
+
+    Also cache the country code in the global object.
+
+    Normally there should be only one country.
+    """
+    alpha2_codes = country_codes(lat, lon)
     flask.g.alpha2_codes = alpha2_codes
     return alpha2_codes
 
 
+# Incomplete list of countries that put street number first.
+alpha2_number_first = {
+    "GB",  # United Kingdom
+    "IE",  # Ireland
+    "US",  # United States
+    "MX",  # Mexico
+    "CA",  # Canada
+    "FR",  # France
+    "AU",  # Australia
+    "NZ",  # New Zealand
+    "ZA",  # South Africa
+}
+
+
 def is_street_number_first(lat: float, lon: float) -> bool:
     """Is lat/lon within a country that puts number first in a street address."""
     if lat is None or lon is None:
         return True
 
-    alpha2 = get_country_iso3166_1(lat, lon)
-    # Incomplete list of countries that put street number first.
-    alpha2_number_first = {
-        "GB",  # United Kingdom
-        "IE",  # Ireland
-        "US",  # United States
-        "MX",  # Mexico
-        "CA",  # Canada
-        "FR",  # France
-        "AU",  # Australia
-        "NZ",  # New Zealand
-        "ZA",  # South Africa
-    }
-
-    return bool(alpha2_number_first & alpha2)
+    return bool(alpha2_number_first & get_country_iso3166_1(lat, lon))
 
 
 def make_envelope(bounds: list[float]) -> geoalchemy2.functions.ST_MakeEnvelope:
@@ -102,41 +125,16 @@ def parse_point(point: str) -> tuple[str, str]:
     return (lon, lat)
 
 
-def get_bbox_centroid(bbox: list[float]) -> tuple[str, str]:
+def get_bbox_centroid(bbox: list[float]) -> tuple[float, float]:
     """Get centroid of bounding box."""
-    bbox = make_envelope(bbox)
-    centroid = database.session.query(
-        sqlalchemy.func.ST_AsText(sqlalchemy.func.ST_Centroid(bbox))
-    ).scalar()
-    lon, lat = parse_point(centroid)
-    return (lat, lon)
+    return geodesy.bbox_centroid(bbox)
 
 
 def make_envelope_around_point(
     lat: float, lon: float, distance: float
 ) -> geoalchemy2.functions.ST_MakeEnvelope:
     """Make an envelope around a point, the distance parameter specifies the size."""
-    conn = database.session.connection()
-
-    p = sqlalchemy.sql.expression.cast(
-        sqlalchemy.func.ST_MakePoint(lon, lat), geoalchemy2.Geography
-    )
-
-    s = select(
-        *[
-            sqlalchemy.func.ST_AsText(
-                sqlalchemy.func.ST_Project(p, distance, sqlalchemy.func.radians(deg))
-            )
-            for deg in (0, 90, 180, 270)
-        ]
-    )
-    coords = [parse_point(i) for i in conn.execute(s).fetchone()]
-
-    north = float(coords[0][1])
-    east = float(coords[1][0])
-    south = float(coords[2][1])
-    west = float(coords[3][0])
-
+    west, south, east, north = geodesy.envelope_around_point(lat, lon, distance)
     return sqlalchemy.func.ST_MakeEnvelope(west, south, east, north, srid)
 
 
@@ -148,42 +146,70 @@ def drop_way_area(tags: TagsType) -> TagsType:
 
 
 def get_part_of(
-    table_name: str, src_id: int, bbox: geoalchemy2.functions.ST_MakeEnvelope
-) -> list[dict[str, typing.Any]]:
-    """Get part of."""
-    table_map = {"point": point, "line": line, "polygon": polygon}
-    table_alias = table_map[table_name].alias()
+    candidates: typing.Collection[tuple[str, int]],
+    bbox_list: list[geoalchemy2.functions.ST_MakeEnvelope],
+) -> dict[tuple[str, int], list[dict[str, typing.Any]]]:
+    """Named landuse/amenity polygons that contain the candidate OSM objects.
 
-    tags: Mapped[postgresql.HSTORE] = polygon.c.tags
+    Candidates are given as (table name, osm_id) pairs, the return value is keyed
+    the same way. All candidates are checked with a single query.
+    """
+    if not candidates:
+        return {}
 
-    s = (
-        select(
-            polygon.c.osm_id,
-            polygon.c.tags,
-            sqlalchemy.func.ST_Area(sqlalchemy.func.ST_Collect(polygon.c.way)),
-        )
-        .where(
-            and_(
-                sqlalchemy.func.ST_Intersects(bbox, polygon.c.way),
-                sqlalchemy.func.ST_Covers(polygon.c.way, table_alias.c.way),
-                table_alias.c.osm_id == src_id,
-                tags.has_key("name"),
-                or_(tags.has_key("landuse"), tags.has_key("amenity")),
+    table_map = {"point": point, "line": line, "polygon": polygon}
+    area = osm_geometry.alias("part_of")
+    tags: Mapped[postgresql.HSTORE] = area.c.tags
+
+    ids_by_table: dict[str, set[int]] = collections.defaultdict(set)
+    for table_name, src_id in candidates:
+        ids_by_table[table_name].add(src_id)
+
+    selects = []
+    for table_name, src_ids in ids_by_table.items():
+        table_alias = table_map[table_name].alias()
+        selects.append(
+            select(
+                sqlalchemy.sql.expression.literal(table_name).label("tbl"),
+                table_alias.c.osm_id.label("src_id"),
+                area.c.osm_id,
+                area.c.tags,
+                area.c.area,
             )
+            .where(
+                and_(
+                    area.c.tbl == "polygon",
+                    or_(
+                        *[
+                            sqlalchemy.func.ST_Intersects(bbox, area.c.way)
+                            for bbox in bbox_list
+                        ]
+                    ),
+                    sqlalchemy.func.ST_Covers(area.c.way, table_alias.c.way),
+                    table_alias.c.osm_id.in_(list(src_ids)),
+                    tags.has_key("name"),
+                    or_(tags.has_key("landuse"), tags.has_key("amenity")),
+                )
+            )
+            .group_by(table_alias.c.osm_id, area.c.tbl, area.c.osm_id)
         )
-        .group_by(polygon.c.osm_id, polygon.c.tags)
-    )
+
+    s = sqlalchemy.sql.expression.union_all(*selects)
 
     conn = database.session.connection()
-    return [
-        {
-            "type": "way" if osm_id > 0 else "relation",
-            "id": abs(osm_id),
-            "tags": tags,
-            "area": area,
-        }
-        for osm_id, tags, area in conn.execute(s)
-    ]
+    part_of: dict[tuple[str, int], list[dict[str, typing.Any]]] = (
+        collections.defaultdict(list)
+    )
+    for table_name, src_id, osm_id, tags, area in conn.execute(s):
+        part_of[(table_name, src_id)].append(
+            {
+                "type": "way" if osm_id > 0 else "relation",
+                "id": abs(osm_id),
+                "tags": tags,
+                "area": area,
+            }
+        )
+    return part_of
 
 
 def get_and_save_item(qid: str) -> model.Item | None:
@@ -211,6 +237,10 @@ def get_and_save_item(qid: str) -> model.Item | None:
     assert item
     item.locations = model.location_objects(coords)
     database.session.add(item)
+    database.session.flush()
+    item_isa.update_items([item_id])
+    item_marker.update_items([item_id])
+    tile_cache.invalidate_points(loc.get_lat_lon() for loc in item.locations)
     database.session.commit()
 
     return item
@@ -245,61 +275,71 @@ def get_items_in_bbox(bbox: list[float]):
     return q
 
 
-def get_osm_with_wikidata_tag(bbox, isa_filter=None):
-    bbox_str = ",".join(str(v) for v in bbox)
-    extra_sql = ""
-    if isa_filter:
-        q = model.Item.query.join(model.ItemLocation).filter(
-            sqlalchemy.func.ST_Covers(make_envelope(bbox), model.ItemLocation.location)
-        )
-        q = add_isa_filter(q, isa_filter)
-        qids = [isa.qid for isa in q]
-        if not qids:
-            return []
-
-        qid_list = ",".join(f"'{qid}'" for qid in qids)
-        extra_sql += f" AND tags -> 'wikidata' in ({qid_list})"
+bbox_envelope_sql = f"ST_MakeEnvelope(:west, :south, :east, :north, {srid})"
 
-    # easier than building this query with SQLAlchemy
-    sql = (
-        f"""
-SELECT tbl, osm_id, tags, ARRAY[ST_Y(centroid), ST_X(centroid)], geojson
+# Matches the partial indexes on rows with a wikidata tag in planet_osm_point and
+# osm_geometry, GeoJSON is only built for the rows that are returned.
+osm_with_wikidata_tag_sql = f"""
+SELECT tbl, osm_id, tags, ARRAY[ST_Y(centroid), ST_X(centroid)],
+    CASE tbl
+        WHEN 'point' THEN {{point_geojson}}
+        WHEN 'line' THEN {{line_geojson}}
+        ELSE {{polygon_geojson}}
+    END
 FROM (
-    SELECT 'point' as tbl, osm_id, tags, ST_AsText(ST_Centroid(way)) as centroid, ST_AsGeoJSON(way) as geojson
+    SELECT 'point' AS tbl, osm_id, tags, way, ST_Centroid(way) AS centroid
     FROM planet_osm_point
-    WHERE ST_Intersects(ST_MakeEnvelope({bbox_str}, {srid}), way)
-UNION
-    SELECT 'line' as tbl, osm_id, tags, ST_AsText(ST_Centroid(ST_Collect(way))) AS centroid, ST_AsGeoJSON(ST_Collect(way)) AS geojson
-    FROM planet_osm_line
-    WHERE ST_Intersects(ST_MakeEnvelope({bbox_str}, {srid}), way)
-    GROUP BY osm_id, tags
-UNION
-    SELECT 'polygon' as tbl, osm_id, tags, ST_AsText(ST_Centroid(ST_Collect(way))) AS centroid, ST_AsGeoJSON(ST_Collect(way)) AS geojson
-    FROM planet_osm_polygon
-    WHERE ST_Intersects(ST_MakeEnvelope({bbox_str}, {srid}), way)
-    GROUP BY osm_id, tags
-    HAVING st_area(st_collect(way)) < 20 * st_area(ST_MakeEnvelope({bbox_str}, {srid}))
-) as anon
-WHERE tags ? 'wikidata'
+    WHERE tags ? 'wikidata' AND ST_Intersects({bbox_envelope_sql}, way)
+        {{point_filter}}
+UNION ALL
+    SELECT tbl, osm_id, tags, way, centroid
+    FROM osm_geometry
+    WHERE tags ? 'wikidata' AND ST_Intersects({bbox_envelope_sql}, way)
+        AND (tbl = 'line' OR area < 20 * ST_Area({bbox_envelope_sql}))
+        {{geometry_filter}}
+) AS found
 """
-        + extra_sql
-    )
-    conn = database.session.connection()
-    result = conn.execute(sqlalchemy.text(sql))
 
-    # print(sql)
+point_qid_filter_sql = """
+AND osm_id IN (
+    SELECT osm_id FROM osm_wikidata WHERE tbl = 'point' AND qid = ANY(:qids)
+)
+"""
 
-    point_sql = (
-        f"""
-    SELECT 'point' as tbl, osm_id, tags, ST_AsText(ST_Centroid(way)) as centroid, ST_AsGeoJSON(way) as geojson
-    FROM planet_osm_point
-    WHERE ST_Intersects(ST_MakeEnvelope({bbox_str}, {srid}), way) and tags ? 'wikidata'
+geometry_qid_filter_sql = """
+AND (tbl, osm_id) IN (
+    SELECT tbl, osm_id FROM osm_wikidata WHERE qid = ANY(:qids)
+)
 """
-        + extra_sql
-    )
 
-    print("point")
-    print(point_sql)
+
+def get_osm_with_wikidata_tag(bbox, isa_filter=None, tolerance=None):
+    """OSM objects with a wikidata tag in the bounding box."""
+    params: dict[str, typing.Any] = dict(zip(["west", "south", "east", "north"], bbox))
+    filters = {"point_filter": "", "geometry_filter": ""}
+    if isa_filter:
+        q = sqlalchemy.select(model.ItemMarker.qid).where(
+            *item_marker.in_bounds(bbox, isa_filter)
+        )
+        params["qids"] = database.session.execute(q).scalars().all()
+        if not params["qids"]:
+            return []
+        filters = {
+            "point_filter": point_qid_filter_sql,
+            "geometry_filter": geometry_qid_filter_sql,
+        }
+
+    sql = osm_with_wikidata_tag_sql.format(
+        point_geojson=simplify.geojson_sql("point", "found.way", tolerance),
+        line_geojson=simplify.geojson_sql(
+            "line", "found.way", tolerance, osm_id="found.osm_id"
+        ),
+        polygon_geojson=simplify.geojson_sql(
+            "polygon", "found.way", tolerance, osm_id="found.osm_id"
+        ),
+        **filters,
+    )
+    result = database.session.execute(sqlalchemy.text(sql), params)
 
     tagged = []
     for tbl, osm_id, tags, centroid, geojson in result:
@@ -347,36 +387,64 @@ class IsaPath(typing.TypedDict):
     label: str
 
 
-def get_item_tags(item: model.Item) -> dict[str, list[str]]:
-    isa_list: list[int] = [typing.cast(int, v["numeric-id"]) for v in item.get_isa()]
-    isa_items: list[tuple[model.Item, list[IsaPath]]] = [
-        (isa, []) for isa in get_items(isa_list)
-    ]
+# Properties followed when walking from an item type towards OSM tags.
+isa_properties = [
+    ("P279", "subclass of"),
+    ("P140", "religion"),
+    ("P641", "sport"),
+    ("P366", "use"),
+    ("P1269", "facet of"),
+    # ("P361", "part of"),
+]
+
+# Item types that are specific enough, no need to keep walking the item hierarchy.
+isa_stop = {
+    "Q11799049": "public institution",
+    "Q7075": "library",
+    "Q329683": "industrial park",
+}
 
-    osm_list = collections.defaultdict(list)
+# Relevant to the IsA tag closure: claims followed by the walk and OSM tag claims.
+isa_tag_pids = {pid for pid, label in isa_properties} | {"P1282"}
 
-    skip_isa: set[int] = {
-        row[0] for row in database.session.query(model.SkipIsA.item_id)
-    }
+building_qid = "Q41176"
 
+
+def skip_building(isa_ids: typing.Collection[int]) -> bool:
+    """Ignore tags that come via building (Q41176) for these item types."""
     tram_stop_id = 41176
     airport_id = 1248784
     aerodrome_id = 62447
-    if {tram_stop_id, airport_id, aerodrome_id} & set(isa_list):
-        skip_isa.add(41176)  # building (Q41176)
-
-    seen: set[int] = set(isa_list) | skip_isa
-    stop = {
-        "Q11799049": "public institution",
-        "Q7075": "library",
-        "Q329683": "industrial park",
-    }
+    return bool({tram_stop_id, airport_id, aerodrome_id} & set(isa_ids))
+
+
+def walk_isa_tags(
+    root: model.Item, exclude: typing.Collection[int] = ()
+) -> model.IsATags:
+    """Walk the item type hierarchy from root collecting OSM tags/keys.
+
+    Item types in exclude aren't followed from a neighbour, like the items in
+    the skip_isa table. The root is always walked.
+    """
+    skip_isa: set[int] = {
+        row[0] for row in database.session.query(model.SkipIsA.item_id)
+    } | set(exclude)
+
+    isa_items: list[tuple[model.Item, list[IsaPath]]] = [(root, [])]
+    osm_list: dict[str, list[list[IsaPath]]] = collections.defaultdict(list)
+    seen: set[int] = {root.item_id} | skip_isa
+    # every item the walk depends on, including skipped neighbours
+    members: set[int] = {root.item_id}
+    items_checked: list[IsaPath] = []
+
     while isa_items:
         isa, isa_path = isa_items.pop()
         if not isa:
             continue
+        members.add(isa.item_id)
         isa_qid: str = typing.cast(str, isa.qid)
         isa_path = isa_path + [{"qid": isa_qid, "label": isa.label()}]
+        items_checked.append({"qid": isa_qid, "label": isa.label()})
         osm: list[str] = [
             typing.cast(str, v) for v in isa.get_claim("P1282") if v not in skip_tags
         ]
@@ -389,21 +457,11 @@ def get_item_tags(item: model.Item) -> dict[str, list[str]]:
         for i in osm:
             osm_list[i].append(isa_path[:])
 
-        if isa_qid in stop:
-            # item is specific enough, no need to keep walking the item hierarchy
+        if isa_qid in isa_stop:
             continue
 
         check: set[int] = set()
-        properties = [
-            ("P279", "subclass of"),
-            ("P140", "religion"),
-            ("P641", "sport"),
-            ("P366", "use"),
-            ("P1269", "facet of"),
-            # ("P361", "part of"),
-        ]
-
-        for pid, label in properties:
+        for pid, label in isa_properties:
             check |= {
                 typing.cast(dict[str, int], v)["numeric-id"]
                 for v in (isa.get_claim(pid) or [])
@@ -411,141 +469,224 @@ def get_item_tags(item: model.Item) -> dict[str, list[str]]:
             }
 
         print(isa.qid, isa.label(), check)
+        members |= check & skip_isa
         isa_list_set = check - seen
         seen.update(isa_list_set)
         isa_items += [(isa, isa_path) for isa in get_items(isa_list_set)]
-    return {key: list(values) for key, values in osm_list.items()}
 
+    return model.IsATags(
+        item_id=root.item_id,
+        tags=dict(osm_list),
+        checked=items_checked,
+        members=sorted(members),
+    )
 
-def get_tags_for_isa_item(item):
-    isa_list = [item.item_id]
-    isa_items = [(item, [])]
 
-    osm_list = collections.defaultdict(list)
+def build_isa_tags(item: model.Item) -> model.IsATags:
+    """Walk the item hierarchy and save the result in the isa_tags table.
 
-    skip_isa = {row[0] for row in database.session.query(model.SkipIsA.item_id)}
+    A second walk that doesn't follow building (Q41176) is saved when the first
+    walk reaches building. The caller commits.
+    """
+    isa_tags = walk_isa_tags(item)
+    building_id = int(building_qid[1:])
+    if building_id in isa_tags.members and item.item_id != building_id:
+        no_building = walk_isa_tags(item, exclude={building_id})
+        isa_tags.tags_no_building = no_building.tags
+        isa_tags.members = sorted(set(isa_tags.members) | set(no_building.members))
+
+    table = model.IsATags.__table__
+    values = {c.name: getattr(isa_tags, c.name) for c in table.columns}
+    stmt = postgresql.insert(table).values(**values)
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.item_id], set_=values)
+    database.session.execute(stmt)
+    return isa_tags
+
+
+def get_isa_tags(item_id: int) -> model.IsATags | None:
+    """Precomputed OSM tags for an item type, built if missing."""
+    isa_tags: model.IsATags | None = model.IsATags.query.get(item_id)
+    if isa_tags:
+        return isa_tags
+    item = get_item(item_id)
+    return build_isa_tags(item) if item else None
+
+
+def invalidate_isa_tags(item_ids: typing.Collection[int]) -> int:
+    """Drop precomputed IsA tags that depend on any of the given items."""
+    if not item_ids:
+        return 0
+    q = model.IsATags.query.filter(model.IsATags.members.overlap(list(item_ids)))
+    count: int = q.delete(synchronize_session=False)
+    return count
+
+
+def reset_isa_tags() -> None:
+    """Recreate the isa_tags table, rows are built again when next requested."""
+    table = model.IsATags.__table__
+    table.drop(database.session.connection(), checkfirst=True)
+    table.create(database.session.connection())
+    database.session.commit()
 
-    tram_stop_id = 41176
-    airport_id = 1248784
-    aerodrome_id = 62447
-    if {tram_stop_id, airport_id, aerodrome_id} & set(isa_list):
-        skip_isa.add(41176)  # building (Q41176)
-
-    seen = set(isa_list) | skip_isa
-    stop = {
-        "Q11799049": "public institution",
-        "Q7075": "library",
-        "Q329683": "industrial park",
-    }
-    items_checked = []
-    items_checked_done = set()
-    while isa_items:
-        isa, isa_path = isa_items.pop()
-        if not isa:
-            continue
-        isa_path = isa_path + [{"qid": isa.qid, "label": isa.label()}]
-        if isa.item_id not in items_checked_done:
-            items_checked.append({"qid": isa.qid, "label": isa.label()})
-            items_checked_done.add(isa.item_id)
-        osm = [v for v in isa.get_claim("P1282") if v not in skip_tags]
 
-        osm += [
-            extra.tag_or_key
-            for extra in model.ItemExtraKeys.query.filter_by(item_id=isa.item_id)
-        ]
+def isa_tag_paths(
+    isa_tags: model.IsATags, skip: bool
+) -> dict[str, list[list[IsaPath]]]:
+    """Tags from the walk that doesn't go via building when skip is set."""
+    if skip and isa_tags.tags_no_building is not None:
+        return typing.cast(dict[str, list[list[IsaPath]]], isa_tags.tags_no_building)
+    return typing.cast(dict[str, list[list[IsaPath]]], isa_tags.tags)
 
-        for i in osm:
-            osm_list[i].append(isa_path[:])
 
-        if isa.qid in stop:
-            # item is specific enough, no need to keep walking the item hierarchy
+def get_item_tags(item: model.Item) -> dict[str, list[list[IsaPath]]]:
+    """OSM tags/keys for an item, with the IsA path that led to each one."""
+    isa_list: list[int] = [typing.cast(int, v["numeric-id"]) for v in item.get_isa()]
+    skip = skip_building(isa_list)
+
+    osm_list: dict[str, list[list[IsaPath]]] = collections.defaultdict(list)
+    for isa_id in dict.fromkeys(isa_list):
+        isa_tags = get_isa_tags(isa_id)
+        if not isa_tags:
             continue
+        for tag_or_key, paths in isa_tag_paths(isa_tags, skip).items():
+            for path in paths:
+                if path not in osm_list[tag_or_key]:
+                    osm_list[tag_or_key].append(path)
 
-        check = set()
-        properties = [
-            ("P279", "subclass of"),
-            ("P140", "religion"),
-            ("P641", "sport"),
-            ("P366", "use"),
-            ("P1269", "facet of"),
-            # ("P361", "part of"),
-        ]
+    return {key: values for key, values in osm_list.items() if values}
 
-        for pid, label in properties:
-            check |= {v["numeric-id"] for v in (isa.get_claim(pid) or []) if v}
 
-        print(isa.qid, isa.label(), check)
-        isa_list = check - seen
-        seen.update(isa_list)
-        isa_items += [(isa, isa_path) for isa in get_items(isa_list)]
+def get_tags_for_isa_item(item: model.Item) -> dict[str, typing.Any]:
+    """OSM tags/keys for an item type and the items checked to find them."""
+    isa_tags = get_isa_tags(item.item_id)
+    assert isa_tags
+    tags = isa_tag_paths(isa_tags, skip_building([item.item_id]))
     return {
-        "tags": {key: list(values) for key, values in osm_list.items()},
-        "checked": items_checked,
+        "tags": {key: paths for key, paths in tags.items() if paths},
+        "checked": isa_tags.checked,
     }
 
 
 def add_isa_filter(q, isa_qids):
-    q_subclass = database.session.query(model.Item.qid).filter(
-        sqlalchemy.func.jsonb_path_query_array(
-            model.Item.claims,
-            "$.P279[*].mainsnak.datavalue.value.id",
-        ).bool_op("?|")(list(isa_qids))
-    )
+    """Limit query to items that are an instance of the given types or subclasses."""
+    return q.filter(item_isa.filter_items(model.Item.item_id, isa_qids))
 
-    subclass_qid = {qid for qid, in q_subclass.all()}
 
-    isa = sqlalchemy.func.jsonb_path_query_array(
-        model.Item.claims,
-        "$.P31[*].mainsnak.datavalue.value.id",
-    ).bool_op("?|")
-    return q.filter(isa(list(isa_qids | subclass_qid)))
+def wikidata_items_count(bounds, isa_filter=None):
+    """Number of items within the bounds."""
+    return get_viewport(bounds, isa_filter=isa_filter, sections={"count"})["count"]
 
 
-def wikidata_items_count(bounds, isa_filter=None):
-    q = model.Item.query.join(model.ItemLocation).filter(
-        sqlalchemy.func.ST_Covers(make_envelope(bounds), model.ItemLocation.location)
-    )
+def wikidata_isa_counts(bounds, isa_filter=None):
+    """Instance of counts for items within the bounds."""
+    viewport = get_viewport(bounds, isa_filter=isa_filter, sections={"isa"})
+    return viewport["isa_count"]
 
-    if isa_filter:
-        q = add_isa_filter(q, isa_filter)
 
-    # print(q.statement.compile(compile_kwargs={"literal_binds": True}))
+def fill_missing_isa_labels(
+    facets: list["item_marker.IsaFacet"], download: bool = True
+) -> list["item_marker.IsaFacet"]:
+    """Download item types that are missing from the database to get a label.
 
-    return q.count()
+    Facets for items in the database always have a label, "[no label]" when the
+    item has none. Without download the label of a missing item stays None.
+    """
+    for facet in facets:
+        if facet["label"] is None and download:
+            item = get_and_save_item(facet["qid"])
+            facet["label"] = item.label() if item else "[missing]"
+    return facets
+
+
+def isa_count_labels(
+    counts: list[tuple[str, int]], limit: int | None = None, download: bool = True
+) -> list["item_marker.IsaFacet"]:
+    """Add labels to the most common instance of counts."""
+    counts = counts[:limit]
+    q = sqlalchemy.select(
+        model.Item.item_id, item_marker.item_label(model.Item.labels)
+    ).where(model.Item.item_id.in_([int(qid[1:]) for qid, count in counts]))
+    labels = {f"Q{item_id}": label for item_id, label in database.session.execute(q)}
+
+    facets: list[item_marker.IsaFacet] = [
+        {"qid": qid, "count": count, "label": labels.get(qid)} for qid, count in counts
+    ]
+    return fill_missing_isa_labels(facets, download)
 
 
-def wikidata_isa_counts(bounds, isa_filter=None):
-    db_bbox = make_envelope(bounds)
+def count_marker_isa(rows: list["item_marker.MarkerRow"]) -> list[tuple[str, int]]:
+    """Count of marker rows for each instance of (P31) type."""
+    isa_count: collections.Counter[str] = collections.Counter(
+        f"Q{isa_id}" for row in rows for isa_id in row["isa_ids"]
+    )
+    return isa_count.most_common()
 
-    q = model.Item.query.join(model.ItemLocation).filter(
-        sqlalchemy.func.ST_Covers(db_bbox, model.ItemLocation.location)
+
+def marker_in_bounds(marker: "ItemDetailType", bounds: list[float]) -> bool:
+    """Any of the item locations are within the bounds."""
+    west, south, east, north = bounds
+    return any(
+        south <= lat <= north and west <= lon <= east for lat, lon in marker["markers"]
     )
 
-    if isa_filter:
-        q = add_isa_filter(q, isa_filter)
 
-    db_items = q.all()
+def get_tiled_marker_rows(
+    bounds: list[float], isa_filter: set[str] | None = None
+) -> list["item_marker.MarkerRow"] | None:
+    """Marker rows within the cache tiles covering the bounds.
 
-    counts = get_isa_count(db_items)
-    isa_ids = [qid[1:] for qid, count in counts]
-    isa_items = {
-        isa.qid: isa for isa in model.Item.query.filter(model.Item.item_id.in_(isa_ids))
-    }
-    isa_count = []
-    for qid, count in counts:
-        item = isa_items.get(qid)
-        if not item:
-            item = get_and_save_item(qid)
+    Returns None if the bounds are too big for the cache.
+    """
+    return tile_cache.get_tiled(
+        "items",
+        bounds,
+        {"isa": isa_filter},
+        lambda tile_bounds: item_marker.get_marker_rows(tile_bounds, isa_filter),
+        lambda row: row["detail"]["qid"],
+    )
 
-        label = item.label() if item else "[missing]"
-        isa = {
-            "qid": qid,
-            "count": count,
-            "label": label,
-        }
-        isa_count.append(isa)
 
-    return isa_count
+def get_cached_marker_rows(
+    bounds: list[float], isa_filter: set[str] | None = None
+) -> list["item_marker.MarkerRow"] | None:
+    """Marker rows within the bounds from the tile cache.
+
+    Returns None if the bounds are too big for the cache.
+    """
+    rows = get_tiled_marker_rows(bounds, isa_filter)
+    if rows is None:
+        return None
+    return [row for row in rows if marker_in_bounds(row["detail"], bounds)]
+
+
+def get_tiled_osm_objects(bounds, isa_filter=None, tolerance=None):
+    """OSM objects within the cache tiles covering the bounds.
+
+    Returns None if the bounds are too big for the cache.
+    """
+    return tile_cache.get_tiled(
+        "osm",
+        bounds,
+        {"isa": isa_filter, "tolerance": tolerance},
+        lambda tile_bounds: get_osm_with_wikidata_tag(
+            tile_bounds, isa_filter=isa_filter, tolerance=tolerance
+        ),
+        lambda obj: obj["identifier"],
+    )
+
+
+def get_osm_objects(bounds, isa_filter=None, tolerance=None):
+    """OSM objects with wikidata tags within the bounds, using the tile cache.
+
+    Objects from the cached tiles are kept if their bounding box overlaps the
+    bounds.
+    """
+    objects = get_tiled_osm_objects(bounds, isa_filter, tolerance)
+    if objects is None:
+        return get_osm_with_wikidata_tag(
+            bounds, isa_filter=isa_filter, tolerance=tolerance
+        )
+    return [obj for obj in objects if osm_object_intersects(obj, bounds)]
 
 
 def get_tag_filter(
@@ -573,39 +714,8 @@ def get_tag_filter(
     return tag_filter
 
 
-def get_preset_translations() -> dict[str, typing.Any]:
-    app = flask.current_app
-    country_language = {
-        "AU": "en-AU",  # Australia
-        "GB": "en-GB",  # United Kingdom
-        "IE": "en-GB",  # Ireland
-        "IN": "en-IN",  # India
-        "NZ": "en-NZ",  # New Zealand
-    }
-    ts_dir = app.config["ID_TAGGING_SCHEMA_DIR"]
-    translation_dir = os.path.join(ts_dir, "dist", "translations")
-
-    for code in flask.g.alpha2_codes:
-        lang_code = country_language.get("code")
-        if not lang_code:
-            continue
-        filename = os.path.join(translation_dir, lang_code + ".json")
-        json_data = json.load(open(filename))
-        if lang_code not in json_data:
-            continue
-
-        try:
-            return typing.cast(
-                dict[str, typing.Any], json_data[lang_code]["presets"]["presets"]
-            )
-        except KeyError:
-            pass
-
-    return {}
-
-
 def get_presets_from_tags(ending: str, tags: TagsType) -> list[dict[str, typing.Any]]:
-    translations = get_preset_translations()
+    alpha2_codes = getattr(flask.g, "alpha2_codes", set())
 
     found: list[dict[str, typing.Any]] = []
 
@@ -615,64 +725,15 @@ def get_presets_from_tags(ending: str, tags: TagsType) -> list[dict[str, typing.
             found.append({"tag_or_key": tag_or_key, "name": "Sundial"})
             continue
 
-        match = find_preset_file(k, v, ending)
+        match = presets.find_preset(k, v, ending, alpha2_codes)
         if not match:
             continue
 
-        preset = match["preset"]
-        if preset in translations:
-            match["name"] = translations[preset]["name"]
-        else:
-            match["name"] = json.load(open(match["filename"]))["name"]
-
-        del match["filename"]
-
-        found.append(match)
+        found.append(dict(match))
 
     return found
 
 
-def find_preset_file(k: str, v: str, ending: str) -> dict[str, str] | None:
-    """Find preset file."""
-    app = flask.current_app
-    ts_dir = app.config["ID_TAGGING_SCHEMA_DIR"]
-    preset_dir = os.path.join(ts_dir, "data", "presets")
-
-    filename = os.path.join(preset_dir, k, v + ".json")
-    if os.path.exists(filename):
-        return {
-            "tag_or_key": f"Tag:{k}={v}",
-            "preset": f"{k}/{v}",
-            "filename": filename,
-        }
-
-    filename = os.path.join(preset_dir, k, f"{v}_{ending}.json")
-    if os.path.exists(filename):
-        return {
-            "tag_or_key": f"Tag:{k}={v}",
-            "preset": f"{k}/{v}",
-            "filename": filename,
-        }
-
-    filename = os.path.join(preset_dir, k, "_" + v + ".json")
-    if os.path.exists(filename):
-        return {
-            "tag_or_key": f"Tag:{k}={v}",
-            "preset": f"{k}/{v}",
-            "filename": filename,
-        }
-
-    filename = os.path.join(preset_dir, k + ".json")
-    if os.path.exists(filename):
-        return {
-            "tag_or_key": f"Key:{k}",
-            "preset": k,
-            "filename": filename,
-        }
-
-    return None
-
-
 def address_from_tags(tags: TagsType) -> str | None:
     """Build list of addresses based on OSM tags."""
     keys = ["street", "housenumber"]
@@ -690,21 +751,27 @@ def address_node_label(tags: TagsType) -> str | None:
     return f"{tags['name']} ({address})" if "name" in tags else address
 
 
-def get_address_nodes_within_building(osm_id, bbox_list):
-    q = model.Point.query.filter(
-        polygon.c.osm_id == osm_id,
-        or_(
-            *[
-                sqlalchemy.func.ST_Intersects(bbox, model.Point.way)
-                for bbox in bbox_list
-            ]
-        ),
-        sqlalchemy.func.ST_Covers(polygon.c.way, model.Point.way),
-        model.Point.tags.has_key("addr:street"),
-        model.Point.tags.has_key("addr:housenumber"),
+def get_address_nodes_within_buildings(
+    osm_ids: typing.Collection[int],
+    bbox_list: list[geoalchemy2.functions.ST_MakeEnvelope],
+) -> dict[int, list[TagsType]]:
+    """Address nodes within each of the given building polygons, keyed by osm_id."""
+    if not osm_ids:
+        return {}
+
+    s = select(polygon.c.osm_id, point.c.tags).where(
+        polygon.c.osm_id.in_(list(osm_ids)),
+        or_(*[sqlalchemy.func.ST_Intersects(bbox, point.c.way) for bbox in bbox_list]),
+        sqlalchemy.func.ST_Covers(polygon.c.way, point.c.way),
+        point.c.tags.has_key("addr:street"),
+        point.c.tags.has_key("addr:housenumber"),
     )
 
-    return [node.tags for node in q]
+    conn = database.session.connection()
+    address_nodes: dict[int, list[TagsType]] = collections.defaultdict(list)
+    for osm_id, tags in conn.execute(s):
+        address_nodes[osm_id].append(tags)
+    return address_nodes
 
 
 def osm_display_name(tags: TagsType) -> str | None:
@@ -724,7 +791,71 @@ def street_address_in_tags(tags):
     return "addr:housenumber" in tags and "addr:street" in tags
 
 
-def find_osm_candidates(item, limit=80, max_distance=450, names=None):
+def get_candidate_filters(
+    tags: sqlalchemy.sql.elements.ColumnElement[typing.Any],
+    tag_list: typing.Collection[str],
+    item_is_street: bool,
+    names: typing.Collection[str] | None,
+) -> list[sqlalchemy.sql.elements.ColumnElement[bool]]:
+    """Conditions on tags that every OSM candidate has to meet."""
+    conditions = []
+    if names:
+        conditions.append(or_(tags["name"].in_(names), tags["old_name"].in_(names)))
+
+    if item_is_street:
+        conditions.append(tags["highway"] != "bus_stop")
+        if not names:
+            conditions.append(tags.has_key("name"))
+
+    if "Key:amenity" in tag_list:
+        conditions.append(
+            and_(
+                tags["amenity"] != "bicycle_parking",
+                tags["amenity"] != "bicycle_repair_station",
+                tags["amenity"] != "atm",
+                tags["amenity"] != "recycling",
+            )
+        )
+
+    return conditions
+
+
+def get_knn_osm_ids(
+    table: sqlalchemy.sql.expression.FromClause,
+    points: list[tuple[float, float]],
+    conditions: list[sqlalchemy.sql.elements.ColumnElement[bool]],
+    limit: int,
+) -> sqlalchemy.sql.expression.CompoundSelect:
+    """IDs of the nearest matching objects to each point, using the KNN operator.
+
+    The spatial index returns rows in distance order, so PostgreSQL stops once
+    limit matching rows have been found for each point.
+    """
+    selects = [
+        select(table.c.osm_id)
+        .where(*conditions)
+        .order_by(
+            table.c.way.op("<->")(
+                sqlalchemy.func.ST_SetSRID(sqlalchemy.func.ST_MakePoint(lon, lat), srid)
+            )
+        )
+        .limit(limit)
+        for lat, lon in points
+    ]
+    return sqlalchemy.sql.expression.union_all(*selects)
+
+
+def find_osm_candidates(
+    item, limit=80, max_distance=450, names=None, knn=False, tolerance=None
+):
+    """Find OSM objects near to the item that could be a match.
+
+    With knn the nearest objects from each table are found with index ordered
+    nearest-neighbour search, rather than measuring everything within the bounding
+    box. Only used when there is a limit.
+
+    The tolerance, in degrees, is used to simplify the returned geometry.
+    """
     item_id = item.item_id
     item_is_linear_feature = item.is_linear_feature()
     item_is_street = item.is_street()
@@ -736,10 +867,8 @@ def find_osm_candidates(item, limit=80, max_distance=450, names=None):
 
     check_is_street_number_first(item.locations[0].get_lat_lon())
 
-    bbox_list = [
-        make_envelope_around_point(*loc.get_lat_lon(), max_distance)
-        for loc in item.locations
-    ]
+    points = [loc.get_lat_lon() for loc in item.locations]
+    bbox_list = [make_envelope_around_point(*p, max_distance) for p in points]
 
     null_area = sqlalchemy.sql.expression.cast(None, sqlalchemy.types.Float)
     dist = sqlalchemy.sql.expression.column("dist")
@@ -749,6 +878,36 @@ def find_osm_candidates(item, limit=80, max_distance=450, names=None):
 
     tag_list = get_item_tags(item)
 
+    def object_filter(
+        table: sqlalchemy.sql.expression.FromClause, tbl: str | None = None
+    ) -> list[sqlalchemy.sql.elements.ColumnElement[bool]]:
+        conditions = [
+            or_(
+                *[
+                    sqlalchemy.func.ST_Intersects(bbox, table.c.way)
+                    for bbox in bbox_list
+                ]
+            ),
+            or_(*get_tag_filter(table.c.tags, tag_list)),
+        ]
+        if tbl:  # osm_geometry holds both lines and polygons
+            conditions.append(table.c.tbl == tbl)
+        return conditions
+
+    def table_filter(
+        table: sqlalchemy.sql.expression.FromClause, tbl: str | None = None
+    ) -> sqlalchemy.sql.elements.BooleanClauseList:
+        conditions = object_filter(table, tbl)
+        if knn and limit:
+            knn_table = table.alias()
+            knn_conditions = object_filter(knn_table, tbl) + get_candidate_filters(
+                knn_table.c.tags, tag_list, item_is_street, names
+            )
+            knn_ids = get_knn_osm_ids(knn_table, points, knn_conditions, limit)
+            conditions.append(table.c.osm_id.in_(knn_ids))
+
+        return and_(model.ItemLocation.item_id == item_id, *conditions)
+
     s_point = (
         select(
             sqlalchemy.sql.expression.literal("point").label("t"),
@@ -760,88 +919,56 @@ def find_osm_candidates(item, limit=80, max_distance=450, names=None):
                 )
             ).label("dist"),
             sqlalchemy.func.ST_AsText(point.c.way),
-            sqlalchemy.func.ST_AsGeoJSON(point.c.way),
+            simplify.geojson("point", point.c.osm_id, point.c.way, tolerance),
             null_area,
         )
-        .where(
-            and_(
-                or_(
-                    *[
-                        sqlalchemy.func.ST_Intersects(bbox, point.c.way)
-                        for bbox in bbox_list
-                    ]
-                ),
-                model.ItemLocation.item_id == item_id,
-                or_(*get_tag_filter(point.c.tags, tag_list)),
-            )
-        )
+        .where(table_filter(point))
         .group_by(point.c.osm_id, point.c.tags, point.c.way)
     )
 
+    line_geometry = osm_geometry.alias("line_geometry")
     s_line = (
         select(
             sqlalchemy.sql.expression.literal("line").label("t"),
-            line.c.osm_id,
-            line.c.tags.label("tags"),
+            line_geometry.c.osm_id,
+            line_geometry.c.tags.label("tags"),
             sqlalchemy.func.min(
                 sqlalchemy.func.ST_DistanceSphere(
-                    model.ItemLocation.location, line.c.way
+                    model.ItemLocation.location, line_geometry.c.way
                 )
             ).label("dist"),
-            sqlalchemy.func.ST_AsText(
-                sqlalchemy.func.ST_Centroid(sqlalchemy.func.ST_Collect(line.c.way))
+            sqlalchemy.func.ST_AsText(line_geometry.c.centroid),
+            simplify.geojson(
+                "line", line_geometry.c.osm_id, line_geometry.c.way, tolerance
             ),
-            sqlalchemy.func.ST_AsGeoJSON(sqlalchemy.func.ST_Collect(line.c.way)),
             null_area,
         )
-        .where(
-            and_(
-                or_(
-                    *[
-                        sqlalchemy.func.ST_Intersects(bbox, line.c.way)
-                        for bbox in bbox_list
-                    ]
-                ),
-                model.ItemLocation.item_id == item_id,
-                or_(*get_tag_filter(line.c.tags, tag_list)),
-            )
-        )
-        .group_by(line.c.osm_id, line.c.tags)
+        .where(table_filter(line_geometry, "line"))
+        .group_by(line_geometry.c.tbl, line_geometry.c.osm_id)
     )
 
+    polygon_geometry = osm_geometry.alias("polygon_geometry")
     s_polygon = (
         select(
             sqlalchemy.sql.expression.literal("polygon").label("t"),
-            polygon.c.osm_id,
-            polygon.c.tags.label("tags"),
+            polygon_geometry.c.osm_id,
+            polygon_geometry.c.tags.label("tags"),
             sqlalchemy.func.min(
                 sqlalchemy.func.ST_DistanceSphere(
-                    model.ItemLocation.location, polygon.c.way
+                    model.ItemLocation.location, polygon_geometry.c.way
                 )
             ).label("dist"),
-            sqlalchemy.func.ST_AsText(
-                sqlalchemy.func.ST_Centroid(sqlalchemy.func.ST_Collect(polygon.c.way))
+            sqlalchemy.func.ST_AsText(polygon_geometry.c.centroid),
+            simplify.geojson(
+                "polygon", polygon_geometry.c.osm_id, polygon_geometry.c.way, tolerance
             ),
-            sqlalchemy.func.ST_AsGeoJSON(sqlalchemy.func.ST_Collect(polygon.c.way)),
-            sqlalchemy.func.ST_Area(sqlalchemy.func.ST_Collect(polygon.c.way)),
+            polygon_geometry.c.area,
         )
         .where(
-            and_(
-                or_(
-                    *[
-                        sqlalchemy.func.ST_Intersects(bbox, polygon.c.way)
-                        for bbox in bbox_list
-                    ]
-                ),
-                model.ItemLocation.item_id == item_id,
-                or_(*get_tag_filter(polygon.c.tags, tag_list)),
-            )
-        )
-        .group_by(polygon.c.osm_id, polygon.c.tags)
-        .having(
-            sqlalchemy.func.ST_Area(sqlalchemy.func.ST_Collect(polygon.c.way))
-            < 20 * sqlalchemy.func.ST_Area(bbox_list[0])
+            table_filter(polygon_geometry, "polygon"),
+            polygon_geometry.c.area < 20 * sqlalchemy.func.ST_Area(bbox_list[0]),
         )
+        .group_by(polygon_geometry.c.tbl, polygon_geometry.c.osm_id)
     )
 
     tables = ([] if item_is_linear_feature else [s_point]) + [s_line, s_polygon]
@@ -851,23 +978,7 @@ def find_osm_candidates(item, limit=80, max_distance=450, names=None):
         .order_by(dist)
     )
 
-    if names:
-        s = s.where(or_(tags["name"].in_(names), tags["old_name"].in_(names)))
-
-    if item_is_street:
-        s = s.where(tags["highway"] != "bus_stop")
-        if not names:
-            s = s.where(tags.has_key("name"))
-
-    if "Key:amenity" in tag_list:
-        s = s.where(
-            and_(
-                tags["amenity"] != "bicycle_parking",
-                tags["amenity"] != "bicycle_repair_station",
-                tags["amenity"] != "atm",
-                tags["amenity"] != "recycling",
-            )
-        )
+    s = s.where(*get_candidate_filters(tags, tag_list, item_is_street, names))
 
     if limit:
         s = s.limit(limit)
@@ -875,8 +986,20 @@ def find_osm_candidates(item, limit=80, max_distance=450, names=None):
     # print(s.compile(compile_kwargs={"literal_binds": True}))
 
     conn = database.session.connection()
+    rows = conn.execute(s).fetchall()
+
+    building_ids = {
+        src_id
+        for table, src_id, tags, *_ in rows
+        if table == "polygon" and "building" in tags
+    }
+    building_address_nodes = get_address_nodes_within_buildings(building_ids, bbox_list)
+    part_of_lookup = get_part_of(
+        [(table, src_id) for table, src_id, *_ in rows], bbox_list
+    )
+
     nearby = []
-    for table, src_id, tags, distance, centroid, geojson, area in conn.execute(s):
+    for table, src_id, tags, distance, centroid, geojson, area in rows:
         osm_id = src_id
         if table == "point":
             osm_type = "node"
@@ -892,7 +1015,7 @@ def find_osm_candidates(item, limit=80, max_distance=450, names=None):
             name = address_from_tags(tags)
 
         if table == "polygon" and "building" in tags:
-            address_nodes = get_address_nodes_within_building(src_id, bbox_list)
+            address_nodes = building_address_nodes.get(src_id, [])
             address_list = [address_node_label(addr) for addr in address_nodes]
         else:
             address_list = []
@@ -917,11 +1040,11 @@ def find_osm_candidates(item, limit=80, max_distance=450, names=None):
         if area is not None:
             cur["area"] = area
 
-        part_of = []
-        for bbox in bbox_list:
-            part_of += [
-                i for i in get_part_of(table, src_id, bbox) if i["tags"]["name"] != name
-            ]
+        part_of = [
+            i
+            for i in part_of_lookup.get((table, src_id), [])
+            if i["tags"]["name"] != name
+        ]
         if part_of:
             cur["part_of"] = part_of
 
@@ -933,16 +1056,85 @@ def find_osm_candidates(item, limit=80, max_distance=450, names=None):
     return nearby
 
 
+def expand_street_name(from_names):
+    ret = set(from_names)
+    for name in from_names:
+        if any(name.startswith(st) for st in ("St ", "St. ")):
+            first_space = name.find(" ")
+            ret.add("Saint" + name[first_space:])
+
+        if ", " in name:
+            for n in set(ret):
+                comma = n.find(", ")
+                ret.add(name[:comma])
+        elif "/" in name:
+            for n in set(ret):
+                ret.extend(part.strip() for part in n.split("/"))
+
+    ret.update({"The " + name for name in ret if not name.startswith("The ")})
+    return ret
+
+
+class CandidateSearch(typing.TypedDict):
+    """Parameters for an OSM candidate search."""
+
+    limit: int | None
+    max_distance: int
+    names: set[str] | None
+
+
+def candidate_search_params(item: model.Item) -> CandidateSearch:
+    """Search parameters for OSM candidates, depending on the type of item."""
+    label = item.label()
+    if item.is_street():
+        return {
+            "max_distance": 5_000,
+            "limit": None,
+            "names": expand_street_name([label] + item.get_aliases()),
+        }
+    if item.is_watercourse():
+        return {"max_distance": 20_000, "limit": None, "names": {label}}
+    return {"max_distance": 1_000, "limit": 40, "names": None}
+
+
+def get_candidates(
+    item: model.Item, knn: bool = False, tolerance: float | None = None
+) -> dict[str, typing.Any]:
+    """Search for OSM candidates for an item, returns nearby and max_distance."""
+    params = candidate_search_params(item)
+    nearby = find_osm_candidates(item, knn=knn, tolerance=tolerance, **params)
+
+    if item.is_linear_feature() and not nearby:
+        # nearby = [osm for osm in nearby if street_name_match(label, osm)]
+
+        # try again without name filter
+        nearby = find_osm_candidates(
+            item, limit=100, max_distance=1_000, knn=knn, tolerance=tolerance
+        )
+
+    return {"nearby": nearby, "max_distance": params["max_distance"]}
+
+
 def get_item(item_id: int) -> model.Item | None:
     """Retrieve a Wikidata item, either from the database or from Wikidata."""
     item = model.Item.query.get(item_id)
     return item or get_and_save_item(f"Q{item_id}")
 
 
-def get_item_street_addresses(item: model.Item) -> list[str]:
+ItemLookup = typing.Callable[[int], model.Item | None]
+
+
+def has_numbered_street(item: model.Item) -> bool:
+    """Street addresses of the item are built from located on street (P669)."""
+    return "P669" in item.claims and not any(item.get_claim("P6375"))
+
+
+def get_item_street_addresses(
+    item: model.Item, street_number_first: bool, lookup: ItemLookup = get_item
+) -> list[str]:
     """Hunt for street addresses for the given item."""
     street_address = [addr["text"] for addr in item.get_claim("P6375") if addr]
-    if street_address or "P669" not in item.claims:
+    if not has_numbered_street(item):
         return street_address
 
     assert isinstance(item.claims, dict)
@@ -953,15 +1145,14 @@ def get_item_street_addresses(item: model.Item) -> list[str]:
             continue
         number = qualifiers["P670"][0]["datavalue"]["value"]
 
-        street_item = get_item(claim["mainsnak"]["datavalue"]["value"]["numeric-id"])
-        assert street_item
+        street_item = lookup(claim["mainsnak"]["datavalue"]["value"]["numeric-id"])
+        if not street_item:
+            continue
         street = street_item.label()
         for q in qualifiers["P670"]:
             number = q["datavalue"]["value"]
             address = (
-                f"{number} {street}"
-                if flask.g.street_number_first
-                else f"{street} {number}"
+                f"{number} {street}" if street_number_first else f"{street} {number}"
             )
             street_address.append(address)
 
@@ -993,25 +1184,35 @@ class ItemDetailType(typing.TypedDict, total=False):
 
 def item_detail(item: model.Item) -> ItemDetailType:
     """Get detail for an item, returns a dict."""
+    if not hasattr(flask.g, "street_number_first"):
+        lat, lon = item.locations[0].get_lat_lon()
+        flask.g.street_number_first = is_street_number_first(lat, lon)
+
+    return build_item_detail(item, flask.g.street_number_first)
+
+
+def build_item_detail(
+    item: model.Item, street_number_first: bool, lookup: ItemLookup = get_item
+) -> ItemDetailType:
+    """Detail for an item, related items are read with lookup."""
     unsupported_relation_types = {
         "Q194356",  # wind farm
         "Q2175765",  # tram stop
     }
 
     locations = [list(i.get_lat_lon()) for i in item.locations]
-    if not hasattr(flask.g, "street_number_first"):
-        flask.g.street_number_first = is_street_number_first(*locations[0])
-
     image_filenames = item.get_claim("P18")
 
-    street_address = get_item_street_addresses(item)
+    street_address = get_item_street_addresses(item, street_number_first, lookup)
 
     heritage_designation = []
     for v in item.get_claim("P1435"):
         if not v:
             print("heritage designation missing:", item.qid)
             continue
-        heritage_designation_item = get_item(v["numeric-id"])
+        heritage_designation_item = lookup(v["numeric-id"])
+        if not heritage_designation_item:
+            continue
         heritage_designation.append(
             {
                 "qid": v["id"],
@@ -1019,7 +1220,7 @@ def item_detail(item: model.Item) -> ItemDetailType:
             }
         )
 
-    isa_items = [get_item(isa["numeric-id"]) for isa in item.get_isa()]
+    isa_items = [lookup(isa["numeric-id"]) for isa in item.get_isa()]
     isa_lookup = {isa.qid: isa for isa in isa_items if isa}
 
     wikipedia_links = [
@@ -1066,37 +1267,221 @@ def get_markers(all_items):
     return [item_detail(item) for item in all_items if item]
 
 
-def wikidata_items(bounds, isa_filter=None):
-    check_is_street_number_first(get_bbox_centroid(bounds))
-    q = get_items_in_bbox(bounds)
+def is_large_bbox(bounds: list[float]) -> bool:
+    """Bounds are big enough that items should be clustered."""
+    west, south, east, north = bounds
+    return (east - west) * (north - south) > cluster_min_area
 
-    if isa_filter:
-        q = add_isa_filter(q, isa_filter)
 
-    db_items = q.all()
-    items = get_markers(db_items)
+def marker_details(
+    rows: list["item_marker.MarkerRow"], isa_count: list["item_marker.IsaFacet"]
+) -> list[ItemDetailType]:
+    """Markers from marker rows, using current labels for the item types."""
+    isa_labels = {isa["qid"]: isa["label"] for isa in isa_count}
+    items = [row["detail"] for row in rows]
 
-    counts = get_isa_count(db_items)
-    isa_ids = [qid[1:] for qid, count in counts]
-    isa_items = {
-        isa.qid: isa for isa in model.Item.query.filter(model.Item.item_id.in_(isa_ids))
+    # stored markers can have an old label for the item type
+    for marker in items:
+        for isa in marker["isa_list"]:
+            isa["label"] = isa_labels.get(isa["qid"]) or isa["label"]
+
+    return items
+
+
+def get_clusters(
+    bounds: list[float],
+    isa_filter: set[str] | None,
+    isa_count: list["item_marker.IsaFacet"],
+) -> list["item_marker.Cluster"]:
+    """Clusters of items within the bounds, labelled with the main item type."""
+    isa_labels = {isa["qid"]: isa["label"] for isa in isa_count}
+    clusters = item_marker.get_clusters(bounds, isa_filter=isa_filter)
+    for c in clusters:
+        if c["isa"]:
+            c["isa_label"] = isa_labels.get(c["isa"], c["isa"])
+    return clusters
+
+
+viewport_sections = {"count", "isa", "items", "osm"}
+
+# Default and maximum number of item types returned in instance of counts.
+isa_facet_limit = 200
+max_isa_facet_limit = 1_000
+
+
+def get_viewport(
+    bounds,
+    isa_filter=None,
+    sections=None,
+    cluster=False,
+    tolerance=None,
+    isa_limit=isa_facet_limit,
+) -> dict[str, typing.Any]:
+    """Item count, instance of counts, markers and tagged OSM objects for bounds.
+
+    Items within the bounds are found once and used for the count, instance of
+    counts and markers. Only the given sections are included. Instance of counts
+    are limited to the most common isa_limit types.
+    """
+    sections = viewport_sections & (sections or viewport_sections)
+    large = cluster and is_large_bbox(bounds)
+
+    rows = None
+    if sections & {"count", "isa", "items"} and not large:
+        if "items" in sections:
+            rows = get_marker_rows(bounds, isa_filter)
+        else:
+            rows = get_cached_marker_rows(bounds, isa_filter)
+
+    ret: dict[str, typing.Any] = {}
+    if "count" in sections:
+        if rows is not None:
+            ret["count"] = len(rows)
+        else:
+            count = None if isa_filter else item_grid.get_count(bounds)
+            if count is None:
+                count = item_marker.get_count(bounds, isa_filter=isa_filter)
+            ret["count"] = count
+
+    if sections & {"isa", "items"}:
+        grid_counts = None
+        if rows is None and not isa_filter:
+            grid_counts = item_grid.get_isa_counts(bounds)
+
+        if rows is not None:
+            isa_count = isa_count_labels(count_marker_isa(rows), limit=isa_limit)
+        elif grid_counts is not None:
+            isa_count = isa_count_labels(grid_counts, limit=isa_limit)
+        else:
+            facets = item_marker.get_isa_facets(
+                bounds, isa_filter=isa_filter, limit=isa_limit
+            )
+            isa_count = fill_missing_isa_labels(facets)
+        if "isa" in sections:
+            ret["isa_count"] = isa_count
+
+    if "items" in sections:
+        if rows is None:
+            ret["clustered"] = True
+            ret["clusters"] = get_clusters(bounds, isa_filter, isa_count)
+        else:
+            ret["items"] = marker_details(rows, isa_count)
+
+    if "osm" in sections:
+        ret["objects"] = get_osm_objects(
+            bounds, isa_filter=isa_filter, tolerance=tolerance
+        )
+
+    return ret
+
+
+def get_marker_rows(bounds, isa_filter=None) -> list["item_marker.MarkerRow"]:
+    """Marker rows within the bounds, from the tile cache when possible."""
+    rows = get_cached_marker_rows(bounds, isa_filter)
+    if rows is None:
+        rows = item_marker.get_marker_rows(bounds, isa_filter=isa_filter)
+    return rows
+
+
+def osm_object_in_bounds(obj: dict[str, typing.Any], bounds: list[float]) -> bool:
+    """The whole of an OSM object is within the bounds."""
+    west, south, east, north = bounds
+    x0, y0, x1, y1 = geodesy.geojson_bounds(obj["geojson"])
+    return west <= x0 and south <= y0 and x1 <= east and y1 <= north
+
+
+def osm_object_intersects(obj: dict[str, typing.Any], bounds: list[float]) -> bool:
+    """The bounding box of an OSM object overlaps the bounds."""
+    west, south, east, north = bounds
+    x0, y0, x1, y1 = geodesy.geojson_bounds(obj["geojson"])
+    return x0 <= east and west <= x1 and y0 <= north and south <= y1
+
+
+def sent_areas(bounds: list[float], tile_ids: list[str] | None) -> list[list[float]]:
+    """Areas a diff response covers, the whole of each tile when it has tiles."""
+    if not tile_ids:
+        return [bounds]
+    return [b for tile_id in tile_ids if (b := tile_cache.tile_id_bounds(tile_id))]
+
+
+def wikidata_items_diff(bounds, previous, isa_filter=None) -> dict[str, typing.Any]:
+    """Markers for items that entered the view and QIDs of items that left.
+
+    previous is a list of bounds the client already has items for. When the
+    bounds are cached every item in the covering tiles is sent, not only those
+    in the view, so the client can send the tile IDs back as previous areas.
+    """
+    tile_ids = tile_cache.covering_tile_ids(bounds)
+    rows = get_tiled_marker_rows(bounds, isa_filter) if tile_ids else None
+    if rows is None:
+        rows = item_marker.get_marker_rows(bounds, isa_filter=isa_filter)
+    areas = sent_areas(bounds, tile_ids)
+
+    entered = [
+        row
+        for row in rows
+        if not any(marker_in_bounds(row["detail"], prev) for prev in previous)
+    ]
+    left = {
+        row["detail"]["qid"]
+        for prev in previous
+        for row in get_marker_rows(prev, isa_filter)
+        if not any(marker_in_bounds(row["detail"], area) for area in areas)
     }
 
-    isa_count = []
-    for qid, count in counts:
-        item = isa_items.get(qid)
-        if not item:
-            item = get_and_save_item(qid)
+    in_view = [row for row in rows if marker_in_bounds(row["detail"], bounds)]
+    isa_count = isa_count_labels(
+        count_marker_isa(in_view), limit=isa_facet_limit, download=False
+    )
+    return {
+        "items": marker_details(entered, isa_count),
+        "left": sorted(left),
+        "isa_count": isa_count,
+        "tiles": tile_ids,
+    }
 
-        label = item.label() if item else "[missing]"
-        isa = {
-            "qid": qid,
-            "count": count,
-            "label": label,
-        }
-        isa_count.append(isa)
 
-    return {"items": items, "isa_count": isa_count}
+def get_osm_objects_diff(
+    bounds, previous, isa_filter=None, tolerance=None
+) -> dict[str, typing.Any]:
+    """OSM objects that entered the view and identifiers of objects that left.
+
+    Like wikidata_items_diff the whole of the covering tiles is sent. Objects
+    that are partly outside the previous areas are sent again.
+    """
+    tile_ids = tile_cache.covering_tile_ids(bounds)
+    objects = get_tiled_osm_objects(bounds, isa_filter, tolerance) if tile_ids else None
+    if objects is None:
+        objects = get_osm_with_wikidata_tag(
+            bounds, isa_filter=isa_filter, tolerance=tolerance
+        )
+    areas = sent_areas(bounds, tile_ids)
+
+    left = {
+        obj["identifier"]
+        for prev in previous
+        for obj in get_osm_objects(prev, isa_filter=isa_filter, tolerance=tolerance)
+        if not any(osm_object_intersects(obj, area) for area in areas)
+    }
+    return {
+        "objects": [
+            obj
+            for obj in objects
+            if not any(osm_object_in_bounds(obj, prev) for prev in previous)
+        ],
+        "left": sorted(left),
+        "tiles": tile_ids,
+    }
+
+
+def wikidata_items(bounds, isa_filter=None, cluster=False):
+    """Markers for items within the bounds, read from the item_marker table.
+
+    With cluster set a large bounding box returns grid clusters instead.
+    """
+    return get_viewport(
+        bounds, isa_filter=isa_filter, sections={"isa", "items"}, cluster=cluster
+    )
 
 
 def missing_wikidata_items(qids, lat, lon):
@@ -1152,32 +1537,134 @@ def isa_incremental_search(search_terms: str) -> list[dict[str, str]]:
     ]
 
 
-class PlaceItems(typing.TypedDict):
-    """Place items."""
+# Item fields that can be requested from the place items API.
+place_item_fields = [
+    "item_id",
+    "labels",
+    "descriptions",
+    "aliases",
+    "sitelinks",
+    "claims",
+]
+
+# Default and maximum number of items in a page of place items.
+place_page_size = 100
+max_place_page_size = 1_000
+
+# Rows fetched at a time from the server-side cursor when streaming.
+place_stream_batch_size = 500
+
+
+class PlaceItems(typing.TypedDict, total=False):
+    """Page of place items, the count and facets are only on the first page."""
 
     count: int
     items: list[dict[str, typing.Any]]
+    isa_count: list["item_marker.IsaFacet"]
+    next: int | None  # item_id to continue after
 
 
-def get_place_items(osm_type: str, osm_id: int) -> PlaceItems:
-    """Return place items for given osm_type and osm_id."""
-    src_id = osm_id * {"way": 1, "relation": -1}[osm_type]
+def place_src_id(osm_type: str, osm_id: int) -> int:
+    """Source ID in planet_osm_polygon for a way or relation."""
+    return osm_id * {"way": 1, "relation": -1}[osm_type]
 
-    q = (
-        model.Item.query.join(model.ItemLocation)
+
+def place_item_filter(
+    src_id: int, stats: model.PlaceStats | None
+) -> sqlalchemy.sql.elements.ColumnElement[bool]:
+    """Condition for items within the place, precomputed if available."""
+    if stats:
+        item_ids = place_stats.item_ids_subquery(src_id)
+        return model.Item.item_id == sqlalchemy.any_(item_ids)
+
+    found = (
+        sqlalchemy.select(model.ItemLocation.item_id)
         .join(
             model.Polygon,
             sqlalchemy.func.ST_Covers(model.Polygon.way, model.ItemLocation.location),
         )
-        .filter(model.Polygon.src_id == src_id)
+        .where(model.Polygon.src_id == src_id)
     )
-    # sql = q.statement.compile(compile_kwargs={"literal_binds": True})
+    return model.Item.item_id.in_(found)
 
-    item_count = q.count()
-    items = []
-    for item in q:
-        keys = ["item_id", "labels", "descriptions", "aliases", "sitelinks", "claims"]
-        item_dict = {key: getattr(item, key) for key in keys}
-        items.append(item_dict)
 
-    return {"count": item_count, "items": items}
+def place_items_query(
+    src_id: int,
+    stats: model.PlaceStats | None,
+    after: int | None,
+    fields: list[str],
+) -> sqlalchemy.Select[typing.Any]:
+    """Selected fields of items within the place, in item_id order."""
+    columns = [getattr(model.Item, field) for field in fields]
+    q = (
+        sqlalchemy.select(*columns)
+        .where(place_item_filter(src_id, stats))
+        .order_by(model.Item.item_id)
+    )
+    if after is not None:
+        q = q.where(model.Item.item_id > after)
+    return q
+
+
+def place_fields(fields: list[str] | None) -> list[str]:
+    """Requested fields in a fixed order, always including item_id."""
+    if not fields:
+        return place_item_fields
+    return [f for f in place_item_fields if f == "item_id" or f in fields]
+
+
+def place_summary(
+    stats: model.PlaceStats | place_stats.PlaceSummary,
+) -> tuple[int, list["item_marker.IsaFacet"]]:
+    """Number of items within the place and the instance of (P31) facets."""
+    counts = [(qid, count) for qid, count in stats.isa_count]
+    return stats.item_count, isa_count_labels(counts, isa_facet_limit)
+
+
+def get_place_items(
+    osm_type: str,
+    osm_id: int,
+    after: int | None = None,
+    limit: int = place_page_size,
+    fields: list[str] | None = None,
+) -> PlaceItems:
+    """Return a page of place items for given osm_type and osm_id.
+
+    Pages are in item_id order, pass the next value as after to get the
+    following page. Uses the precomputed statistics for administrative
+    boundaries when they are up to date, otherwise a spatial query.
+    """
+    src_id = place_src_id(osm_type, osm_id)
+    stats = place_stats.get_place(src_id)
+    limit = min(max(limit, 1), max_place_page_size)
+
+    q = place_items_query(src_id, stats, after, place_fields(fields)).limit(limit + 1)
+    items = [dict(row._mapping) for row in database.session.execute(q)]
+    more = len(items) > limit
+    items = items[:limit]
+
+    ret: PlaceItems = {
+        "items": items,
+        "next": items[-1]["item_id"] if more else None,
+    }
+    if after is None:
+        summary = stats or place_stats.live_summary(src_id)
+        ret["count"], ret["isa_count"] = place_summary(summary)
+    return ret
+
+
+def iter_place_items(
+    osm_type: str,
+    osm_id: int,
+    after: int | None = None,
+    fields: list[str] | None = None,
+) -> typing.Iterator[dict[str, typing.Any]]:
+    """Place items one at a time, read with a server-side cursor."""
+    src_id = place_src_id(osm_type, osm_id)
+    stats = place_stats.get_place(src_id)
+    q = place_items_query(src_id, stats, after, place_fields(fields))
+    result = database.session.execute(
+        q.execution_options(stream_results=True, yield_per=place_stream_batch_size)
+    )
+    for row in result:
+        yield dict(row._mapping)
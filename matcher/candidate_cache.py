@@ -0,0 +1,104 @@
+"""Cache of OSM candidate search results."""
+
+import hashlib
+import json
+import typing
+
+import sqlalchemy
+from geoalchemy2.elements import WKTElement
+from sqlalchemy.dialects import postgresql
+
+from . import api, geodesy, model
+from .database import now_utc, session
+
+srid = 4326
+
+
+def get_planet_version() -> int:
+    """Version of the planet data, changes when the OSM data is reloaded."""
+    version = session.query(sqlalchemy.func.max(model.PlanetState.version)).scalar()
+    return typing.cast(int, version or 0)
+
+
+def params_key(
+    search: api.CandidateSearch, knn: bool, tolerance: float | None = None
+) -> str:
+    """Hash of the candidate search parameters."""
+    names = sorted(search["names"]) if search["names"] is not None else None
+    params = [search["max_distance"], search["limit"], names, knn, tolerance]
+    return hashlib.sha1(json.dumps(params).encode("utf-8")).hexdigest()
+
+
+def search_area(item: model.Item, max_distance: int) -> WKTElement:
+    """Area searched for candidates, used to invalidate the cache after edits."""
+    # the fallback search without names uses a radius of 1km
+    distance = max(max_distance, 1_000)
+    polygons = []
+    for loc in item.locations:
+        west, south, east, north = geodesy.envelope_around_point(
+            *loc.get_lat_lon(), distance
+        )
+        ring = [(west, south), (east, south), (east, north), (west, north)]
+        ring.append(ring[0])
+        polygons.append("((" + ", ".join(f"{x} {y}" for x, y in ring) + "))")
+    return WKTElement(f"MULTIPOLYGON({', '.join(polygons)})", srid=srid)
+
+
+def get_candidates(
+    item: model.Item, knn: bool = False, tolerance: float | None = None
+) -> tuple[dict[str, typing.Any], bool]:
+    """OSM candidates for item, from the cache if possible.
+
+    Returns the candidates and a flag that is True for a cache hit.
+    """
+    search = api.candidate_search_params(item)
+    key = params_key(search, knn, tolerance)
+    planet_version = get_planet_version()
+
+    cached = model.CandidateCache.query.get((item.item_id, key))
+    if (
+        cached
+        and cached.lastrevid == item.lastrevid
+        and cached.planet_version == planet_version
+    ):
+        return (cached.result, True)
+
+    result = api.get_candidates(item, knn=knn, tolerance=tolerance)
+
+    table = model.CandidateCache.__table__
+    values = {
+        "item_id": item.item_id,
+        "params": key,
+        "lastrevid": item.lastrevid,
+        "planet_version": planet_version,
+        "area": search_area(item, search["max_distance"]),
+        "result": result,
+        "created": now_utc(),
+    }
+    stmt = postgresql.insert(table).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.item_id, table.c.params], set_=values
+    )
+    session.execute(stmt)
+    session.commit()
+
+    return (result, False)
+
+
+def invalidate_item(item_id: int) -> None:
+    """Remove cached candidates for an item."""
+    model.CandidateCache.query.filter_by(item_id=item_id).delete(
+        synchronize_session=False
+    )
+
+
+def invalidate_osm_object(
+    cls: type[model.Point] | type[model.Line] | type[model.Polygon], src_id: int
+) -> None:
+    """Remove cached candidates for searches that included this OSM object."""
+    # ways and relations can be split over several rows, match any of them
+    rows = sqlalchemy.select(cls.src_id).where(
+        cls.src_id == src_id,
+        sqlalchemy.func.ST_Intersects(model.CandidateCache.area, cls.way),
+    )
+    model.CandidateCache.query.filter(rows.exists()).delete(synchronize_session=False)
@@ -0,0 +1,205 @@
+"""Geodesy and WKB helpers, avoids database round-trips for simple geometry."""
+
+import re
+import struct
+import typing
+
+import numpy as np
+import numpy.typing as npt
+from geoalchemy2.elements import WKBElement, WKTElement
+
+# Same sphere as PostGIS ST_DistanceSphere.
+earth_radius = 6370986.0
+
+re_point = re.compile(r"^(?:SRID=\d+;)?POINT\s*\((\S+) (\S+)\)$")
+
+Coords = npt.NDArray[np.float64]
+
+
+class Components(typing.NamedTuple):
+    """Parts of a geometry grouped by dimension."""
+
+    points: list[Coords]
+    lines: list[Coords]
+    polygons: list[list[Coords]]
+
+
+def destination(
+    lat: float, lon: float, distance: float, bearings: npt.ArrayLike
+) -> tuple[Coords, Coords]:
+    """Points at distance (metres) from lat/lon along each bearing (degrees)."""
+    lat1 = np.radians(lat)
+    lon1 = np.radians(lon)
+    theta = np.radians(np.asarray(bearings, dtype=np.float64))
+    delta = distance / earth_radius
+
+    lat2 = np.arcsin(
+        np.sin(lat1) * np.cos(delta) + np.cos(lat1) * np.sin(delta) * np.cos(theta)
+    )
+    lon2 = lon1 + np.arctan2(
+        np.sin(theta) * np.sin(delta) * np.cos(lat1),
+        np.cos(delta) - np.sin(lat1) * np.sin(lat2),
+    )
+    lon2 = (lon2 + np.pi) % (2 * np.pi) - np.pi
+    return np.degrees(lat2), np.degrees(lon2)
+
+
+def envelope_around_point(
+    lat: float, lon: float, distance: float
+) -> tuple[float, float, float, float]:
+    """Bounds (west, south, east, north) of a box distance metres around a point."""
+    lats, lons = destination(lat, lon, distance, [0, 90, 180, 270])
+    north, east, south, west = (float(v) for v in (lats[0], lons[1], lats[2], lons[3]))
+    return (west, south, east, north)
+
+
+def bbox_centroid(bbox: typing.Sequence[float]) -> tuple[float, float]:
+    """Centre (lat, lon) of bounds given as west, south, east, north."""
+    west, south, east, north = bbox
+    return ((south + north) / 2, (west + east) / 2)
+
+
+def geojson_positions(geojson: dict[str, typing.Any]) -> typing.Iterator[list[float]]:
+    """Every position (lon, lat) in a GeoJSON geometry."""
+    if geojson["type"] == "GeometryCollection":
+        for geom in geojson["geometries"]:
+            yield from geojson_positions(geom)
+        return
+    stack = [geojson["coordinates"]]
+    while stack:
+        coords = stack.pop()
+        if coords and isinstance(coords[0], (int, float)):
+            yield coords
+        else:
+            stack.extend(coords)
+
+
+def geojson_bounds(geojson: dict[str, typing.Any]) -> tuple[float, float, float, float]:
+    """Bounds (west, south, east, north) of a GeoJSON geometry."""
+    lons, lats = zip(*((pos[0], pos[1]) for pos in geojson_positions(geojson)))
+    return (min(lons), min(lats), max(lons), max(lats))
+
+
+class WKBReader:
+    """Read geometry from WKB or PostGIS EWKB."""
+
+    def __init__(self, data: bytes) -> None:
+        """Initialise the reader."""
+        self.data = data
+        self.offset = 0
+
+    def uint32(self, byte_order: str) -> int:
+        """Read an unsigned 32-bit integer."""
+        (value,) = struct.unpack_from(byte_order + "I", self.data, self.offset)
+        self.offset += 4
+        return typing.cast(int, value)
+
+    def coords(self, byte_order: str, count: int, dims: int) -> Coords:
+        """Read count coordinates, return an array of x, y."""
+        dtype = np.dtype(np.float64).newbyteorder(byte_order)
+        values = np.frombuffer(
+            self.data, dtype=dtype, count=count * dims, offset=self.offset
+        )
+        self.offset += count * dims * 8
+        return values.reshape(count, dims)[:, :2].astype(np.float64)
+
+    def geometry(self, found: Components) -> None:
+        """Read one geometry, adding the parts to found."""
+        byte_order = ">" if self.data[self.offset] == 0 else "<"
+        self.offset += 1
+        geom_type = self.uint32(byte_order)
+
+        dims = 2
+        if geom_type & 0x80000000:  # EWKB Z
+            dims += 1
+        if geom_type & 0x40000000:  # EWKB M
+            dims += 1
+        if geom_type & 0x20000000:  # EWKB SRID
+            self.offset += 4
+        geom_type &= 0x0FFFFFFF
+        iso_dims, geom_type = divmod(geom_type, 1000)  # ISO WKB Z, M and ZM
+        dims += {0: 0, 1: 1, 2: 1, 3: 2}[iso_dims]
+
+        if geom_type == 1:
+            found.points.append(self.coords(byte_order, 1, dims))
+        elif geom_type == 2:
+            found.lines.append(self.coords(byte_order, self.uint32(byte_order), dims))
+        elif geom_type == 3:
+            rings = [
+                self.coords(byte_order, self.uint32(byte_order), dims)
+                for _ in range(self.uint32(byte_order))
+            ]
+            found.polygons.append(rings)
+        elif geom_type in (4, 5, 6, 7):  # multi-geometries and collections
+            for _ in range(self.uint32(byte_order)):
+                self.geometry(found)
+        else:
+            raise ValueError(f"unsupported WKB geometry type: {geom_type}")
+
+
+def wkb_to_bytes(data: bytes | memoryview | str) -> bytes:
+    """WKB as bytes, PostGIS returns hex encoded strings."""
+    if isinstance(data, str):
+        return bytes.fromhex(data)
+    return bytes(data)
+
+
+def read_wkb(data: bytes | memoryview | str) -> Components:
+    """Parse WKB into points, lines and polygons."""
+    found = Components([], [], [])
+    WKBReader(wkb_to_bytes(data)).geometry(found)
+    return found
+
+
+def ring_area_centroid(ring: Coords) -> tuple[float, Coords]:
+    """Absolute area and centroid of a closed ring."""
+    x, y = ring[:, 0], ring[:, 1]
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = cross.sum() / 2
+    if area == 0:
+        return 0.0, ring.mean(axis=0)
+    cx = ((x[:-1] + x[1:]) * cross).sum() / (6 * area)
+    cy = ((y[:-1] + y[1:]) * cross).sum() / (6 * area)
+    return abs(float(area)), np.array([cx, cy])
+
+
+def centroid(geom: Components) -> tuple[float, float]:
+    """Planar centroid (x, y), matching ST_Centroid on geometry."""
+    weights: list[float] = []
+    centres: list[Coords] = []
+
+    for rings in geom.polygons:
+        for num, ring in enumerate(rings):
+            area, ring_centre = ring_area_centroid(ring)
+            weights.append(area if num == 0 else -area)  # holes are subtracted
+            centres.append(ring_centre)
+    if weights and sum(weights) > 0:
+        xy = np.average(np.array(centres), axis=0, weights=weights)
+        return (float(xy[0]), float(xy[1]))
+
+    lines = geom.lines + [ring for rings in geom.polygons for ring in rings]
+    if lines:
+        segments = np.concatenate(
+            [np.stack([line[:-1], line[1:]], 1) for line in lines]
+        )
+        lengths = np.hypot(*(segments[:, 1] - segments[:, 0]).T)
+        if lengths.sum() > 0:
+            xy = np.average(segments.mean(axis=1), axis=0, weights=lengths)
+            return (float(xy[0]), float(xy[1]))
+
+    points = np.concatenate(geom.points + lines)
+    xy = points.mean(axis=0)
+    return (float(xy[0]), float(xy[1]))
+
+
+def point_lat_lon(location: str | WKTElement | WKBElement) -> tuple[float, float]:
+    """Latitude and longitude of a point from the database or from WKT."""
+    if isinstance(location, WKBElement):
+        lon, lat = read_wkb(location.data).points[0][0]
+        return (float(lat), float(lon))
+
+    wkt = location.data if isinstance(location, WKTElement) else location
+    m = re_point.match(wkt)
+    assert m
+    lon, lat = m.groups()
+    return (float(lat), float(lon))
@@ -0,0 +1,206 @@
+"""Item counts in a multi-resolution tile grid, for counts over large areas.
+
+Each item is counted in the cell that contains the centroid of its locations.
+Counts for bounds add up the cells that are entirely inside the bounds and
+count the items in the remaining strips along the edges exactly.
+"""
+
+import collections
+import math
+import typing
+
+import sqlalchemy
+
+from . import model, tiles
+from .database import session
+
+# Zoom levels of the grid, from coarse to fine.
+grid_zooms = [4, 6, 8, 10, 12]
+
+# Use the finest zoom level with no more than this many cells inside the bounds.
+max_cells = 1024
+
+cells_sql = """
+SELECT zoom, x, y, isa_id, count(DISTINCT item_id) AS count
+FROM (
+    SELECT m.item_id, zoom,
+        least(floor((ST_X(c.centroid) + 180) / 360 * 2 ^ zoom), 2 ^ zoom - 1)::int
+            AS x,
+        least(floor((1 - asinh(tan(radians(
+            greatest(least(ST_Y(c.centroid), 85.0511), -85.0511)
+        ))) / pi()) / 2 * 2 ^ zoom), 2 ^ zoom - 1)::int AS y,
+        unnest(array_append(m.isa_ids, 0)) AS isa_id
+    FROM item_marker m
+    CROSS JOIN LATERAL (SELECT ST_Centroid(m.location) AS centroid) AS c
+    CROSS JOIN unnest(CAST(:zooms AS integer[])) AS zoom
+    WHERE {item_filter}
+) AS cells
+GROUP BY zoom, x, y, isa_id
+"""
+
+apply_sql = f"""
+INSERT INTO item_grid (zoom, x, y, isa_id, count)
+SELECT zoom, x, y, isa_id, :sign * count FROM ({cells_sql}) AS changes
+ON CONFLICT (zoom, x, y, isa_id) DO UPDATE SET count = item_grid.count + excluded.count
+"""
+
+
+class Interior(typing.NamedTuple):
+    """Range of grid cells inside some bounds."""
+
+    zoom: int
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+
+
+def apply_items(item_ids: typing.Collection[int], sign: int) -> None:
+    """Add (sign 1) or remove (sign -1) items, using their current item_marker rows."""
+    if not item_ids:
+        return
+    sql = apply_sql.format(item_filter="m.item_id = ANY(:item_ids)")
+    params = {"item_ids": list(item_ids), "zooms": grid_zooms, "sign": sign}
+    session.execute(sqlalchemy.text(sql), params)
+    session.execute(sqlalchemy.text("DELETE FROM item_grid WHERE count <= 0"))
+
+
+def add_items(item_ids: typing.Collection[int]) -> None:
+    """Count items after their markers are created."""
+    apply_items(item_ids, 1)
+
+
+def remove_items(item_ids: typing.Collection[int]) -> None:
+    """Stop counting items before their markers are removed."""
+    apply_items(item_ids, -1)
+
+
+def rebuild() -> None:
+    """Rebuild the grid from item_marker."""
+    session.execute(sqlalchemy.text("TRUNCATE item_grid"))
+    sql = apply_sql.format(item_filter="true")
+    session.execute(sqlalchemy.text(sql), {"zooms": grid_zooms, "sign": 1})
+    session.commit()
+
+
+def find_interior(bounds: list[float]) -> Interior | None:
+    """Cells at the finest usable zoom level that are entirely inside the bounds."""
+    west, south, east, north = bounds
+    for zoom in reversed(grid_zooms):
+        left, top = tiles.tile_position(north, west, zoom)
+        right, bottom = tiles.tile_position(south, east, zoom)
+        x0, y0 = math.ceil(left), math.ceil(top)
+        x1, y1 = math.floor(right) - 1, math.floor(bottom) - 1
+        if x1 < x0 or y1 < y0:
+            return None  # coarser cells are bigger, so they won't fit either
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= max_cells:
+            return Interior(zoom, x0, y0, x1, y1)
+    return None
+
+
+def edge_strips(bounds: list[float], interior: Interior) -> list[list[float]]:
+    """Parts of the bounds outside the interior cells, as non-overlapping bounds."""
+    west, south, east, north = bounds
+    inner_west, inner_south, _, _ = tiles.tile_bounds(
+        interior.zoom, interior.x0, interior.y1
+    )
+    _, _, inner_east, inner_north = tiles.tile_bounds(
+        interior.zoom, interior.x1, interior.y0
+    )
+    strips = [
+        [west, south, inner_west, north],
+        [inner_east, south, east, north],
+        [inner_west, south, inner_east, inner_south],
+        [inner_west, inner_north, inner_east, north],
+    ]
+    return [s for s in strips if s[0] < s[2] and s[1] < s[3]]
+
+
+def in_strips(
+    strips: list[list[float]],
+) -> sqlalchemy.sql.elements.ColumnElement[bool]:
+    """Condition for markers with a centroid inside one of the strips."""
+    centroid = sqlalchemy.func.ST_Centroid(model.ItemMarker.location)
+    lon, lat = sqlalchemy.func.ST_X(centroid), sqlalchemy.func.ST_Y(centroid)
+    return sqlalchemy.or_(
+        *[
+            sqlalchemy.and_(
+                sqlalchemy.func.ST_Intersects(
+                    sqlalchemy.func.ST_MakeEnvelope(*strip, 4326),
+                    model.ItemMarker.location,
+                ),
+                lon >= strip[0],
+                lat >= strip[1],
+                lon < strip[2],
+                lat < strip[3],
+            )
+            for strip in strips
+        ]
+    )
+
+
+def in_interior(
+    interior: Interior,
+) -> list[sqlalchemy.sql.elements.ColumnElement[bool]]:
+    """Conditions for grid cells in the interior."""
+    return [
+        model.ItemGrid.zoom == interior.zoom,
+        model.ItemGrid.x.between(interior.x0, interior.x1),
+        model.ItemGrid.y.between(interior.y0, interior.y1),
+    ]
+
+
+def get_count(bounds: list[float]) -> int | None:
+    """Number of items in the bounds, None if the bounds are too small for the grid."""
+    interior = find_interior(bounds)
+    if not interior:
+        return None
+
+    grid_q = sqlalchemy.select(sqlalchemy.func.sum(model.ItemGrid.count)).where(
+        *in_interior(interior), model.ItemGrid.isa_id == 0
+    )
+    total = session.execute(grid_q).scalar() or 0
+
+    strips = edge_strips(bounds, interior)
+    if strips:
+        strip_q = sqlalchemy.select(sqlalchemy.func.count()).where(in_strips(strips))
+        total += session.execute(strip_q).scalar() or 0
+
+    return int(total)
+
+
+def get_isa_counts(bounds: list[float]) -> list[tuple[str, int]] | None:
+    """Instance of (P31) counts for the bounds, most common first.
+
+    Returns None if the bounds are too small for the grid.
+    """
+    interior = find_interior(bounds)
+    if not interior:
+        return None
+
+    counts: collections.Counter[str] = collections.Counter()
+    grid_q = (
+        sqlalchemy.select(
+            model.ItemGrid.isa_id, sqlalchemy.func.sum(model.ItemGrid.count)
+        )
+        .where(*in_interior(interior), model.ItemGrid.isa_id != 0)
+        .group_by(model.ItemGrid.isa_id)
+    )
+    for isa_id, num in session.execute(grid_q):
+        counts[f"Q{isa_id}"] += int(num)
+
+    strips = edge_strips(bounds, interior)
+    if strips:
+        isa_id = sqlalchemy.func.unnest(model.ItemMarker.isa_ids).label("isa_id")
+        found = (
+            sqlalchemy.select(model.ItemMarker.item_id, isa_id)
+            .where(in_strips(strips))
+            .subquery()
+        )
+        strip_q = sqlalchemy.select(
+            found.c.isa_id, sqlalchemy.func.count(found.c.item_id.distinct())
+        ).group_by(found.c.isa_id)
+        for strip_isa_id, num in session.execute(strip_q):
+            counts[f"Q{strip_isa_id}"] += num
+
+    return counts.most_common()
@@ -0,0 +1,94 @@
+"""Transitive closure of instance of (P31) and subclass of (P279) for items."""
+
+import typing
+
+import sqlalchemy
+
+from . import model, tile_cache
+from .database import session
+
+# Guard against cycles in the subclass graph.
+max_depth = 20
+
+closure_sql = """
+WITH RECURSIVE isa(item_id, ancestor_id, depth) AS (
+    SELECT item.item_id, (isa_id #>> '{{}}')::int, 1
+    FROM item,
+        jsonb_path_query(item.claims, '$.P31[*].mainsnak.datavalue.value."numeric-id"')
+            AS isa_id
+    WHERE {item_filter}
+UNION
+    SELECT isa.item_id, (parent_id #>> '{{}}')::int, isa.depth + 1
+    FROM isa
+    JOIN item ON item.item_id = isa.ancestor_id,
+        jsonb_path_query(item.claims, '$.P279[*].mainsnak.datavalue.value."numeric-id"')
+            AS parent_id
+    WHERE isa.depth < :max_depth
+)
+INSERT INTO item_isa (item_id, ancestor_id, depth)
+SELECT item_id, ancestor_id, min(depth) FROM isa GROUP BY item_id, ancestor_id
+"""
+
+
+def delete_items(item_ids: typing.Collection[int]) -> None:
+    """Remove closure rows for the given items."""
+    session.query(model.ItemIsA).filter(
+        model.ItemIsA.item_id.in_(list(item_ids))
+    ).delete(synchronize_session=False)
+
+
+def update_items(item_ids: typing.Collection[int]) -> None:
+    """Recalculate closure rows for the given items."""
+    if not item_ids:
+        return
+    delete_items(item_ids)
+    sql = closure_sql.format(item_filter="item.item_id = ANY(:item_ids)")
+    session.execute(
+        sqlalchemy.text(sql), {"item_ids": list(item_ids), "max_depth": max_depth}
+    )
+
+
+def get_descendants(isa_id: int) -> list[int]:
+    """Items that are an instance of the given type or one of its subclasses."""
+    q = session.query(model.ItemIsA.item_id).filter(model.ItemIsA.ancestor_id == isa_id)
+    return [item_id for item_id, in q]
+
+
+def update_descendants(isa_id: int) -> None:
+    """Recalculate closure rows after the subclass claims of a type changed.
+
+    Cached tiles filtered by type are out of date where the items are.
+    """
+    item_ids = get_descendants(isa_id)
+    update_items(item_ids)
+    tile_cache.invalidate_items(item_ids)
+
+
+def rebuild() -> None:
+    """Rebuild the closure for every item with a location.
+
+    The table is dropped and created again, this also moves it from the old
+    layout with an isa_id column to ancestor_id and depth.
+    """
+    table = model.ItemIsA.__table__
+    table.drop(session.connection(), checkfirst=True)
+    table.create(session.connection())
+    item_filter = "item.item_id IN (SELECT item_id FROM item_location)"
+    sql = closure_sql.format(item_filter=item_filter)
+    session.execute(sqlalchemy.text(sql), {"max_depth": max_depth})
+    session.commit()
+
+
+def isa_filter_ids(isa_qids: typing.Iterable[str]) -> list[int]:
+    """Convert a set of QIDs from the isa parameter into item IDs."""
+    return [int(qid[1:]) for qid in isa_qids if qid[:1] == "Q" and qid[1:].isdigit()]
+
+
+def filter_items(
+    item_id: sqlalchemy.sql.elements.ColumnElement[int], isa_qids: typing.Iterable[str]
+) -> sqlalchemy.sql.elements.ColumnElement[bool]:
+    """Condition for items that are an instance of any of the given types."""
+    subclass_of = sqlalchemy.select(model.ItemIsA.item_id).where(
+        model.ItemIsA.ancestor_id.in_(isa_filter_ids(isa_qids))
+    )
+    return item_id.in_(subclass_of)
@@ -0,0 +1,230 @@
+"""Denormalised copy of items with coordinates, for viewport queries."""
+
+import typing
+
+import sqlalchemy
+from geoalchemy2.elements import WKTElement
+from sqlalchemy.dialects import postgresql
+
+from . import api, item_grid, item_isa, model
+from .database import session
+
+srid = 4326
+
+# Width of the viewport in grid cells when items are clustered.
+cluster_grid_cells = 32
+
+
+class Cluster(typing.TypedDict, total=False):
+    """Items grouped into a grid cell."""
+
+    count: int
+    centroid: list[float]  # lat, lon
+    bounds: list[float]  # west, south, east, north
+    isa: str | None  # most common instance of (P31)
+    isa_label: str
+
+
+class MarkerRow(typing.TypedDict):
+    """Marker detail with the instance of (P31) item IDs, used for counts."""
+
+    detail: "api.ItemDetailType"
+    isa_ids: list[int]
+
+
+def location_wkt(item: model.Item) -> WKTElement:
+    """Locations of an item as a multipoint."""
+    points = ", ".join(
+        f"({lon} {lat})" for lat, lon in (loc.get_lat_lon() for loc in item.locations)
+    )
+    return WKTElement(f"MULTIPOINT({points})", srid=srid)
+
+
+def stored_item(item_id: int) -> model.Item | None:
+    """Item from the database, None if it hasn't been downloaded."""
+    return typing.cast(model.Item | None, model.Item.query.get(item_id))
+
+
+def address_number_first(item: model.Item) -> bool:
+    """Address format for the item, the country is only found if it is needed."""
+    if not item.locations or not api.has_numbered_street(item):
+        return True
+    lat, lon = item.locations[0].get_lat_lon()
+    return bool(api.alpha2_number_first & api.country_codes(lat, lon))
+
+
+def marker_values(item: model.Item, street_number_first: bool) -> dict[str, typing.Any]:
+    """Column values for the marker of an item.
+
+    Related items missing from the database are left out of the detail.
+    """
+    isa_ids = [isa["numeric-id"] for isa in item.get_claim("P31") if isa]
+    images = item.get_claim("P18")
+    return {
+        "item_id": item.item_id,
+        "location": location_wkt(item),
+        "label": item.label(),
+        "description": item.description(),
+        "isa_ids": isa_ids,
+        "image": images[0] if images else None,
+        "closed": bool(item.closed()),
+        "identifiers": item.get_identifiers(),
+        "detail": api.build_item_detail(item, street_number_first, stored_item),
+    }
+
+
+def delete_items(item_ids: typing.Collection[int]) -> None:
+    """Remove markers for the given items."""
+    item_grid.remove_items(item_ids)
+    session.query(model.ItemMarker).filter(
+        model.ItemMarker.item_id.in_(list(item_ids))
+    ).delete(synchronize_session=False)
+
+
+def update_items(item_ids: typing.Collection[int]) -> None:
+    """Recreate markers for the given items."""
+    if not item_ids:
+        return
+    delete_items(item_ids)
+    items = model.Item.query.filter(model.Item.item_id.in_(list(item_ids)))
+    rows = [
+        marker_values(item, address_number_first(item))
+        for item in items
+        if item.locations
+    ]
+    if rows:
+        session.execute(postgresql.insert(model.ItemMarker.__table__), rows)
+        item_grid.add_items([row["item_id"] for row in rows])
+
+
+def rebuild(batch_size: int = 1_000) -> None:
+    """Rebuild markers, and the item grid, for every item with a location."""
+    session.execute(sqlalchemy.text("TRUNCATE item_marker, item_grid"))
+    q = (
+        sqlalchemy.select(model.ItemLocation.item_id)
+        .distinct()
+        .order_by(model.ItemLocation.item_id)
+    )
+    item_ids = session.execute(q).scalars().all()
+    for start in range(0, len(item_ids), batch_size):
+        update_items(item_ids[start : start + batch_size])
+        session.commit()
+
+
+def in_bounds(
+    bounds: list[float], isa_filter: typing.Iterable[str] | None = None
+) -> list[sqlalchemy.sql.elements.ColumnElement[bool]]:
+    """Conditions for markers within the bounds, optionally of the given types."""
+    envelope = api.make_envelope(bounds)
+    conditions = [sqlalchemy.func.ST_Intersects(envelope, model.ItemMarker.location)]
+    if isa_filter:
+        conditions.append(item_isa.filter_items(model.ItemMarker.item_id, isa_filter))
+    return conditions
+
+
+def get_marker_rows(
+    bounds: list[float], isa_filter: typing.Iterable[str] | None = None
+) -> list[MarkerRow]:
+    """Marker details and instance of IDs for items within the bounds."""
+    q = sqlalchemy.select(model.ItemMarker.detail, model.ItemMarker.isa_ids).where(
+        *in_bounds(bounds, isa_filter)
+    )
+    return [
+        {"detail": detail, "isa_ids": isa_ids} for detail, isa_ids in session.execute(q)
+    ]
+
+
+def get_count(
+    bounds: list[float], isa_filter: typing.Iterable[str] | None = None
+) -> int:
+    """Number of items within the bounds."""
+    q = sqlalchemy.select(sqlalchemy.func.count()).where(*in_bounds(bounds, isa_filter))
+    return typing.cast(int, session.execute(q).scalar())
+
+
+class IsaFacet(typing.TypedDict):
+    """Number of items of an instance of (P31) type, label is None if unknown."""
+
+    qid: str
+    count: int
+    label: str | None
+
+
+def item_label(
+    labels: sqlalchemy.sql.elements.ColumnElement[typing.Any],
+) -> sqlalchemy.sql.elements.ColumnElement[str]:
+    """English label of an item in SQL, otherwise the first label, like Item.label."""
+    first_label = sqlalchemy.func.jsonb_path_query_first(labels, "$.*.value")
+    return sqlalchemy.func.coalesce(
+        labels["en"]["value"].astext, first_label.op("#>>")("{}"), "[no label]"
+    )
+
+
+def get_isa_facets(
+    bounds: list[float],
+    isa_filter: typing.Iterable[str] | None = None,
+    limit: int | None = None,
+) -> list[IsaFacet]:
+    """Most common instance of (P31) types for items in the bounds, with labels."""
+    isa_id = sqlalchemy.func.unnest(model.ItemMarker.isa_ids).label("isa_id")
+    found = sqlalchemy.select(isa_id).where(*in_bounds(bounds, isa_filter)).subquery()
+    count = sqlalchemy.func.count().label("count")
+    counts = (
+        sqlalchemy.select(found.c.isa_id, count)
+        .group_by(found.c.isa_id)
+        .order_by(count.desc(), found.c.isa_id)
+        .limit(limit)
+        .subquery()
+    )
+    q = (
+        sqlalchemy.select(
+            counts.c.isa_id,
+            counts.c.count,
+            model.Item.item_id,
+            item_label(model.Item.labels),
+        )
+        .outerjoin(model.Item, model.Item.item_id == counts.c.isa_id)
+        .order_by(counts.c.count.desc(), counts.c.isa_id)
+    )
+    # label is None for item types missing from the item table
+    return [
+        {"qid": f"Q{isa_id}", "count": num, "label": label if item_id else None}
+        for isa_id, num, item_id, label in session.execute(q)
+    ]
+
+
+def get_clusters(
+    bounds: list[float], isa_filter: typing.Iterable[str] | None = None
+) -> list[Cluster]:
+    """Items within the bounds grouped into grid cells."""
+    west, south, east, north = bounds
+    size = max(east - west, north - south) / cluster_grid_cells
+
+    centre = sqlalchemy.func.ST_Centroid(model.ItemMarker.location)
+    cell = sqlalchemy.func.ST_SnapToGrid(centre, size)
+    top_isa = sqlalchemy.func.mode().within_group(model.ItemMarker.isa_ids[1])
+    q = (
+        sqlalchemy.select(
+            sqlalchemy.func.ST_X(cell),
+            sqlalchemy.func.ST_Y(cell),
+            sqlalchemy.func.count(),
+            sqlalchemy.func.avg(sqlalchemy.func.ST_Y(centre)),
+            sqlalchemy.func.avg(sqlalchemy.func.ST_X(centre)),
+            top_isa,
+        )
+        .where(*in_bounds(bounds, isa_filter))
+        .group_by(cell)
+    )
+
+    clusters: list[Cluster] = []
+    for x, y, count, lat, lon, isa_id in session.execute(q):
+        half = size / 2
+        clusters.append(
+            {
+                "count": count,
+                "centroid": [lat, lon],
+                "bounds": [x - half, y - half, x + half, y + half],
+                "isa": f"Q{isa_id}" if isa_id else None,
+            }
+        )
+    return clusters
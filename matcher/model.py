@@ -25,10 +25,10 @@ from sqlalchemy.orm import (
 )
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm.decl_api import DeclarativeMeta
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.schema import Column, ForeignKey, Index
 from sqlalchemy.types import BigInteger, Boolean, DateTime, Float, Integer, String, Text
 
-from . import mail, utils, wikidata, wikidata_api
+from . import geodesy, mail, utils, wikidata, wikidata_api
 from .database import now_utc, session
 
 mapper_registry = registry()
@@ -51,8 +51,6 @@ class Base(metaclass=DeclarativeMeta):
     __init__ = mapper_registry.constructor
 
 
-re_point = re.compile(r"^POINT\((.+) (.+)\)$")
-
 osm_type_enum = postgresql.ENUM(
     "node", "way", "relation", name="osm_type_enum", metadata=Base.metadata
 )
@@ -432,14 +430,20 @@ class Item(Base):
 
 
 class ItemIsA(Base):
-    """Item IsA."""
+    """Item IsA, transitive closure of instance of (P31) and subclass of (P279).
+
+    Depth 1 is a direct instance of (P31) statement, each subclass of (P279) step
+    adds one. The ancestor might not be in the local mirror.
+    """
 
     __tablename__ = "item_isa"
     item_id = Column(Integer, ForeignKey("item.item_id"), primary_key=True)
-    isa_id = Column(Integer, ForeignKey("item.item_id"), primary_key=True)
+    ancestor_id = Column(Integer, primary_key=True)
+    depth = Column(Integer, nullable=False)
 
     item: Mapped[Item] = relationship("Item", foreign_keys=[item_id])
-    isa: Mapped[Item] = relationship("Item", foreign_keys=[isa_id])
+
+    __table_args__ = (Index("item_isa_ancestor_idx", ancestor_id, item_id),)
 
 
 class ItemLocation(Base):
@@ -456,9 +460,7 @@ class ItemLocation(Base):
 
     def get_lat_lon(self) -> tuple[float, float]:
         """Get latitude and longitude of item."""
-        loc: tuple[float, float]
-        loc = session.query(func.ST_Y(self.location), func.ST_X(self.location)).one()
-        return loc
+        return geodesy.point_lat_lon(self.location)
 
 
 def location_objects(
@@ -537,11 +539,8 @@ class MapMixin:
 
     def get_centroid(self) -> tuple[float, float]:
         """Centroid."""
-        centroid = session.query(func.ST_AsText(func.ST_Centroid(self.way))).scalar()
-        assert centroid
-        assert (m := re_point.match(centroid))
-        lon, lat = m.groups()
-        return (float(lat), float(lon))
+        lon, lat = geodesy.centroid(geodesy.read_wkb(self.way.data))
+        return (lat, lon)
 
     @classmethod
     def coords_within(cls, lat: float, lon: float):
@@ -618,6 +617,28 @@ class Polygon(MapMixin, Base):
         return area / (1000 * 1000)
 
 
+class SimplifiedGeometry(Base):
+    """Precomputed simplified geometry for a large OSM line or polygon."""
+
+    __tablename__ = "simplified_geometry"
+    tbl = Column(String, primary_key=True)  # line or polygon
+    osm_id = Column(BigInteger, primary_key=True)
+    tolerance = Column(Float, primary_key=True)
+    way = Column(Geometry("GEOMETRY", srid=4326), nullable=False)
+
+
+class TileInvalidation(Base):
+    """Area where data changed, cached tiles that overlap it are discarded."""
+
+    __tablename__ = "tile_invalidation"
+    id = Column(Integer, primary_key=True)
+    west = Column(Float, nullable=False)
+    south = Column(Float, nullable=False)
+    east = Column(Float, nullable=False)
+    north = Column(Float, nullable=False)
+    created = Column(DateTime, default=now_utc())
+
+
 class User(Base, UserMixin):
     """User."""
 
@@ -714,6 +735,118 @@ class SkipIsA(Base):
     item: Mapped[Item] = relationship("Item")
 
 
+class IsATags(Base):
+    """OSM tags/keys reachable from an item type by walking the item hierarchy."""
+
+    __tablename__ = "isa_tags"
+    item_id = Column(Integer, ForeignKey("item.item_id"), primary_key=True)
+    tags = Column(postgresql.JSONB, nullable=False)  # tag_or_key -> list of IsA paths
+    # walk that doesn't go via building (Q41176), null when building isn't reached
+    tags_no_building = Column(postgresql.JSONB)
+    checked = Column(postgresql.JSONB, nullable=False)
+    members = Column(postgresql.ARRAY(Integer), nullable=False)
+
+    __table_args__ = (Index("isa_tags_members_idx", members, postgresql_using="gin"),)
+
+
+class ItemMarker(Base):
+    """Compact copy of an item with coordinates, used to draw map markers."""
+
+    __tablename__ = "item_marker"
+    item_id = Column(Integer, ForeignKey("item.item_id"), primary_key=True)
+    location = Column(
+        Geometry("MULTIPOINT", srid=4326, spatial_index=True), nullable=False
+    )
+    label = Column(String)
+    description = Column(String)
+    isa_ids = Column(postgresql.ARRAY(Integer), nullable=False)  # instance of (P31)
+    image = Column(String)
+    closed = Column(Boolean, nullable=False)
+    identifiers = Column(postgresql.JSONB, nullable=False)
+    detail = Column(postgresql.JSONB, nullable=False)  # marker for the frontend
+
+    qid = column_property("Q" + cast_to_string(item_id))
+
+    __table_args__ = (
+        Index("item_marker_isa_ids_idx", isa_ids, postgresql_using="gin"),
+    )
+
+
+class ItemGrid(Base):
+    """Number of items in a tile grid cell, by instance of (P31) type."""
+
+    __tablename__ = "item_grid"
+    zoom = Column(Integer, primary_key=True)
+    x = Column(Integer, primary_key=True)
+    y = Column(Integer, primary_key=True)
+    isa_id = Column(Integer, primary_key=True)  # 0 for all items
+    count = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("item_grid_empty_idx", count, postgresql_where=count <= 0),)
+
+
+class OsmWikidata(Base):
+    """Wikidata tag of an object in the planet tables, for lookups by QID."""
+
+    __tablename__ = "osm_wikidata"
+    tbl = Column(String, primary_key=True)  # point, line or polygon
+    osm_id = Column(BigInteger, primary_key=True)
+    qid = Column(String, nullable=False, index=True)  # value of the wikidata tag
+    centroid = Column(Geometry("POINT", srid=4326, spatial_index=True), nullable=False)
+
+    @property
+    def osm_type(self) -> str:
+        """OSM type of the object: node, way or relation."""
+        if self.tbl == "point":
+            return "node"
+        return "way" if self.osm_id > 0 else "relation"
+
+    @property
+    def identifier(self) -> str:
+        """OSM type and ID, for example way/1234."""
+        return f"{self.osm_type}/{abs(self.osm_id)}"
+
+
+class OsmGeometry(Base):
+    """Line or polygon from the planet tables, one row per OSM object.
+
+    osm2pgsql can split a way or relation over several rows, here they are
+    collected into a single geometry.
+    """
+
+    __tablename__ = "osm_geometry"
+    tbl = Column(String, primary_key=True)  # line or polygon
+    osm_id = Column(BigInteger, primary_key=True)
+    tags = Column(postgresql.HSTORE, nullable=False)
+    way = Column(Geometry("GEOMETRY", srid=4326, spatial_index=True), nullable=False)
+    centroid = Column(Geometry("POINT", srid=4326), nullable=False)
+    area = Column(Float, nullable=False)  # square degrees, like ST_Area(way)
+
+    __table_args__ = (
+        Index(
+            "osm_geometry_wikidata_idx",
+            way,
+            postgresql_using="gist",
+            postgresql_where=tags.has_key("wikidata"),
+        ),
+    )
+
+
+class PlaceStats(Base):
+    """Precomputed items within an administrative boundary polygon."""
+
+    __tablename__ = "place_stats"
+    src_id = Column(BigInteger, primary_key=True)  # osm_id in planet_osm_polygon
+    admin_level = Column(Integer, nullable=False)
+    item_count = Column(Integer, nullable=False)
+    item_ids = Column(postgresql.ARRAY(Integer), nullable=False)
+    isa_count = Column(postgresql.JSONB, nullable=False)  # [[qid, count], ...]
+    dirty = Column(Boolean, nullable=False, default=False)  # items changed since
+    updated = Column(DateTime, default=now_utc(), nullable=False)
+
+    __table_args__ = (Index("place_stats_dirty_idx", src_id, postgresql_where=dirty),)
+
+
 class ItemExtraKeys(Base):
     """Extra tag or key to consider for an Wikidata item type."""
 
@@ -726,6 +859,30 @@ class ItemExtraKeys(Base):
     item: Mapped[Item] = relationship("Item")
 
 
+class PlanetState(Base):
+    """State of the local copy of the OSM planet."""
+
+    __tablename__ = "planet_state"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)  # bumped on data reload
+    sequence = Column(Integer)  # last replication diff applied
+    updated = Column(DateTime)
+
+
+class CandidateCache(Base):
+    """Cached OSM candidate search results for a Wikidata item."""
+
+    __tablename__ = "candidate_cache"
+
+    item_id = Column(Integer, ForeignKey("item.item_id"), primary_key=True)
+    params = Column(String, primary_key=True)  # hash of the search parameters
+    lastrevid = Column(Integer, nullable=False)
+    planet_version = Column(Integer, nullable=False)
+    area = Column(Geometry("GEOMETRY", srid=4326, spatial_index=True), nullable=False)
+    result = Column(postgresql.JSONB, nullable=False)
+    created = Column(DateTime, default=now_utc(), nullable=False)
+
+
 class Extract(Base):
     """First paragraph from Wikipedia."""
 
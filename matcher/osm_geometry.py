@@ -0,0 +1,58 @@
+"""Lines and polygons from the planet tables with one row per OSM object.
+
+Saves collecting the rows of split ways and relations, and computing the
+centroid and area of the result, on every request.
+"""
+
+import typing
+
+import sqlalchemy
+
+from . import osm_wikidata
+from .database import session
+
+tables = ["line", "polygon"]
+
+select_sql = """
+SELECT '{tbl}', osm_id, tags, way, ST_Centroid(way), ST_Area(way)
+FROM (
+    SELECT osm_id, (array_agg(tags))[1] AS tags, ST_Collect(way) AS way
+    FROM planet_osm_{tbl}
+    WHERE {osm_filter}
+    GROUP BY osm_id
+) AS collected
+"""
+
+insert_sql = """
+INSERT INTO osm_geometry (tbl, osm_id, tags, way, centroid, area)
+{select}
+"""
+
+
+def rebuild() -> None:
+    """Rebuild the table from the planet tables."""
+    session.execute(sqlalchemy.text("TRUNCATE osm_geometry"))
+    for tbl in tables:
+        select = select_sql.format(tbl=tbl, osm_filter="true")
+        session.execute(sqlalchemy.text(insert_sql.format(select=select)))
+        session.commit()
+
+
+def update_objects(tbl: str, osm_ids: typing.Collection[int]) -> None:
+    """Refresh objects after their planet rows changed."""
+    if tbl not in tables or not osm_ids:
+        return
+    params = {"tbl": tbl, "osm_ids": list(osm_ids)}
+    session.execute(
+        sqlalchemy.text(
+            "DELETE FROM osm_geometry WHERE tbl = :tbl AND osm_id = ANY(:osm_ids)"
+        ),
+        params,
+    )
+    select = select_sql.format(tbl=tbl, osm_filter="osm_id = ANY(:osm_ids)")
+    session.execute(sqlalchemy.text(insert_sql.format(select=select)), params)
+
+
+def update_object(cls: osm_wikidata.PlanetClass, src_id: int) -> None:
+    """Refresh an object after its tags were edited."""
+    update_objects(osm_wikidata.table_name(cls), [src_id])
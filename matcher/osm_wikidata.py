@@ -0,0 +1,93 @@
+"""Index of wikidata tags in the planet tables, from QID to OSM object.
+
+Ways and relations can be split over several rows in planet_osm_line and
+planet_osm_polygon, the index has one row per object.
+"""
+
+import typing
+
+import sqlalchemy
+
+from . import model, planet
+from .database import session
+
+PlanetClass = type[model.Point] | type[model.Line] | type[model.Polygon]
+
+tables = ["point", "line", "polygon"]
+
+select_sql = """
+SELECT '{tbl}', osm_id, tags -> 'wikidata', ST_Centroid(ST_Collect(way))
+FROM planet_osm_{tbl}
+WHERE tags ? 'wikidata' {osm_filter}
+GROUP BY osm_id, tags -> 'wikidata'
+"""
+
+insert_sql = """
+INSERT INTO osm_wikidata (tbl, osm_id, qid, centroid)
+{select}
+ON CONFLICT (tbl, osm_id) DO UPDATE
+SET qid = excluded.qid, centroid = excluded.centroid
+"""
+
+
+def table_name(cls: PlanetClass) -> str:
+    """Name used for the planet table of a model class: point, line or polygon."""
+    return typing.cast(str, cls.__tablename__).removeprefix("planet_osm_")
+
+
+def rebuild() -> None:
+    """Rebuild the index from the planet tables."""
+    session.execute(sqlalchemy.text("TRUNCATE osm_wikidata"))
+    for tbl in tables:
+        select = select_sql.format(tbl=tbl, osm_filter="")
+        session.execute(sqlalchemy.text(insert_sql.format(select=select)))
+        session.commit()
+
+
+def create_indexes() -> None:
+    """Add partial spatial indexes on planet rows that have a wikidata tag."""
+    for index in planet.wikidata_indexes:
+        index.create(session.connection(), checkfirst=True)
+    session.commit()
+
+
+def update_objects(tbl: str, osm_ids: typing.Collection[int]) -> None:
+    """Refresh the index for objects after their planet rows changed."""
+    if not osm_ids:
+        return
+    params = {"tbl": tbl, "osm_ids": list(osm_ids)}
+    session.execute(
+        sqlalchemy.text(
+            "DELETE FROM osm_wikidata WHERE tbl = :tbl AND osm_id = ANY(:osm_ids)"
+        ),
+        params,
+    )
+    select = select_sql.format(tbl=tbl, osm_filter="AND osm_id = ANY(:osm_ids)")
+    session.execute(sqlalchemy.text(insert_sql.format(select=select)), params)
+
+
+def update_object(cls: PlanetClass, src_id: int) -> None:
+    """Refresh the index for an object after its tags were edited."""
+    update_objects(table_name(cls), [src_id])
+
+
+def tagged_qids(qids: typing.Collection[str]) -> set[str]:
+    """QIDs that are used in a wikidata tag on OSM."""
+    if not qids:
+        return set()
+    q = (
+        sqlalchemy.select(model.OsmWikidata.qid)
+        .where(model.OsmWikidata.qid.in_(list(qids)))
+        .distinct()
+    )
+    return set(session.execute(q).scalars())
+
+
+def find_objects(
+    qids: typing.Collection[str], tbl: str | None = None
+) -> list[model.OsmWikidata]:
+    """OSM objects tagged with the given QIDs, optionally from one planet table."""
+    q = model.OsmWikidata.query.filter(model.OsmWikidata.qid.in_(list(qids)))
+    if tbl:
+        q = q.filter(model.OsmWikidata.tbl == tbl)
+    return typing.cast(list[model.OsmWikidata], q.all())
@@ -0,0 +1,197 @@
+"""Precomputed items within administrative boundaries, for place pages.
+
+Each boundary polygon with an admin_level between 2 and 8 gets the IDs of the
+items with a location inside it, the number of items and the instance of (P31)
+counts. Edits mark the boundaries around the changed locations as dirty, they
+are read with a live query until they are refreshed.
+"""
+
+import typing
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from . import model
+from .database import now_utc, session
+
+# Administrative levels that get precomputed statistics.
+min_admin_level = 2
+max_admin_level = 8
+
+place_cte_sql = """
+WITH found AS (
+    SELECT DISTINCT l.item_id
+    FROM planet_osm_polygon p
+    JOIN item_location l ON ST_Covers(p.way, l.location)
+    WHERE p.osm_id = :src_id
+), isa AS (
+    SELECT isa_id, count(*) AS num
+    FROM found
+    JOIN item_marker m USING (item_id)
+    CROSS JOIN unnest(m.isa_ids) AS isa_id
+    GROUP BY isa_id
+)
+"""
+
+isa_count_sql = """
+coalesce(
+    (
+        SELECT jsonb_agg(jsonb_build_array('Q' || isa_id, num)
+            ORDER BY num DESC, isa_id)
+        FROM isa
+    ),
+    '[]'
+)
+"""
+
+summary_sql = f"""
+{place_cte_sql}
+SELECT (SELECT count(*) FROM found) AS item_count, {isa_count_sql} AS isa_count
+"""
+
+place_sql = f"""
+{place_cte_sql}
+INSERT INTO place_stats
+    (src_id, admin_level, item_count, item_ids, isa_count, dirty, updated)
+SELECT :src_id, :admin_level,
+    (SELECT count(*) FROM found),
+    coalesce((SELECT array_agg(item_id ORDER BY item_id) FROM found), '{{}}'),
+    {isa_count_sql},
+    false, now() AT TIME ZONE 'utc'
+ON CONFLICT (src_id) DO UPDATE SET
+    admin_level = excluded.admin_level,
+    item_count = excluded.item_count,
+    item_ids = excluded.item_ids,
+    isa_count = excluded.isa_count,
+    dirty = false,
+    updated = excluded.updated
+"""
+
+mark_dirty_sql = """
+UPDATE place_stats SET dirty = true
+FROM planet_osm_polygon p
+WHERE p.osm_id = place_stats.src_id
+    AND ST_Covers(p.way, ST_SetSRID(ST_MakePoint(:lon, :lat), 4326))
+"""
+
+
+def admin_polygons(
+    src_ids: typing.Collection[int] | None = None,
+) -> list[tuple[int, int]]:
+    """Source IDs and admin levels of the boundary polygons to precompute."""
+    levels = [str(level) for level in range(min_admin_level, max_admin_level + 1)]
+    q = (
+        sqlalchemy.select(model.Polygon.src_id, model.Polygon.admin_level)
+        .where(
+            model.Polygon.boundary == "administrative",
+            model.Polygon.admin_level.in_(levels),
+        )
+        .distinct()
+        .order_by(model.Polygon.src_id)
+    )
+    if src_ids is not None:
+        q = q.where(model.Polygon.src_id.in_(list(src_ids)))
+    return [(src_id, int(level)) for src_id, level in session.execute(q)]
+
+
+def build_place(src_id: int, admin_level: int) -> None:
+    """Compute the statistics for one boundary polygon."""
+    params = {"src_id": src_id, "admin_level": admin_level}
+    session.execute(sqlalchemy.text(place_sql), params)
+
+
+def rebuild() -> None:
+    """Compute statistics for every administrative boundary polygon."""
+    session.execute(sqlalchemy.text("TRUNCATE place_stats"))
+    session.commit()
+    for src_id, admin_level in admin_polygons():
+        build_place(src_id, admin_level)
+        session.commit()
+
+
+def refresh_dirty() -> None:
+    """Recompute statistics for boundaries with changed items."""
+    q = sqlalchemy.select(model.PlaceStats.src_id, model.PlaceStats.admin_level).where(
+        model.PlaceStats.dirty
+    )
+    for src_id, admin_level in session.execute(q).all():
+        build_place(src_id, admin_level)
+        session.commit()
+
+
+def update_places(src_ids: typing.Collection[int]) -> None:
+    """Mark polygons that changed in OSM as dirty, for refresh_dirty to rebuild.
+
+    New boundaries get a dirty row and polygons that are no longer boundaries
+    lose their row.
+    """
+    if not src_ids:
+        return
+    places = admin_polygons(src_ids)
+    session.execute(
+        sqlalchemy.delete(model.PlaceStats).where(
+            model.PlaceStats.src_id.in_(list(src_ids)),
+            model.PlaceStats.src_id.not_in([src_id for src_id, _ in places]),
+        )
+    )
+    if not places:
+        return
+
+    rows = [
+        {
+            "src_id": src_id,
+            "admin_level": admin_level,
+            "item_count": 0,
+            "item_ids": [],
+            "isa_count": [],
+            "dirty": True,
+            "updated": now_utc(),
+        }
+        for src_id, admin_level in places
+    ]
+    stmt = postgresql.insert(model.PlaceStats.__table__).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[model.PlaceStats.src_id],
+        set_={"admin_level": stmt.excluded.admin_level, "dirty": True},
+    )
+    session.execute(stmt)
+
+
+def mark_dirty_points(points: typing.Iterable[tuple[float, float]]) -> None:
+    """Mark the boundaries that cover the given lat/lon points as dirty."""
+    for lat, lon in set(points):
+        session.execute(sqlalchemy.text(mark_dirty_sql), {"lat": lat, "lon": lon})
+
+
+def get_place(src_id: int) -> model.PlaceStats | None:
+    """Statistics for a polygon, None if missing or out of date.
+
+    The item_ids column isn't loaded, use item_ids_subquery to filter by it.
+    """
+    stats: model.PlaceStats | None = model.PlaceStats.query.options(
+        sqlalchemy.orm.defer(model.PlaceStats.item_ids)
+    ).get(src_id)
+    return stats if stats and not stats.dirty else None
+
+
+def item_ids_subquery(src_id: int) -> sqlalchemy.ScalarSelect[typing.Any]:
+    """The precomputed item IDs of a polygon, for use in a query."""
+    return (
+        sqlalchemy.select(model.PlaceStats.item_ids)
+        .where(model.PlaceStats.src_id == src_id)
+        .scalar_subquery()
+    )
+
+
+class PlaceSummary(typing.NamedTuple):
+    """Number of items in a polygon and the instance of (P31) counts."""
+
+    item_count: int
+    isa_count: list[list[typing.Any]]  # [[qid, count], ...]
+
+
+def live_summary(src_id: int) -> PlaceSummary:
+    """Summary for any polygon computed now, with one spatial query."""
+    params = {"src_id": src_id}
+    row = session.execute(sqlalchemy.text(summary_sql), params).one()
+    return PlaceSummary(item_count=row.item_count, isa_count=row.isa_count)
@@ -1,7 +1,7 @@
 """Planet tables."""
 
 from geoalchemy2 import Geometry
-from sqlalchemy import Column, Float, Integer, MetaData, String, Table
+from sqlalchemy import Column, Float, Index, Integer, MetaData, String, Table
 from sqlalchemy.dialects import postgresql
 
 metadata = MetaData()
@@ -33,3 +33,15 @@ polygon = Table(
     Column("way", Geometry("GEOMETRY", srid=4326, spatial_index=True), nullable=False),
     Column("way_area", Float),
 )
+
+# Partial spatial index for bounding box queries of nodes with a wikidata tag, the
+# table is created by osm2pgsql so this is added by osm_wikidata. Lines and
+# polygons are read from osm_geometry, which has its own index.
+wikidata_indexes = [
+    Index(
+        "planet_osm_point_wikidata_idx",
+        point.c.way,
+        postgresql_using="gist",
+        postgresql_where=point.c.tags.has_key("wikidata"),
+    )
+]
@@ -0,0 +1,253 @@
+"""Apply OSM replication diffs to the planet tables and the tables derived from them.
+
+The planet tables are updated by osm2pgsql in append mode, this needs the slim
+tables from an import with --slim. The osmChange file is read here to find the
+changed objects, so the derived tables and the caches can be refreshed.
+
+Ways and relations are found in the slim tables, these need the legacy middle
+format: nodes and parts arrays, used by osm2pgsql 1.x. The bucket index on way
+nodes from osm2pgsql 1.4 and the older GIN index are both supported.
+"""
+
+import gzip
+import os
+import subprocess
+import typing
+
+import lxml.etree
+import sqlalchemy
+
+from . import model, osm_geometry, osm_wikidata, place_stats, simplify, tile_cache
+from .database import now_utc, session
+
+# Objects refreshed in the derived tables per statement.
+batch_size = 1_000
+
+# Changed objects are grouped by the grid cell of their centroid, one cached
+# tile invalidation per cell (degrees).
+invalidation_cell_size = 1.0
+
+RowIds = dict[str, set[int]]  # osm_id values by planet table
+Box = list[float]  # west, south, east, north
+
+
+class Change(typing.NamedTuple):
+    """Objects in an osmChange file."""
+
+    nodes: set[int]
+    ways: set[int]
+    relations: set[int]
+
+
+def sequence_path(diff_dir: str, sequence: int) -> str:
+    """Filename of a diff in a replication directory, like 000/123/456.osc.gz."""
+    digits = f"{sequence:09d}"
+    return os.path.join(diff_dir, digits[:3], digits[3:6], digits[6:] + ".osc.gz")
+
+
+def read_state(filename: str) -> int:
+    """Sequence number from a replication state.txt file."""
+    with open(filename) as f:
+        for line in f:
+            key, _, value = line.strip().partition("=")
+            if key == "sequenceNumber":
+                return int(value)
+    raise ValueError(f"no sequenceNumber in {filename}")
+
+
+def parse_change(filename: str) -> Change:
+    """Read the IDs of the nodes, ways and relations in an osmChange file."""
+    change = Change(nodes=set(), ways=set(), relations=set())
+    found = {"node": change.nodes, "way": change.ways, "relation": change.relations}
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as f:
+        for _, element in lxml.etree.iterparse(
+            f, events=("end",), tag=("node", "way", "relation")
+        ):
+            found[element.tag].add(int(element.get("id")))
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    return change
+
+
+ways_sql = "SELECT id FROM planet_osm_ways WHERE nodes && CAST(:ids AS bigint[])"
+
+# osm2pgsql 1.4 and later index way nodes with this function instead of GIN.
+ways_bucket_sql = """
+SELECT id FROM planet_osm_ways
+WHERE planet_osm_index_bucket(nodes)
+        && planet_osm_index_bucket(CAST(:ids AS bigint[]))
+    AND nodes && CAST(:ids AS bigint[])
+"""
+
+# Relation parts are nodes, then ways from way_off, then relations from rel_off.
+relations_sql = """
+SELECT id FROM planet_osm_rels
+WHERE parts && CAST(:ids AS bigint[])
+    AND parts[way_off + 1:rel_off] && CAST(:ids AS bigint[])
+"""
+
+has_bucket_index_sql = "SELECT to_regproc('planet_osm_index_bucket') IS NOT NULL"
+
+legacy_middle_sql = """
+SELECT count(*) FROM information_schema.columns
+WHERE table_name = 'planet_osm_rels' AND column_name IN ('parts', 'way_off', 'rel_off')
+"""
+
+
+def check_middle_tables() -> None:
+    """Check the slim tables use the legacy middle format."""
+    if session.execute(sqlalchemy.text(legacy_middle_sql)).scalar() != 3:
+        raise ValueError("planet_osm_rels needs the osm2pgsql legacy middle format")
+
+
+def changed_rows(change: Change) -> RowIds:
+    """Planet table rows affected by a change, found before it is applied.
+
+    Ways with a changed node and relations with a changed way are included,
+    these are found using the osm2pgsql slim tables.
+    """
+    ways = set(change.ways)
+    relations = set(change.relations)
+    if change.nodes:
+        bucket = session.execute(sqlalchemy.text(has_bucket_index_sql)).scalar()
+        sql = ways_bucket_sql if bucket else ways_sql
+        params = {"ids": list(change.nodes)}
+        ways.update(session.execute(sqlalchemy.text(sql), params).scalars())
+    if ways:
+        params = {"ids": list(ways)}
+        result = session.execute(sqlalchemy.text(relations_sql), params)
+        relations.update(result.scalars())
+
+    way_rows = ways | {-relation_id for relation_id in relations}
+    return {"point": set(change.nodes), "line": way_rows, "polygon": set(way_rows)}
+
+
+def batches(osm_ids: set[int]) -> typing.Iterator[list[int]]:
+    """IDs in lists of batch_size."""
+    id_list = sorted(osm_ids)
+    for start in range(0, len(id_list), batch_size):
+        yield id_list[start : start + batch_size]
+
+
+cell_bounds_sql = """
+SELECT floor(ST_X(centroid) / :cell_size) AS cell_x,
+    floor(ST_Y(centroid) / :cell_size) AS cell_y,
+    min(ST_XMin(way)), min(ST_YMin(way)), max(ST_XMax(way)), max(ST_YMax(way))
+FROM (
+    SELECT way, ST_Centroid(way) AS centroid
+    FROM planet_osm_{tbl}
+    WHERE osm_id = ANY(:osm_ids)
+) AS objects
+GROUP BY cell_x, cell_y
+"""
+
+invalidate_candidates_sql = """
+DELETE FROM candidate_cache c
+USING planet_osm_{tbl} p
+WHERE p.osm_id = ANY(:osm_ids) AND ST_Intersects(c.area, p.way)
+"""
+
+
+def merge_cells(
+    cells: dict[tuple[int, int], Box], cell: tuple[int, int], bounds: Box
+) -> None:
+    """Add the bounds of some objects to the box for their grid cell."""
+    if box := cells.get(cell):
+        west, south, east, north = bounds
+        cells[cell] = [
+            min(box[0], west),
+            min(box[1], south),
+            max(box[2], east),
+            max(box[3], north),
+        ]
+    else:
+        cells[cell] = list(bounds)
+
+
+def invalidate_caches(rows: RowIds) -> None:
+    """Discard cached tiles and candidates around the current planet rows.
+
+    Called before and after the change is applied, so the old and new locations
+    of the objects are both covered. Tile invalidations are merged into one box
+    per grid cell.
+    """
+    cells: dict[tuple[int, int], Box] = {}
+    for tbl, osm_ids in rows.items():
+        for batch in batches(osm_ids):
+            params = {"osm_ids": batch}
+            sql = cell_bounds_sql.format(tbl=tbl)
+            cell_params = {**params, "cell_size": invalidation_cell_size}
+            result = session.execute(sqlalchemy.text(sql), cell_params)
+            for cell_x, cell_y, *bounds in result:
+                merge_cells(cells, (int(cell_x), int(cell_y)), bounds)
+            sql = invalidate_candidates_sql.format(tbl=tbl)
+            session.execute(sqlalchemy.text(sql), params)
+    tile_cache.invalidate_boxes(cells.values())
+
+
+def update_derived(rows: RowIds) -> None:
+    """Refresh the tables derived from the planet for the changed rows."""
+    for tbl, osm_ids in rows.items():
+        for batch in batches(osm_ids):
+            osm_wikidata.update_objects(tbl, batch)
+            osm_geometry.update_objects(tbl, batch)
+            simplify.update_objects(tbl, batch)
+    place_stats.update_places(rows["polygon"])
+
+
+def get_state() -> model.PlanetState:
+    """State of the planet tables, created if missing."""
+    state: model.PlanetState | None = model.PlanetState.query.order_by(
+        model.PlanetState.id
+    ).first()
+    if not state:
+        state = model.PlanetState(id=1, version=0)
+        session.add(state)
+    return state
+
+
+def init_state(sequence: int) -> None:
+    """Record the replication sequence number of the planet import."""
+    state = get_state()
+    state.sequence = sequence
+    state.updated = now_utc()
+    session.commit()
+
+
+def apply_diff(filename: str, sequence: int, osm2pgsql: list[str]) -> None:
+    """Apply one diff with osm2pgsql, then refresh derived tables and caches."""
+    rows = changed_rows(parse_change(filename))
+    invalidate_caches(rows)
+    session.commit()
+
+    subprocess.run(osm2pgsql + [filename], check=True)
+
+    update_derived(rows)
+    invalidate_caches(rows)
+    state = get_state()
+    state.sequence = sequence
+    state.updated = now_utc()
+    session.commit()
+
+
+def apply_pending(diff_dir: str, osm2pgsql: list[str]) -> int:
+    """Apply diffs newer than the last one recorded, returns the number applied."""
+    latest = read_state(os.path.join(diff_dir, "state.txt"))
+    current = get_state().sequence
+    if current is None:
+        raise ValueError(
+            "sequence of the planet import isn't set, run planet_update.py --init"
+        )
+    check_middle_tables()
+
+    applied = 0
+    for sequence in range(current + 1, latest + 1):
+        filename = sequence_path(diff_dir, sequence)
+        if not os.path.exists(filename):
+            break
+        print(f"applying {sequence}")
+        apply_diff(filename, sequence, osm2pgsql)
+        applied += 1
+    return applied
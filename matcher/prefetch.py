@@ -0,0 +1,59 @@
+"""Warm the candidate cache in the background for items the user is likely to open."""
+
+import concurrent.futures
+import threading
+import typing
+
+import flask
+
+from . import candidate_cache, model
+
+# Small pool so prefetching doesn't starve the database of connections.
+max_workers = 2
+
+# Items waiting or in progress, new requests are dropped beyond this.
+max_pending = 200
+
+# Maximum number of items to queue from a single viewport.
+max_items_per_request = 50
+
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max_workers, thread_name_prefix="prefetch"
+)
+_pending: set[tuple[int, bool, float | None]] = set()
+_lock = threading.Lock()
+
+
+def warm_candidates(
+    app: flask.Flask, item_id: int, knn: bool, tolerance: float | None
+) -> None:
+    """Run the candidate search for an item so the result is cached."""
+    try:
+        with app.app_context():
+            item = model.Item.query.get(item_id)
+            if item and item.locations:
+                candidate_cache.get_candidates(item, knn=knn, tolerance=tolerance)
+    except Exception:
+        app.logger.exception("candidate prefetch failed for Q%d", item_id)
+    finally:
+        with _lock:
+            _pending.discard((item_id, knn, tolerance))
+
+
+def queue_items(
+    item_ids: typing.Iterable[int], knn: bool = False, tolerance: float | None = None
+) -> int:
+    """Queue candidate searches for items, returns the number queued."""
+    app = flask.current_app._get_current_object()  # type: ignore
+    queued = 0
+    with _lock:
+        for item_id in item_ids:
+            if queued >= max_items_per_request or len(_pending) >= max_pending:
+                break
+            key = (item_id, knn, tolerance)
+            if key in _pending:
+                continue
+            _pending.add(key)
+            _executor.submit(warm_candidates, app, item_id, knn, tolerance)
+            queued += 1
+    return queued
@@ -0,0 +1,161 @@
+"""In-memory index of id-tagging-schema presets."""
+
+import json
+import os
+import threading
+import time
+import typing
+
+import flask
+
+# How often to check if the id-tagging-schema directory has changed (seconds).
+reload_interval = 60
+
+country_language = {
+    "AU": "en-AU",  # Australia
+    "GB": "en-GB",  # United Kingdom
+    "IE": "en-GB",  # Ireland
+    "IN": "en-IN",  # India
+    "NZ": "en-NZ",  # New Zealand
+}
+
+
+class Preset(typing.TypedDict):
+    """Preset matching an OSM tag."""
+
+    tag_or_key: str
+    preset: str
+    name: str
+
+
+class PresetIndex:
+    """Preset names and translations read from an id-tagging-schema checkout."""
+
+    def __init__(self, ts_dir: str) -> None:
+        """Read presets and translations from the given directory."""
+        self.ts_dir = ts_dir
+        self.preset_dir = os.path.join(ts_dir, "data", "presets")
+        self.translation_dir = os.path.join(ts_dir, "dist", "translations")
+        self.signature = self.get_signature()
+        self.checked = time.monotonic()
+        self.names = self.load_names()
+        self.translations = self.load_translations()
+        # Only tags that match a preset are cached, so the size is bounded by
+        # the schema rather than by the free-text values found in OSM.
+        self.cache: dict[tuple[str, str, str], Preset] = {}
+
+    def watched_paths(self) -> list[str]:
+        """Paths with a modification time that changes when the schema is updated."""
+        paths = [self.ts_dir, self.preset_dir, self.translation_dir]
+        if os.path.isdir(self.preset_dir):
+            paths += [entry.path for entry in os.scandir(self.preset_dir)]
+        return paths
+
+    def get_signature(self) -> tuple[float, ...]:
+        """Modification times of the watched paths."""
+        return tuple(
+            os.stat(path).st_mtime if os.path.exists(path) else 0.0
+            for path in self.watched_paths()
+        )
+
+    def is_stale(self) -> bool:
+        """Check if the schema directory changed, at most once per reload interval."""
+        now = time.monotonic()
+        if now - self.checked < reload_interval:
+            return False
+        self.checked = now
+        return self.get_signature() != self.signature
+
+    def load_names(self) -> dict[str, str]:
+        """Map preset file path, relative to the preset dir, to preset name."""
+        names: dict[str, str] = {}
+        for root, dirs, files in os.walk(self.preset_dir):
+            for filename in files:
+                if not filename.endswith(".json"):
+                    continue
+                full_path = os.path.join(root, filename)
+                relative = os.path.relpath(full_path, self.preset_dir)[:-5]
+                with open(full_path) as f:
+                    preset = json.load(f)
+                if "name" in preset:
+                    names[relative.replace(os.sep, "/")] = preset["name"]
+        return names
+
+    def load_translations(self) -> dict[str, dict[str, typing.Any]]:
+        """Preset translations for the languages listed in country_language."""
+        translations = {}
+        for lang_code in set(country_language.values()):
+            filename = os.path.join(self.translation_dir, lang_code + ".json")
+            if not os.path.exists(filename):
+                continue
+            with open(filename) as f:
+                json_data = json.load(f)
+            try:
+                translations[lang_code] = json_data[lang_code]["presets"]["presets"]
+            except KeyError:
+                continue
+        return translations
+
+    def find(self, k: str, v: str, ending: str) -> Preset | None:
+        """Find preset for tag, ending is the geometry: point, line or area."""
+        cache_key = (k, v, ending)
+        if cache_key in self.cache:
+            return self.cache[cache_key]
+
+        for path in f"{k}/{v}", f"{k}/{v}_{ending}", f"{k}/_{v}":
+            if path in self.names:
+                found: Preset = {
+                    "tag_or_key": f"Tag:{k}={v}",
+                    "preset": f"{k}/{v}",
+                    "name": self.names[path],
+                }
+                self.cache[cache_key] = found
+                return found
+
+        if k in self.names:
+            return {"tag_or_key": f"Key:{k}", "preset": k, "name": self.names[k]}
+        return None
+
+    def translated_name(self, preset: str, lang_code: str) -> str | None:
+        """Name of preset in the given language."""
+        translation = self.translations.get(lang_code, {}).get(preset)
+        return translation.get("name") if translation else None
+
+
+_index: PresetIndex | None = None
+_lock = threading.Lock()
+
+
+def get_index() -> PresetIndex:
+    """Preset index for ID_TAGGING_SCHEMA_DIR, reloaded if the directory changes."""
+    global _index
+    ts_dir = flask.current_app.config["ID_TAGGING_SCHEMA_DIR"]
+    index = _index
+    if index and index.ts_dir == ts_dir and not index.is_stale():
+        return index
+
+    with _lock:
+        if _index is index:
+            if index:
+                index.cache.clear()
+            _index = PresetIndex(ts_dir)
+        return _index
+
+
+def find_preset(
+    k: str, v: str, ending: str, alpha2_codes: typing.Iterable[str] = ()
+) -> Preset | None:
+    """Find preset for the given tag, translated for the country if possible."""
+    index = get_index()
+    found = index.find(k, v, ending)
+    if not found:
+        return None
+
+    preset: Preset = found.copy()  # type: ignore
+    for code in alpha2_codes:
+        lang_code = country_language.get(code)
+        name = index.translated_name(preset["preset"], lang_code) if lang_code else None
+        if name:
+            preset["name"] = name
+            break
+    return preset
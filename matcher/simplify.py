@@ -0,0 +1,154 @@
+"""Simplified geometry for GeoJSON responses, based on the map zoom level."""
+
+import json
+import math
+import typing
+
+import sqlalchemy
+from sqlalchemy.sql.elements import ColumnElement
+
+from . import model, tiles
+from .database import session
+
+# Precompute simplified geometry for objects with more points than this.
+min_points = 10_000
+
+# Zoom levels with precomputed simplified geometry for the largest objects.
+precomputed_zooms = [6, 9, 12]
+
+
+def zoom_tolerance(zoom: int) -> float:
+    """Simplification tolerance in degrees, half a pixel at this zoom level.
+
+    The zoom is clamped to the levels used by the map tiles.
+    """
+    zoom = min(max(zoom, 0), tiles.max_zoom)
+    return 360 / (256 * 2**zoom) / 2
+
+
+def tolerance_digits(tolerance: float) -> int:
+    """Decimal digits needed to represent coordinates at this tolerance."""
+    if not 0 < tolerance < math.inf:
+        raise ValueError(f"tolerance must be positive and finite: {tolerance}")
+    return max(1, min(7, math.ceil(-math.log10(tolerance))))
+
+
+def geojson(
+    tbl: str,
+    osm_id: ColumnElement[int],
+    geom: ColumnElement[bytes],
+    tolerance: float | None,
+) -> ColumnElement[str]:
+    """GeoJSON for geometry, simplified if there is a tolerance.
+
+    Uses precomputed simplified geometry for large objects when available.
+    """
+    if tolerance is None:
+        return sqlalchemy.func.ST_AsGeoJSON(geom)
+
+    digits = tolerance_digits(tolerance)
+    if tbl == "point":
+        return sqlalchemy.func.ST_AsGeoJSON(geom, digits)
+
+    simplified = model.SimplifiedGeometry
+    precomputed = (
+        sqlalchemy.select(sqlalchemy.func.ST_AsGeoJSON(simplified.way, digits))
+        .where(
+            simplified.tbl == tbl,
+            simplified.osm_id == osm_id,
+            simplified.tolerance <= tolerance,
+        )
+        .order_by(simplified.tolerance.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    on_the_fly = sqlalchemy.func.ST_AsGeoJSON(
+        sqlalchemy.func.ST_SimplifyPreserveTopology(geom, tolerance), digits
+    )
+    return sqlalchemy.func.coalesce(precomputed, on_the_fly)
+
+
+def geojson_sql(
+    tbl: str, geom: str, tolerance: float | None, osm_id: str | None = None
+) -> str:
+    """SQL for GeoJSON of geometry in a planet table query written as SQL text.
+
+    osm_id is the SQL for the osm_id column, by default from the planet table.
+    """
+    if tolerance is None:
+        return f"ST_AsGeoJSON({geom})"
+
+    digits = tolerance_digits(tolerance)
+    if tbl == "point":
+        return f"ST_AsGeoJSON({geom}, {digits})"
+
+    tolerance = float(tolerance)
+    osm_id = osm_id or f"planet_osm_{tbl}.osm_id"
+    precomputed = (
+        f"SELECT ST_AsGeoJSON(s.way, {digits}) FROM simplified_geometry s "
+        f"WHERE s.tbl = '{tbl}' AND s.osm_id = {osm_id} "
+        f"AND s.tolerance <= {tolerance!r} ORDER BY s.tolerance DESC LIMIT 1"
+    )
+    on_the_fly = (
+        f"ST_AsGeoJSON(ST_SimplifyPreserveTopology({geom}, {tolerance!r}), {digits})"
+    )
+    return f"COALESCE(({precomputed}), {on_the_fly})"
+
+
+def polygon_geojson(
+    polygon: model.Polygon, tolerance: float | None
+) -> dict[str, typing.Any]:
+    """GeoJSON for an OSM polygon, simplified if there is a tolerance."""
+    if tolerance is None:
+        return polygon.geojson()
+
+    q = session.query(
+        geojson("polygon", model.Polygon.src_id, model.Polygon.way, tolerance)
+    ).filter(model.Polygon.src_id == polygon.src_id)
+    return typing.cast(dict[str, typing.Any], json.loads(q.limit(1).scalar()))
+
+
+build_sql = """
+INSERT INTO simplified_geometry (tbl, osm_id, tolerance, way)
+SELECT :tbl, osm_id, :tolerance, ST_SimplifyPreserveTopology(ST_Collect(way), :tolerance)
+FROM planet_osm_{tbl}
+WHERE {osm_filter}
+GROUP BY osm_id
+HAVING sum(ST_NPoints(way)) > :min_points
+"""
+
+
+def build() -> None:
+    """Precompute simplified geometry for the largest lines and polygons."""
+    session.execute(sqlalchemy.text("TRUNCATE simplified_geometry"))
+    for tbl in "line", "polygon":
+        for zoom in precomputed_zooms:
+            params = {
+                "tbl": tbl,
+                "tolerance": zoom_tolerance(zoom),
+                "min_points": min_points,
+            }
+            sql = build_sql.format(tbl=tbl, osm_filter="true")
+            session.execute(sqlalchemy.text(sql), params)
+            session.commit()
+
+
+def update_objects(tbl: str, osm_ids: typing.Collection[int]) -> None:
+    """Recompute simplified geometry for objects after their planet rows changed."""
+    if tbl == "point" or not osm_ids:
+        return
+    session.execute(
+        sqlalchemy.delete(model.SimplifiedGeometry).where(
+            model.SimplifiedGeometry.tbl == tbl,
+            model.SimplifiedGeometry.osm_id.in_(list(osm_ids)),
+        )
+    )
+    sql = build_sql.format(tbl=tbl, osm_filter="osm_id = ANY(:osm_ids)")
+    for zoom in precomputed_zooms:
+        params = {
+            "tbl": tbl,
+            "tolerance": zoom_tolerance(zoom),
+            "min_points": min_points,
+            "osm_ids": list(osm_ids),
+        }
+        session.execute(sqlalchemy.text(sql), params)
@@ -0,0 +1,397 @@
+"""Cache results for bounding box endpoints in map tiles.
+
+Requested bounds are snapped to the covering tiles at a zoom level that suits
+the size of the bounds. Each tile is cached in memory and optionally on disk,
+and responses are assembled from the tiles.
+"""
+
+import collections
+import datetime
+import hashlib
+import json
+import math
+import os
+import shutil
+import threading
+import time
+import typing
+
+import flask
+import sqlalchemy
+
+from . import model, tiles, utils
+from .database import now_utc, session
+
+# Tile zoom levels used for caching, bigger bounds are not cached.
+min_zoom = 8
+max_zoom = 16
+
+# Bounds that need more tiles than this are not cached.
+max_tiles = 16
+
+# Memory limit for the in-process cache, in bytes of JSON.
+max_memory = 64 * 1024 * 1024
+
+# How often to look for new rows in tile_invalidation (seconds).
+invalidation_check_interval = 10
+
+# Rows in tile_invalidation are deleted after this many seconds. A cache that
+# hasn't checked for longer might have missed some, so it is emptied.
+invalidation_retention = 3600
+
+T = typing.TypeVar("T")
+TileKey = tuple[str, int, int, int, str]  # endpoint, z, x, y, params hash
+TileRange = tuple[int, int, int, int]  # min x, min y, max x, max y
+
+
+class LRUCache:
+    """Least recently used cache of tiles, limited by the total size."""
+
+    def __init__(self, max_size: int) -> None:
+        """Make an empty cache."""
+        self.max_size = max_size
+        self.size = 0
+        self.entries: collections.OrderedDict[TileKey, bytes] = (
+            collections.OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    def get(self, key: TileKey) -> bytes | None:
+        """Cached data for key, marks the entry as recently used."""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def set(self, key: TileKey, data: bytes) -> None:
+        """Store data, discarding the least recently used entries to make space."""
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_size and self.entries:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self) -> None:
+        """Remove every entry."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def discard(self, dirty: dict[int, list[TileRange]]) -> None:
+        """Remove tiles within the dirty ranges, which are grouped by zoom."""
+        with self.lock:
+            for key in list(self.entries):
+                _, z, x, y, _ = key
+                if in_ranges(dirty.get(z, []), x, y):
+                    self.size -= len(self.entries.pop(key))
+
+
+memory_cache = LRUCache(max_memory)
+
+_last_check = 0.0
+_last_invalidation_id: int | None = None
+_invalidation_lock = threading.Lock()
+
+
+def in_ranges(ranges: list[TileRange], x: int, y: int) -> bool:
+    """Tile is within one of the ranges."""
+    return any(x0 <= x <= x1 and y0 <= y <= y1 for x0, y0, x1, y1 in ranges)
+
+
+def cache_zoom(bounds: list[float]) -> int | None:
+    """Zoom level where a tile is between half and all of the bounds width."""
+    west, south, east, north = bounds
+    width = east - west
+    if width <= 0:
+        return max_zoom
+    z = math.floor(math.log2(360 / width)) + 1
+    return min(z, max_zoom) if z >= min_zoom else None
+
+
+def tile_range(bounds: typing.Sequence[float], z: int) -> TileRange:
+    """Range of tiles at zoom level z that cover the bounds."""
+    west, south, east, north = bounds
+    x0, y0 = tiles.lat_lon_to_tile(north, west, z)
+    x1, y1 = tiles.lat_lon_to_tile(south, east, z)
+    return (x0, y0, x1, y1)
+
+
+def covering_tiles(bounds: list[float], z: int) -> list[tuple[int, int]]:
+    """Tiles at zoom level z that cover the bounds."""
+    x0, y0, x1, y1 = tile_range(bounds, z)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def cache_tiles(bounds: list[float]) -> tuple[int, list[tuple[int, int]]] | None:
+    """Zoom level and tiles used to cache the bounds, None if they are too big."""
+    z = cache_zoom(bounds)
+    if z is None:
+        return None
+    tile_list = covering_tiles(bounds, z)
+    return (z, tile_list) if len(tile_list) <= max_tiles else None
+
+
+def covering_tile_ids(bounds: list[float]) -> list[str] | None:
+    """IDs (z/x/y) of the cache tiles covering the bounds, None if not cached."""
+    found = cache_tiles(bounds)
+    if not found:
+        return None
+    z, tile_list = found
+    return [f"{z}/{x}/{y}" for x, y in tile_list]
+
+
+def tile_id_bounds(tile_id: str) -> list[float] | None:
+    """Bounds of a tile given as z/x/y, None if the ID isn't valid."""
+    parts = tile_id.split("/")
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    z, x, y = (int(part) for part in parts)
+    return list(tiles.tile_bounds(z, x, y)) if tiles.is_valid(z, x, y) else None
+
+
+def params_key(params: dict[str, typing.Any]) -> str:
+    """Hash of the parameters that change the result for a tile."""
+    params_json = json.dumps(params, sort_keys=True, default=sorted)
+    return hashlib.sha1(params_json.encode("utf-8")).hexdigest()
+
+
+def disk_dir() -> str | None:
+    """Directory for the disk tier of the cache, if enabled."""
+    if not flask.current_app.config.get("TILE_CACHE_DISK"):
+        return None
+    return os.path.join(utils.cache_dir(), "tiles")
+
+
+def disk_filename(key: TileKey) -> str | None:
+    """Filename for a tile in the disk cache."""
+    tile_dir = disk_dir()
+    if not tile_dir:
+        return None
+    endpoint, z, x, y, params = key
+    return os.path.join(tile_dir, str(z), str(x), str(y), f"{endpoint}-{params}.json")
+
+
+def read_disk(key: TileKey) -> bytes | None:
+    """Read a tile from the disk cache."""
+    filename = disk_filename(key)
+    if not filename or not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def write_disk(key: TileKey, data: bytes) -> None:
+    """Save a tile to the disk cache."""
+    filename = disk_filename(key)
+    if not filename:
+        return
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_filename, "wb") as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
+
+
+def discard_disk(tile_dir: str, dirty: dict[int, list[TileRange]]) -> None:
+    """Remove tiles within the dirty ranges from the disk cache."""
+    for z, ranges in dirty.items():
+        zoom_dir = os.path.join(tile_dir, str(z))
+        if not os.path.isdir(zoom_dir):
+            continue
+        for x_entry in os.scandir(zoom_dir):
+            for y_entry in os.scandir(x_entry.path):
+                if in_ranges(ranges, int(x_entry.name), int(y_entry.name)):
+                    shutil.rmtree(y_entry.path, ignore_errors=True)
+
+
+def dirty_tiles(
+    rows: typing.Iterable[model.TileInvalidation],
+) -> dict[int, list[TileRange]]:
+    """Ranges of cached tiles, by zoom level, that overlap the invalidated areas."""
+    dirty: dict[int, list[TileRange]] = collections.defaultdict(list)
+    for row in rows:
+        bounds = (row.west, row.south, row.east, row.north)
+        for z in range(min_zoom, max_zoom + 1):
+            dirty[z].append(tile_range(bounds, z))
+    return dirty
+
+
+def read_watermark(tile_dir: str) -> int | None:
+    """ID of the last invalidation applied to the disk cache.
+
+    None if missing or too old, rows after it might have been deleted.
+    """
+    filename = os.path.join(tile_dir, "invalidation_id")
+    if not os.path.exists(filename):
+        return None
+    if time.time() - os.path.getmtime(filename) > invalidation_retention:
+        return None
+    with open(filename) as f:
+        return int(f.read())
+
+
+def write_watermark(tile_dir: str, invalidation_id: int) -> None:
+    """Record the last invalidation applied to the disk cache."""
+    os.makedirs(tile_dir, exist_ok=True)
+    with open(os.path.join(tile_dir, "invalidation_id"), "w") as f:
+        f.write(str(invalidation_id))
+
+
+def check_invalidations() -> None:
+    """Discard cached tiles in areas changed since the last check."""
+    global _last_check, _last_invalidation_id
+    now = time.monotonic()
+    if now - _last_check < invalidation_check_interval:
+        return
+
+    with _invalidation_lock:
+        if _last_invalidation_id is not None and (
+            now - _last_check > invalidation_retention
+        ):
+            # invalidations since the last check might have been deleted
+            memory_cache.clear()
+            _last_invalidation_id = None
+        _last_check = now
+        tile_dir = disk_dir()
+        max_id = session.query(sqlalchemy.func.max(model.TileInvalidation.id)).scalar()
+        max_id = max_id or 0
+
+        if _last_invalidation_id is None:
+            # the memory cache is empty, the disk cache may be older than us
+            watermark = read_watermark(tile_dir) if tile_dir else None
+            if watermark is None:
+                if tile_dir:
+                    shutil.rmtree(tile_dir, ignore_errors=True)
+                watermark = max_id
+            _last_invalidation_id = watermark
+
+        if max_id > _last_invalidation_id:
+            q = model.TileInvalidation.query.filter(
+                model.TileInvalidation.id > _last_invalidation_id,
+                model.TileInvalidation.id <= max_id,
+            )
+            dirty = dirty_tiles(q)
+            memory_cache.discard(dirty)
+            if tile_dir:
+                discard_disk(tile_dir, dirty)
+            _last_invalidation_id = max_id
+
+        if tile_dir:
+            write_watermark(tile_dir, max_id)
+
+
+def get_tile(key: TileKey, fetch: typing.Callable[[list[float]], list[T]]) -> list[T]:
+    """Result for one tile, from the cache or by running fetch for the tile bounds."""
+    data = memory_cache.get(key)
+    if data is None:
+        data = read_disk(key)
+        if data is not None:
+            memory_cache.set(key, data)
+    if data is not None:
+        return typing.cast(list[T], json.loads(data))
+
+    _, z, x, y, _ = key
+    result = fetch(list(tiles.tile_bounds(z, x, y)))
+    data = json.dumps(result).encode("utf-8")
+    memory_cache.set(key, data)
+    write_disk(key, data)
+    return result
+
+
+def get_tiled(
+    endpoint: str,
+    bounds: list[float],
+    params: dict[str, typing.Any],
+    fetch: typing.Callable[[list[float]], list[T]],
+    get_id: typing.Callable[[T], str],
+) -> list[T] | None:
+    """Combined results for the tiles covering the bounds, duplicates removed.
+
+    Returns None if the bounds are too big to cache, the caller should run the
+    query for the bounds instead.
+    """
+    covering = cache_tiles(bounds)
+    if not covering:
+        return None
+    z, tile_list = covering
+
+    check_invalidations()
+    key_params = params_key(params)
+    found: dict[str, T] = {}
+    for x, y in tile_list:
+        for row in get_tile((endpoint, z, x, y, key_params), fetch):
+            found.setdefault(get_id(row), row)
+    return list(found.values())
+
+
+def prune_invalidations() -> None:
+    """Delete invalidations that every cache has had time to apply."""
+    cutoff = now_utc() - datetime.timedelta(seconds=invalidation_retention)
+    session.query(model.TileInvalidation).filter(
+        model.TileInvalidation.created < cutoff
+    ).delete(synchronize_session=False)
+
+
+def invalidate(bounds: typing.Sequence[float]) -> None:
+    """Record that data within the bounds changed."""
+    west, south, east, north = bounds
+    session.add(model.TileInvalidation(west=west, south=south, east=east, north=north))
+    prune_invalidations()
+
+
+def invalidate_boxes(boxes: typing.Iterable[typing.Sequence[float]]) -> None:
+    """Record that data within each of the bounds changed, with one insert."""
+    rows = [
+        {"west": west, "south": south, "east": east, "north": north}
+        for west, south, east, north in boxes
+    ]
+    if not rows:
+        return
+    session.execute(sqlalchemy.insert(model.TileInvalidation), rows)
+    prune_invalidations()
+
+
+def invalidate_points(points: typing.Iterable[tuple[float, float]]) -> None:
+    """Record that data changed at the given lat/lon points."""
+    point_list = list(points)
+    if not point_list:
+        return
+    lats = [lat for lat, lon in point_list]
+    lons = [lon for lat, lon in point_list]
+    invalidate((min(lons), min(lats), max(lons), max(lats)))
+
+
+def invalidate_items(item_ids: typing.Collection[int]) -> None:
+    """Record that items changed, covering the locations of their markers."""
+    if not item_ids:
+        return
+    box = sqlalchemy.func.ST_Extent(model.ItemMarker.location)
+    q = session.query(
+        sqlalchemy.func.ST_XMin(box),
+        sqlalchemy.func.ST_YMin(box),
+        sqlalchemy.func.ST_XMax(box),
+        sqlalchemy.func.ST_YMax(box),
+    ).filter(model.ItemMarker.item_id.in_(list(item_ids)))
+    bounds = q.one()
+    if bounds[0] is not None:
+        invalidate(bounds)
+
+
+def invalidate_osm_object(
+    cls: type[model.Point] | type[model.Line] | type[model.Polygon], src_id: int
+) -> None:
+    """Record that an OSM object changed."""
+    box = sqlalchemy.func.ST_Extent(cls.way)
+    q = session.query(
+        sqlalchemy.func.ST_XMin(box),
+        sqlalchemy.func.ST_YMin(box),
+        sqlalchemy.func.ST_XMax(box),
+        sqlalchemy.func.ST_YMax(box),
+    ).filter(cls.src_id == src_id)
+    bounds = q.one()
+    if bounds[0] is not None:
+        invalidate(bounds)
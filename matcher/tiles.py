@@ -0,0 +1,198 @@
+"""Mapbox Vector Tiles of Wikidata items and OSM objects with wikidata tags."""
+
+import math
+import typing
+
+import sqlalchemy
+
+from . import item_grid, item_isa
+from .database import session
+
+# Tile coordinate space used by ST_AsMVTGeom.
+extent = 4096
+buffer = 64
+
+# OSM objects are only included from this zoom level, matching the map.
+osm_min_zoom = 14
+
+# Items are included from this zoom level, below it tiles have a clusters layer
+# with counts from the item grid.
+items_min_zoom = 8
+
+# Maximum number of items in the items layer of one tile.
+items_limit = 10_000
+
+# Cluster cells are this many zoom levels finer than the tile, or the nearest
+# finer item grid zoom.
+cluster_zoom_offset = 4
+
+max_zoom = 20
+
+
+class TileBounds(typing.NamedTuple):
+    """Bounds of a tile in degrees."""
+
+    west: float
+    south: float
+    east: float
+    north: float
+
+
+def is_valid(z: int, x: int, y: int) -> bool:
+    """Check the tile coordinates exist at this zoom level."""
+    return 0 <= z <= max_zoom and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def tile_lon(x: int, z: int) -> float:
+    """Longitude of the west edge of a tile column."""
+    return x / 2**z * 360 - 180
+
+
+def tile_lat(y: int, z: int) -> float:
+    """Latitude of the north edge of a tile row."""
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / 2**z))))
+
+
+def tile_bounds(z: int, x: int, y: int) -> TileBounds:
+    """Bounds of the given tile."""
+    return TileBounds(
+        west=tile_lon(x, z),
+        south=tile_lat(y + 1, z),
+        east=tile_lon(x + 1, z),
+        north=tile_lat(y, z),
+    )
+
+
+def tile_position(lat: float, lon: float, z: int) -> tuple[float, float]:
+    """Position of a point in tile coordinates, the integer part is the tile."""
+    n = 2**z
+    x = (lon + 180) / 360 * n
+    lat_rad = math.radians(max(min(lat, 85.0511), -85.0511))
+    y = (1 - math.asinh(math.tan(lat_rad)) / math.pi) / 2 * n
+    return (x, y)
+
+
+def lat_lon_to_tile(lat: float, lon: float, z: int) -> tuple[int, int]:
+    """Tile x and y that contain a point."""
+    n = 2**z
+    x, y = tile_position(lat, lon, z)
+    return (min(max(int(x), 0), n - 1), min(max(int(y), 0), n - 1))
+
+
+items_layer_sql = """
+SELECT ST_AsMVT(layer, 'items', :extent, 'geom')
+FROM (
+    SELECT 'Q' || m.item_id AS qid, m.label, m.closed,
+        ST_AsMVTGeom(ST_Transform(m.location, 3857), bounds.merc, :extent, :buffer)
+            AS geom
+    FROM item_marker m, bounds
+    WHERE m.location && bounds.geog {isa_sql}
+    LIMIT :items_limit
+) AS layer
+"""
+
+clusters_layer_sql = """
+SELECT ST_AsMVT(layer, 'clusters', :extent, 'geom')
+FROM (
+    SELECT g.count,
+        ST_AsMVTGeom(
+            ST_Centroid(ST_TileEnvelope(g.zoom, g.x, g.y)),
+            bounds.merc,
+            :extent,
+            :buffer
+        ) AS geom
+    FROM item_grid g, bounds
+    WHERE g.zoom = :grid_zoom AND g.isa_id = 0 AND g.count > 0
+        AND g.x >= :x * :scale AND g.x < (:x + 1) * :scale
+        AND g.y >= :y * :scale AND g.y < (:y + 1) * :scale
+) AS layer
+"""
+
+osm_layer_sql = """
+SELECT ST_AsMVT(layer, 'osm', :extent, 'geom')
+FROM (
+    SELECT
+        CASE
+            WHEN tbl = 'point' THEN 'node/' || osm_id
+            WHEN osm_id > 0 THEN 'way/' || osm_id
+            ELSE 'relation/' || -osm_id
+        END AS identifier,
+        tags -> 'wikidata' AS wikidata,
+        coalesce(tags -> 'name', tags -> 'addr:housename') AS name,
+        ST_AsMVTGeom(ST_Transform(way, 3857), bounds.merc, :extent, :buffer) AS geom
+    FROM (
+        SELECT 'point' AS tbl, osm_id, tags, way FROM planet_osm_point
+    UNION ALL
+        SELECT 'line' AS tbl, osm_id, tags, way FROM planet_osm_line
+    UNION ALL
+        SELECT 'polygon' AS tbl, osm_id, tags, way FROM planet_osm_polygon
+    ) AS osm, bounds
+    WHERE way && bounds.geog AND tags ? 'wikidata' {isa_sql}
+) AS layer
+"""
+
+items_isa_sql = """
+AND m.item_id IN (SELECT item_id FROM item_isa WHERE ancestor_id = ANY(:isa_ids))
+"""
+
+osm_isa_sql = """
+AND tags -> 'wikidata' IN (
+    SELECT 'Q' || m.item_id FROM item_marker m
+    JOIN item_isa USING (item_id)
+    WHERE m.location && bounds.geog AND item_isa.ancestor_id = ANY(:isa_ids)
+)
+"""
+
+tile_sql = """
+WITH bounds AS (
+    SELECT ST_TileEnvelope(:z, :x, :y) AS merc,
+        ST_Transform(ST_TileEnvelope(:z, :x, :y), 4326) AS geog
+)
+SELECT coalesce(({items_layer}), ''::bytea) || coalesce(({osm_layer}), ''::bytea)
+"""
+
+
+def cluster_grid_zoom(z: int) -> int:
+    """Item grid zoom level used for the clusters layer of a tile at zoom z."""
+    finer = [zoom for zoom in item_grid.grid_zooms if zoom >= z + cluster_zoom_offset]
+    return finer[0] if finer else item_grid.grid_zooms[-1]
+
+
+def get_tile(
+    z: int, x: int, y: int, isa_filter: typing.Iterable[str] | None = None
+) -> bytes:
+    """Vector tile with an items layer and, when zoomed in, an osm layer.
+
+    Below items_min_zoom the items layer is replaced by a clusters layer, it
+    counts every item so there are no clusters when filtering by type.
+    """
+    isa_ids = item_isa.isa_filter_ids(isa_filter) if isa_filter else []
+    grid_zoom = cluster_grid_zoom(z)
+    if z >= items_min_zoom:
+        items_layer = items_layer_sql.format(
+            isa_sql=items_isa_sql if isa_filter else ""
+        )
+    elif not isa_filter:
+        items_layer = clusters_layer_sql
+    else:
+        items_layer = "NULL"
+
+    if z >= osm_min_zoom:
+        osm_layer = osm_layer_sql.format(isa_sql=osm_isa_sql if isa_filter else "")
+    else:
+        osm_layer = "NULL"
+
+    sql = tile_sql.format(items_layer=items_layer, osm_layer=osm_layer)
+    params = {
+        "z": z,
+        "x": x,
+        "y": y,
+        "extent": extent,
+        "buffer": buffer,
+        "isa_ids": isa_ids,
+        "items_limit": items_limit,
+        "grid_zoom": grid_zoom,
+        "scale": 2 ** max(grid_zoom - z, 0),
+    }
+    tile = session.execute(sqlalchemy.text(sql), params).scalar()
+    return bytes(tile) if tile else b""
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+"""Apply OSM replication diffs from a local directory to the planet tables."""
+
+import sys
+from time import sleep
+
+from matcher import planet_diff
+from matcher.database import init_db
+
+DB_URL = "postgresql:///matcher"
+init_db(DB_URL)
+
+# Must match the options used to import the planet, which needs to use --slim.
+osm2pgsql_command = [
+    "osm2pgsql",
+    "--append",
+    "--slim",
+    "--latlong",
+    "--hstore-all",
+    "--style",
+    "matcher.style",
+    "--database",
+    "matcher",
+]
+
+
+def usage() -> None:
+    """Print usage and exit."""
+    print(f"usage: {sys.argv[0]} REPLICATION_DIR")
+    print(f"       {sys.argv[0]} --init SEQUENCE|STATE_FILE")
+    sys.exit(1)
+
+
+def init(arg: str) -> None:
+    """Record the sequence of the planet import, a number or from its state.txt."""
+    sequence = int(arg) if arg.isdigit() else planet_diff.read_state(arg)
+    planet_diff.init_state(sequence)
+    print(f"planet sequence set to {sequence}")
+
+
+def main() -> None:
+    """Apply new diffs as they appear in the replication directory."""
+    if len(sys.argv) == 3 and sys.argv[1] == "--init":
+        init(sys.argv[2])
+        return
+    if len(sys.argv) != 2:
+        usage()
+    diff_dir = sys.argv[1]
+
+    while True:
+        if not planet_diff.apply_pending(diff_dir, osm2pgsql_command):
+            sleep(60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+"""Build the precomputed tables derived from the Wikidata and OSM mirrors."""
+
+import sys
+import typing
+
+from matcher import (
+    api,
+    item_grid,
+    item_isa,
+    item_marker,
+    osm_geometry,
+    osm_wikidata,
+    place_stats,
+    simplify,
+)
+from matcher.database import init_db
+
+DB_URL = "postgresql:///matcher"
+init_db(DB_URL)
+
+commands: dict[str, typing.Callable[[], None]] = {
+    "item_isa": item_isa.rebuild,
+    "isa_tags": api.reset_isa_tags,
+    "item_marker": item_marker.rebuild,
+    "item_grid": item_grid.rebuild,
+    "simplified_geometry": simplify.build,
+    "place_stats": place_stats.rebuild,
+    "osm_wikidata": osm_wikidata.rebuild,
+    "osm_geometry": osm_geometry.rebuild,
+    "wikidata_indexes": osm_wikidata.create_indexes,
+    "place_stats_dirty": place_stats.refresh_dirty,
+}
+
+
+def main() -> None:
+    """Run the builders named on the command line."""
+    names = sys.argv[1:]
+    if not names or any(name not in commands for name in names):
+        print(f"usage: {sys.argv[0]} {'|'.join(commands)} ...")
+        sys.exit(1)
+
+    for name in names:
+        print(name)
+        commands[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import struct
+
+import pytest
+from geoalchemy2.elements import WKBElement
+
+from matcher import geodesy
+
+
+def test_envelope_around_point():
+    west, south, east, north = geodesy.envelope_around_point(0, 0, 1000)
+    assert north == pytest.approx(0.008993, abs=1e-6)
+    assert south == pytest.approx(-north)
+    assert east == pytest.approx(north)
+    assert west == pytest.approx(-east)
+
+
+def test_bbox_centroid():
+    assert geodesy.bbox_centroid([-1.0, 50.0, 1.0, 52.0]) == (51.0, 0.0)
+
+
+def test_geojson_bounds():
+    line = {"type": "LineString", "coordinates": [[1.0, 2.0], [3.0, -1.0]]}
+    assert geodesy.geojson_bounds(line) == (1.0, -1.0, 3.0, 2.0)
+    polygon = {
+        "type": "MultiPolygon",
+        "coordinates": [[[[0, 0], [4, 0], [4, 5], [0, 0]]], [[[-2, 1], [0, 1]]]],
+    }
+    collection = {"type": "GeometryCollection", "geometries": [line, polygon]}
+    assert geodesy.geojson_bounds(collection) == (-2, -1.0, 4, 5)
+
+
+def test_point_lat_lon():
+    ewkb = struct.pack("<BIIdd", 1, 0x20000001, 4326, -1.5, 52.25)
+    assert geodesy.point_lat_lon(WKBElement(ewkb.hex(), extended=True)) == (52.25, -1.5)
+    assert geodesy.point_lat_lon("POINT(-1.5 52.25)") == (52.25, -1.5)
+
+
+def test_polygon_centroid():
+    square = [(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)]
+    hole = [(2, 0), (4, 0), (4, 4), (2, 4), (2, 0)]
+    wkb = struct.pack("<BII", 1, 3, 2)
+    for ring in square, hole:
+        wkb += struct.pack("<I", len(ring))
+        wkb += b"".join(struct.pack("<dd", x, y) for x, y in ring)
+
+    assert geodesy.centroid(geodesy.read_wkb(wkb)) == pytest.approx((1.0, 2.0))
+
+
+def test_line_centroid():
+    line = [(0, 0), (2, 0), (2, 6)]
+    wkb = struct.pack("<BII", 1, 2, len(line))
+    wkb += b"".join(struct.pack("<dd", x, y) for x, y in line)
+
+    assert geodesy.centroid(geodesy.read_wkb(wkb)) == pytest.approx((1.75, 2.25))
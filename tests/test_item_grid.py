@@ -0,0 +1,43 @@
+import pytest
+
+from matcher import item_grid, tiles
+
+
+def test_find_interior():
+    england = [-6.0, 49.9, 1.8, 55.8]
+    interior = item_grid.find_interior(england)
+    assert interior
+    cells = (interior.x1 - interior.x0 + 1) * (interior.y1 - interior.y0 + 1)
+    assert cells <= item_grid.max_cells
+
+    west, south, east, north = england
+    inner_west, inner_south, _, _ = tiles.tile_bounds(
+        interior.zoom, interior.x0, interior.y1
+    )
+    _, _, inner_east, inner_north = tiles.tile_bounds(
+        interior.zoom, interior.x1, interior.y0
+    )
+    assert west <= inner_west < inner_east <= east
+    assert south <= inner_south < inner_north <= north
+
+    assert item_grid.find_interior([-0.13, 51.50, -0.12, 51.51]) is None
+
+
+def test_edge_strips():
+    bounds = [-6.0, 49.9, 1.8, 55.8]
+    interior = item_grid.find_interior(bounds)
+    assert interior
+    strips = item_grid.edge_strips(bounds, interior)
+    assert len(strips) == 4
+
+    def area(b):
+        return (b[2] - b[0]) * (b[3] - b[1])
+
+    inner_west, inner_south, _, _ = tiles.tile_bounds(
+        interior.zoom, interior.x0, interior.y1
+    )
+    _, _, inner_east, inner_north = tiles.tile_bounds(
+        interior.zoom, interior.x1, interior.y0
+    )
+    inner = [inner_west, inner_south, inner_east, inner_north]
+    assert sum(area(s) for s in strips) + area(inner) == pytest.approx(area(bounds))
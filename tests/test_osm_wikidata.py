@@ -0,0 +1,18 @@
+from matcher import model, osm_wikidata
+
+
+def test_table_name():
+    assert osm_wikidata.table_name(model.Point) == "point"
+    assert osm_wikidata.table_name(model.Line) == "line"
+    assert osm_wikidata.table_name(model.Polygon) == "polygon"
+
+
+def test_identifier():
+    node = model.OsmWikidata(tbl="point", osm_id=1234, qid="Q1")
+    assert node.identifier == "node/1234"
+
+    way = model.OsmWikidata(tbl="line", osm_id=5678, qid="Q1")
+    assert way.identifier == "way/5678"
+
+    relation = model.OsmWikidata(tbl="polygon", osm_id=-42, qid="Q1")
+    assert relation.identifier == "relation/42"
@@ -0,0 +1,61 @@
+import gzip
+
+from matcher import planet_diff
+
+osm_change = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="test">
+  <create>
+    <node id="1" version="1" lat="51.5" lon="-0.1">
+      <tag k="amenity" v="cafe"/>
+    </node>
+  </create>
+  <modify>
+    <way id="10" version="2">
+      <nd ref="1"/>
+      <nd ref="2"/>
+      <tag k="highway" v="residential"/>
+    </way>
+    <relation id="100" version="3">
+      <member type="way" ref="10" role="outer"/>
+      <tag k="type" v="multipolygon"/>
+    </relation>
+  </modify>
+  <delete>
+    <node id="2" version="4"/>
+  </delete>
+</osmChange>
+"""
+
+
+def test_sequence_path():
+    path = planet_diff.sequence_path("/data/minute", 5_123_456)
+    assert path == "/data/minute/005/123/456.osc.gz"
+
+
+def test_read_state(tmp_path):
+    state = tmp_path / "state.txt"
+    state.write_text(
+        "#Sat Jan 01 00:00:00 UTC 2022\n"
+        "sequenceNumber=5123456\n"
+        "timestamp=2022-01-01T00\\:00\\:00Z\n"
+    )
+    assert planet_diff.read_state(str(state)) == 5_123_456
+
+
+def test_parse_change(tmp_path):
+    filename = tmp_path / "456.osc.gz"
+    with gzip.open(filename, "wt") as f:
+        f.write(osm_change)
+
+    change = planet_diff.parse_change(str(filename))
+    assert change.nodes == {1, 2}
+    assert change.ways == {10}
+    assert change.relations == {100}
+
+
+def test_merge_cells():
+    cells = {}
+    planet_diff.merge_cells(cells, (0, 51), [0.1, 51.2, 0.2, 51.3])
+    planet_diff.merge_cells(cells, (0, 51), [0.5, 51.1, 0.6, 51.25])
+    planet_diff.merge_cells(cells, (1, 51), [1.5, 51.5, 1.6, 51.6])
+    assert cells == {(0, 51): [0.1, 51.1, 0.6, 51.3], (1, 51): [1.5, 51.5, 1.6, 51.6]}
@@ -0,0 +1,57 @@
+import json
+
+import flask
+
+from matcher import presets
+
+
+def write_json(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data))
+
+
+def make_schema(ts_dir):
+    preset_dir = ts_dir / "data" / "presets"
+    write_json(preset_dir / "amenity" / "cafe.json", {"name": "Cafe"})
+    write_json(preset_dir / "amenity" / "parking_point.json", {"name": "Parking"})
+    write_json(preset_dir / "building.json", {"name": "Building"})
+    translations = {"presets": {"presets": {"amenity/cafe": {"name": "Caff"}}}}
+    write_json(ts_dir / "dist" / "translations" / "en-GB.json", {"en-GB": translations})
+
+
+def test_find_preset(tmp_path):
+    make_schema(tmp_path)
+    app = flask.Flask(__name__)
+    app.config["ID_TAGGING_SCHEMA_DIR"] = str(tmp_path)
+
+    with app.app_context():
+        cafe = presets.find_preset("amenity", "cafe", "point")
+        assert cafe == {
+            "tag_or_key": "Tag:amenity=cafe",
+            "preset": "amenity/cafe",
+            "name": "Cafe",
+        }
+
+        parking = presets.find_preset("amenity", "parking", "point")
+        assert parking and parking["name"] == "Parking"
+        assert presets.find_preset("amenity", "parking", "area") is None
+
+        building = presets.find_preset("building", "yes", "area")
+        assert building == {
+            "tag_or_key": "Key:building",
+            "preset": "building",
+            "name": "Building",
+        }
+
+        cafe_gb = presets.find_preset("amenity", "cafe", "point", {"GB"})
+        assert cafe_gb and cafe_gb["name"] == "Caff"
+
+
+def test_find_caches_only_preset_tags(tmp_path):
+    make_schema(tmp_path)
+    index = presets.PresetIndex(str(tmp_path))
+
+    assert index.find("amenity", "cafe", "point")
+    assert index.find("building", "yes", "area")
+    assert index.find("name", "Free text", "point") is None
+    assert list(index.cache) == [("amenity", "cafe", "point")]
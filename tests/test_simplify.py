@@ -0,0 +1,29 @@
+import math
+
+import pytest
+
+from matcher import simplify, tiles
+
+
+def test_zoom_tolerance():
+    assert simplify.zoom_tolerance(0) == 360 / 512
+    assert simplify.zoom_tolerance(10) == simplify.zoom_tolerance(9) / 2
+    assert simplify.zoom_tolerance(-5) == simplify.zoom_tolerance(0)
+    assert simplify.zoom_tolerance(5000) == simplify.zoom_tolerance(tiles.max_zoom)
+
+
+def test_tolerance_digits():
+    assert simplify.tolerance_digits(simplify.zoom_tolerance(0)) == 1
+    assert simplify.tolerance_digits(simplify.zoom_tolerance(12)) == 4
+    assert simplify.tolerance_digits(1e-12) == 7
+    for tolerance in (0, -1, math.inf, math.nan):
+        with pytest.raises(ValueError):
+            simplify.tolerance_digits(tolerance)
+
+
+def test_geojson_sql():
+    assert simplify.geojson_sql("point", "way", None) == "ST_AsGeoJSON(way)"
+    assert simplify.geojson_sql("point", "way", 0.001) == "ST_AsGeoJSON(way, 3)"
+    sql = simplify.geojson_sql("line", "ST_Collect(way)", 0.001)
+    assert "ST_SimplifyPreserveTopology(ST_Collect(way), 0.001)" in sql
+    assert "planet_osm_line.osm_id" in sql
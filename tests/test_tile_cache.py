@@ -0,0 +1,60 @@
+from matcher import tile_cache, tiles
+
+
+def test_cache_zoom():
+    assert tile_cache.cache_zoom([-0.2, 51.4, 0.0, 51.6]) == 11
+    assert tile_cache.cache_zoom([-0.001, 51.5, 0.0, 51.501]) == tile_cache.max_zoom
+    assert tile_cache.cache_zoom([-10.0, 40.0, 10.0, 60.0]) is None
+
+
+def test_covering_tiles():
+    bounds = [-0.2, 51.4, 0.0, 51.6]
+    z = tile_cache.cache_zoom(bounds)
+    assert z
+    found = tile_cache.covering_tiles(bounds, z)
+    assert 1 < len(found) <= tile_cache.max_tiles
+
+    west, south, east, north = bounds
+    tile_bounds = [tiles.tile_bounds(z, x, y) for x, y in found]
+    assert min(b.west for b in tile_bounds) <= west
+    assert min(b.south for b in tile_bounds) <= south
+    assert max(b.east for b in tile_bounds) >= east
+    assert max(b.north for b in tile_bounds) >= north
+
+
+def test_params_key():
+    key = tile_cache.params_key({"isa": {"Q5", "Q16970"}})
+    assert key == tile_cache.params_key({"isa": {"Q16970", "Q5"}})
+    assert key != tile_cache.params_key({"isa": None})
+
+
+def test_lru_cache():
+    cache = tile_cache.LRUCache(max_size=10)
+    cache.set(("items", 10, 1, 1, ""), b"12345")
+    cache.set(("items", 10, 1, 2, ""), b"12345")
+    assert cache.get(("items", 10, 1, 1, "")) == b"12345"
+
+    cache.set(("items", 10, 1, 3, ""), b"12345")  # evicts the oldest entry
+    assert cache.get(("items", 10, 1, 2, "")) is None
+    assert cache.size == 10
+
+    cache.discard({10: [(0, 0, 1, 1)]})
+    assert cache.get(("items", 10, 1, 1, "")) is None
+    assert cache.get(("items", 10, 1, 3, "")) == b"12345"
+    assert cache.size == 5
+
+    cache.clear()
+    assert cache.get(("items", 10, 1, 3, "")) is None
+    assert cache.size == 0
+
+
+def test_tile_ids():
+    bounds = [-0.2, 51.4, 0.0, 51.6]
+    tile_ids = tile_cache.covering_tile_ids(bounds)
+    assert tile_ids and all(tile_id.startswith("11/") for tile_id in tile_ids)
+    assert tile_cache.covering_tile_ids([-10.0, 40.0, 10.0, 60.0]) is None
+
+    assert tile_cache.tile_id_bounds("0/0/0") == list(tiles.tile_bounds(0, 0, 0))
+    assert tile_cache.tile_id_bounds("1/2/0") is None
+    assert tile_cache.tile_id_bounds("1/a/0") is None
+    assert tile_cache.tile_id_bounds("1/0") is None
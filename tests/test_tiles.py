@@ -0,0 +1,37 @@
+import pytest
+
+from matcher import tiles
+
+
+def test_is_valid():
+    assert tiles.is_valid(0, 0, 0)
+    assert tiles.is_valid(2, 3, 3)
+    assert not tiles.is_valid(2, 4, 0)
+    assert not tiles.is_valid(-1, 0, 0)
+    assert not tiles.is_valid(tiles.max_zoom + 1, 0, 0)
+
+
+def test_tile_bounds():
+    world = tiles.tile_bounds(0, 0, 0)
+    assert world.west == -180 and world.east == 180
+    assert world.north == pytest.approx(85.0511, abs=1e-4)
+    assert world.south == pytest.approx(-85.0511, abs=1e-4)
+
+    west, south, east, north = tiles.tile_bounds(1, 1, 0)
+    assert (west, south, east) == (0, 0, 180)
+
+
+def test_lat_lon_to_tile():
+    lat, lon = 51.5014, -0.1419  # Buckingham Palace
+    x, y = tiles.lat_lon_to_tile(lat, lon, 15)
+    bounds = tiles.tile_bounds(15, x, y)
+    assert bounds.west <= lon < bounds.east
+    assert bounds.south <= lat < bounds.north
+    assert tiles.lat_lon_to_tile(90, 180, 3) == (7, 0)
+
+
+def test_cluster_grid_zoom():
+    assert tiles.cluster_grid_zoom(0) == 4
+    assert tiles.cluster_grid_zoom(3) == 8
+    assert tiles.cluster_grid_zoom(7) == 12
+    assert tiles.cluster_grid_zoom(10) == 12
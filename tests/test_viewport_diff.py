@@ -0,0 +1,51 @@
+import random
+
+from matcher import api, tile_cache
+
+
+def marker_row(num, lat, lon):
+    return {
+        "detail": {"qid": f"Q{num}", "markers": [[lat, lon]], "isa_list": []},
+        "isa_ids": [],
+    }
+
+
+def test_items_diff_pan(monkeypatch):
+    rand = random.Random(0)
+    points = [(rand.uniform(51.3, 51.7), rand.uniform(-0.5, 0.3)) for _ in range(2000)]
+
+    def rows_in(bounds):
+        west, south, east, north = bounds
+        return [
+            marker_row(num, lat, lon)
+            for num, (lat, lon) in enumerate(points)
+            if south <= lat <= north and west <= lon <= east
+        ]
+
+    def tiled_rows(bounds, isa_filter=None):
+        tile_ids = tile_cache.covering_tile_ids(bounds)
+        if not tile_ids:
+            return None
+        found = {}
+        for tile_id in tile_ids:
+            for row in rows_in(tile_cache.tile_id_bounds(tile_id)):
+                found.setdefault(row["detail"]["qid"], row)
+        return list(found.values())
+
+    monkeypatch.setattr(api, "get_tiled_marker_rows", tiled_rows)
+    monkeypatch.setattr(api, "get_marker_rows", lambda b, isa_filter=None: rows_in(b))
+    monkeypatch.setattr(api, "isa_count_labels", lambda counts, **kwargs: [])
+
+    def in_view(bounds):
+        return {row["detail"]["qid"] for row in rows_in(bounds)}
+
+    first = [-0.2, 51.45, -0.1, 51.55]
+    held = in_view(first)
+    previous = [first]
+    for bounds in ([-0.17, 51.47, -0.07, 51.57], [-0.12, 51.5, -0.02, 51.6]):
+        ret = api.wikidata_items_diff(bounds, previous)
+        assert ret["tiles"]
+        held = (held - set(ret["left"])) | {item["qid"] for item in ret["items"]}
+        assert in_view(bounds) <= held
+        assert not set(ret["left"]) & in_view(bounds)
+        previous = [bounds] + [tile_cache.tile_id_bounds(t) for t in ret["tiles"]]
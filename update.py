@@ -6,7 +6,17 @@ import json
 import typing
 from time import sleep
 
-from matcher import model, wikidata, wikidata_api
+from matcher import (
+    api,
+    candidate_cache,
+    item_isa,
+    item_marker,
+    model,
+    place_stats,
+    tile_cache,
+    wikidata,
+    wikidata_api,
+)
 from matcher.database import init_db, session
 
 DB_URL = "postgresql:///matcher"
@@ -14,28 +24,46 @@ init_db(DB_URL)
 
 entity_keys = {"labels", "sitelinks", "aliases", "claims", "descriptions", "lastrevid"}
 
+# Maximum number of entities in one wbgetentities request.
+entity_batch_size = 50
+
 
 class Change(typing.TypedDict):
     """Dict representing an edit in recent changes."""
 
+    type: str
     title: str
     timestamp: str
     redirect: dict[str, typing.Any] | None
     revid: int
 
 
-def handle_new(change: Change) -> None:
+class PendingUpdates:
+    """Derived table updates for a page of changes, applied together."""
+
+    def __init__(self) -> None:
+        """Start with nothing to update."""
+        self.isa_items: set[int] = set()
+        self.subclass_items: set[int] = set()
+        self.marker_items: set[int] = set()
+        self.points: list[tuple[float, float]] = []
+
+    def apply(self) -> None:
+        """Update item_isa and item_marker, and mark changed places as dirty."""
+        session.flush()
+        item_isa.update_items(self.isa_items)
+        for item_id in self.subclass_items:
+            item_isa.update_descendants(item_id)
+        item_marker.update_items(self.marker_items)
+        place_stats.mark_dirty_points(self.points)
+
+
+def handle_new(
+    change: Change, entity: wikidata_api.EntityType, pending: PendingUpdates
+) -> None:
     """Handle a new Wikidata item from the recent changes feed."""
     qid = change["title"]
     ts = change["timestamp"]
-    if change["redirect"]:
-        print(f"{ts}: new item {qid}, since replaced with redirect")
-        return
-    item = model.Item.query.get(qid[1:])  # check if item is already loaded
-    if item:
-        return handle_edit(change)
-
-    entity = wikidata_api.get_entity(qid)
     if entity["id"] != qid:
         print(f'redirect {qid} -> {entity["id"]}')
         return
@@ -61,6 +89,11 @@ def handle_new(change: Change) -> None:
         raise
     item.locations = model.location_objects(coords)
     session.add(item)
+    pending.isa_items.add(item_id)
+    pending.marker_items.add(item_id)
+    points = [loc.get_lat_lon() for loc in item.locations]
+    tile_cache.invalidate_points(points)
+    pending.points += points
 
 
 def coords_equal(a: dict[str, typing.Any], b: dict[str, typing.Any]) -> bool:
@@ -68,25 +101,89 @@ def coords_equal(a: dict[str, typing.Any], b: dict[str, typing.Any]) -> bool:
     return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
 
 
-def handle_edit(change: Change) -> None:
-    """Process an edit from recent changes."""
-    qid = change["title"]
-    item = model.Item.query.get(qid[1:])
-    if not item:
-        return  # item isn't in our database so it probably has no coordinates
+def claim_values(claims: wikidata.Claims, pid: str) -> list[typing.Any]:
+    """Values of the given property, ignoring qualifiers and references."""
+    return [claim["mainsnak"].get("datavalue") for claim in claims.get(pid, [])]
+
+
+def isa_tags_changed(item: model.Item, entity: wikidata_api.EntityType) -> bool:
+    """Edit changes something the precomputed IsA tags depend on."""
+    if any(
+        claim_values(item.claims, pid) != claim_values(entity["claims"], pid)
+        for pid in api.isa_tag_pids
+    ):
+        return True
+    return item.labels.get("en") != entity["labels"].get("en")
+
+
+isa_rules_snapshot: set[tuple[str, int, str | None]] | None = None
+
+
+def get_isa_rules() -> set[tuple[str, int, str | None]]:
+    """Current contents of the skip_isa and item_extra_keys tables."""
+    rules: set[tuple[str, int, str | None]] = {
+        ("skip", item_id, None) for item_id, in session.query(model.SkipIsA.item_id)
+    }
+    rules |= {
+        ("extra", item_id, tag_or_key)
+        for item_id, tag_or_key in session.query(
+            model.ItemExtraKeys.item_id, model.ItemExtraKeys.tag_or_key
+        )
+    }
+    return rules
+
 
+def check_isa_rules() -> None:
+    """Invalidate IsA tags for items with changed skip_isa or item_extra_keys rows."""
+    global isa_rules_snapshot
+    rules = get_isa_rules()
+    if isa_rules_snapshot is not None:
+        changed = {item_id for _, item_id, _ in rules ^ isa_rules_snapshot}
+        if changed:
+            print(f"IsA rules changed for {len(changed)} items")
+            api.invalidate_isa_tags(changed)
+    isa_rules_snapshot = rules
+
+
+def needs_entity(change: Change, item: model.Item | None) -> bool:
+    """Change needs the current entity, the stored item is None if not loaded."""
+    qid = change["title"]
     ts = change["timestamp"]
+    if not item:
+        if change["type"] != "new":
+            # item isn't in our database so it probably has no coordinates
+            return False
+        if change["redirect"]:
+            print(f"{ts}: new item {qid}, since replaced with redirect")
+            return False
+        return True
 
     if item.lastrevid >= change["revid"]:
         print(f"{ts}: no need to update {qid}")
-        return
+        return False
+    return True
+
+
+def handle_edit(
+    change: Change,
+    item: model.Item,
+    entity: wikidata_api.EntityType,
+    pending: PendingUpdates,
+) -> None:
+    """Process an edit from recent changes."""
+    qid = change["title"]
+    ts = change["timestamp"]
 
-    entity = wikidata_api.get_entity(qid)
     entity_qid = entity.pop("id")
+    old_points = [loc.get_lat_lon() for loc in item.locations]
     if entity_qid != qid:
         print(f"{ts}: item {qid} replaced with redirect")
+        tile_cache.invalidate_points(old_points)
+        place_stats.mark_dirty_points(old_points)
+        item_isa.delete_items([item.item_id])
+        item_marker.delete_items([item.item_id])
+        candidate_cache.invalidate_item(item.item_id)
         session.delete(item)
-        session.commit()
         return
 
     assert entity_qid == qid
@@ -101,9 +198,65 @@ def handle_edit(change: Change) -> None:
     else:
         print(f"{ts}: update item {qid}, no change to coordinates")
 
+    candidate_cache.invalidate_item(item.item_id)
+
+    if isa_tags_changed(item, entity):
+        api.invalidate_isa_tags([item.item_id])
+
+    isa_changed, subclass_changed = (
+        claim_values(item.claims, pid) != claim_values(entity["claims"], pid)
+        for pid in ("P31", "P279")
+    )
+
     for key in entity_keys:
         setattr(item, key, entity[key])  # type: ignore
 
+    if isa_changed:
+        pending.isa_items.add(item.item_id)
+    if subclass_changed:
+        pending.subclass_items.add(item.item_id)
+    pending.marker_items.add(item.item_id)
+    new_points = [loc.get_lat_lon() for loc in item.locations]
+    tile_cache.invalidate_points(old_points + new_points)
+    pending.points += old_points + new_points
+
+
+def fetch_entities(qids: list[str]) -> dict[str, wikidata_api.EntityType]:
+    """Download entities from Wikidata, entity_batch_size at a time."""
+    entities: dict[str, wikidata_api.EntityType] = {}
+    for start in range(0, len(qids), entity_batch_size):
+        entities.update(
+            wikidata_api.get_entities(qids[start : start + entity_batch_size])
+        )
+    return entities
+
+
+def handle_changes(changes: list[Change]) -> None:
+    """Apply a page of new items and edits from recent changes."""
+    item_ids = [int(change["title"][1:]) for change in changes]
+    items = {
+        item.item_id: item
+        for item in model.Item.query.filter(model.Item.item_id.in_(item_ids))
+    }
+
+    todo = [
+        (change, items.get(item_id))
+        for change, item_id in zip(changes, item_ids)
+        if needs_entity(change, items.get(item_id))
+    ]
+    entities = fetch_entities([change["title"] for change, _ in todo])
+
+    pending = PendingUpdates()
+    for change, item in todo:
+        entity = entities.get(change["title"])
+        if not entity:
+            continue
+        if item:
+            handle_edit(change, item, entity, pending)
+        else:
+            handle_new(change, entity, pending)
+    pending.apply()
+
 
 def update_timestamp(timestamp: str) -> None:
     """Save timestamp to rc_timestamp."""
@@ -117,26 +270,26 @@ def update_database() -> None:
     with open("rc_timestamp") as f:
         start = f.read().strip()
 
+    check_isa_rules()
+
     rccontinue = None
     seen = set()
     while True:
         r = wikidata_api.get_recent_changes(rcstart=start, rccontinue=rccontinue)
 
         reply = r.json()
+        changes: list[Change] = []
         for change in reply["query"]["recentchanges"]:
-            rctype = change["type"]
             timestamp = change["timestamp"]
             qid = change["title"]
             if qid in seen:
                 continue
 
-            if rctype == "new":
-                handle_new(change)
-                seen.add(qid)
-            if rctype == "edit":
-                handle_edit(change)
+            if change["type"] in ("new", "edit"):
+                changes.append(change)
                 seen.add(qid)
 
+        handle_changes(changes)
         update_timestamp(timestamp)
         print("commit")
         session.commit()
@@ -4,6 +4,7 @@
 
 import inspect
 import json
+import math
 import re
 import sys
 import traceback
@@ -24,6 +25,7 @@ from sqlalchemy.sql.expression import update
 
 from matcher import (
     api,
+    candidate_cache,
     commons,
     database,
     edit,
@@ -31,7 +33,13 @@ from matcher import (
     mail,
     model,
     nominatim,
+    osm_geometry,
     osm_oauth,
+    osm_wikidata,
+    prefetch,
+    simplify,
+    tile_cache,
+    tiles,
     wikidata,
     wikidata_api,
 )
@@ -59,6 +67,13 @@ entity_keys = {"labels", "sitelinks", "aliases", "claims", "descriptions", "last
 
 re_qid = re.compile(r"^Q\d+$")
 
+# Browser and proxy cache lifetime for vector tiles (seconds).
+tile_max_age = 300
+
+# Maximum number of held tile IDs accepted by the viewport diff endpoints, the
+# tiles of one cached viewport.
+max_held_tiles = tile_cache.max_tiles
+
 
 @app.teardown_appcontext
 def shutdown_session(exception=None) -> None:
@@ -126,26 +141,11 @@ def cors_jsonify(*args, **kwargs) -> flask.Response:
 
 def check_for_tagged_qids(qids: list[str]) -> set[str]:
     """Check OSM for existing wikidata tags for given QIDs."""
-    tagged = set()
-    for qid in qids:
-        for cls in model.Point, model.Polygon, model.Line:
-            q = cls.query.filter(cls.tags["wikidata"] == qid)
-            if q.count():
-                tagged.add(qid)
-                break
-
-    return tagged
+    return osm_wikidata.tagged_qids(qids)
 
 
 def check_for_tagged_qid(qid):
-    return any(
-        database.session.query(
-            cls.query.filter(
-                cls.tags.has_key("wikidata"), cls.tags["wikidata"] == qid
-            ).exists()
-        ).scalar()
-        for cls in (model.Point, model.Polygon, model.Line)
-    )
+    return bool(osm_wikidata.tagged_qids([qid]))
 
 
 def geoip_user_record():
@@ -190,6 +190,7 @@ def isa_page(item_id: int) -> werkzeug.wrappers.Response | str:
         tag_or_key = flask.request.form["tag_or_key"]
         extra = model.ItemExtraKeys(item=item, tag_or_key=tag_or_key)
         database.session.add(extra)
+        api.invalidate_isa_tags([item_id])
         database.session.commit()
         flask.flash("extra OSM tag/key added")
 
@@ -220,6 +221,7 @@ def isa_page(item_id: int) -> werkzeug.wrappers.Response | str:
         )
 
     tags = api.get_tags_for_isa_item(item)
+    database.session.commit()
 
     return flask.render_template(
         "isa.html",
@@ -281,10 +283,12 @@ def identifier_page(pid):
 
     osm_points = {}
 
+    point_ids = [obj.osm_id for obj in osm_wikidata.find_objects(qids, tbl="point")]
+    points = model.Point.query.filter(model.Point.src_id.in_(point_ids))
     for qid in qids:
-        osm_points[qid] = model.Point.query.filter(
-            model.Point.tags["wikidata"] == qid
-        ).all()
+        osm_points[qid] = []
+    for point in points:
+        osm_points.setdefault(point.tags["wikidata"], []).append(point)
 
     osm_total = len(osm_points)
 
@@ -452,6 +456,34 @@ def read_bounds_param() -> list[float]:
     return [float(i) for i in flask.request.args["bounds"].split(",")]
 
 
+def read_tolerance_param() -> float | None:
+    """Read geometry simplification tolerance from the tolerance or zoom parameter."""
+    if tolerance := flask.request.args.get("tolerance", type=float):
+        return tolerance if 0 < tolerance < math.inf else None
+    zoom = flask.request.args.get("zoom", type=int)
+    return simplify.zoom_tolerance(zoom) if zoom is not None else None
+
+
+def read_held_tiles_param() -> list[str]:
+    """Read the IDs of the cache tiles the client already has."""
+    tile_ids = flask.request.args.get("tiles")
+    if not tile_ids:
+        return []
+    held = tile_ids.split(",")[:max_held_tiles]
+    return [tile_id for tile_id in held if tile_cache.tile_id_bounds(tile_id)]
+
+
+def read_previous_param() -> list[list[float]] | None:
+    """Read areas the client already has, as previous bounds or held tile IDs."""
+    previous = []
+    if previous_bounds := flask.request.args.get("previous"):
+        previous.append([float(i) for i in previous_bounds.split(",")])
+    for tile_id in read_held_tiles_param():
+        if tile_bounds := tile_cache.tile_id_bounds(tile_id):
+            previous.append(tile_bounds)
+    return previous or None
+
+
 def read_isa_filter_param():
     isa_param = flask.request.args.get("isa")
     if isa_param:
@@ -504,29 +536,122 @@ def api_wikidata_items():
     bounds = read_bounds_param()
     isa_filter = read_isa_filter_param()
 
-    ret = api.wikidata_items(bounds, isa_filter=isa_filter)
+    cluster = bool(flask.request.args.get("cluster"))
+    previous = read_previous_param()
+    if previous and not (cluster and api.is_large_bbox(bounds)):
+        ret = api.wikidata_items_diff(bounds, previous, isa_filter=isa_filter)
+    else:
+        ret = api.wikidata_items(bounds, isa_filter=isa_filter, cluster=cluster)
+
+    if flask.request.args.get("prefetch") and "items" in ret:
+        item_ids = [int(item["qid"][1:]) for item in ret["items"]]
+        knn = flask.request.args.get("mode") == "knn"
+        ret["prefetch"] = prefetch.queue_items(
+            item_ids, knn=knn, tolerance=read_tolerance_param()
+        )
 
     t1 = time() - t0
     return cors_jsonify(success=True, duration=t1, **ret)
 
 
+@app.route("/api/1/viewport")
+def api_viewport() -> werkzeug.wrappers.Response:
+    """Count, instance of counts, markers and OSM objects for the map viewport."""
+    t0 = time()
+    sections_param = flask.request.args.get("sections")
+    sections = set(sections_param.split(",")) if sections_param else None
+    isa_limit = flask.request.args.get(
+        "isa_limit", default=api.isa_facet_limit, type=int
+    )
+
+    ret = api.get_viewport(
+        read_bounds_param(),
+        isa_filter=read_isa_filter_param(),
+        sections=sections,
+        cluster=bool(flask.request.args.get("cluster")),
+        tolerance=read_tolerance_param(),
+        isa_limit=min(max(isa_limit, 1), api.max_isa_facet_limit),
+    )
+
+    t1 = time() - t0
+    return cors_jsonify(success=True, duration=t1, **ret)
+
+
+@app.route("/api/1/tiles/<int:z>/<int:x>/<int:y>.mvt")
+def api_tile(z: int, x: int, y: int) -> flask.Response:
+    """Vector tile of Wikidata items and OSM objects with wikidata tags."""
+    if not tiles.is_valid(z, x, y):
+        flask.abort(404)
+
+    tile = tiles.get_tile(z, x, y, isa_filter=read_isa_filter_param())
+    response = flask.Response(tile, mimetype="application/vnd.mapbox-vector-tile")
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.cache_control.public = True
+    response.cache_control.max_age = tile_max_age
+    response.add_etag()
+    return response.make_conditional(flask.request)
+
+
+def read_fields_param() -> list[str] | None:
+    """Read list of item fields to include in the response."""
+    fields = flask.request.args.get("fields")
+    return [field.strip() for field in fields.split(",")] if fields else None
+
+
 @app.route("/api/1/place/<osm_type>/<int:osm_id>")
 def api_place_items(osm_type, osm_id):
     t0 = time()
 
-    ret = api.get_place_items(osm_type, osm_id)
+    ret = api.get_place_items(
+        osm_type,
+        osm_id,
+        after=flask.request.args.get("after", type=int),
+        limit=flask.request.args.get("limit", api.place_page_size, type=int),
+        fields=read_fields_param(),
+    )
 
     t1 = time() - t0
     return cors_jsonify(success=True, duration=t1, **ret)
 
 
+@app.route("/api/1/place/<osm_type>/<int:osm_id>.ndjson")
+def api_place_items_stream(osm_type: str, osm_id: int) -> flask.Response:
+    """Place items as newline delimited JSON, streamed from a server-side cursor."""
+    items = api.iter_place_items(
+        osm_type,
+        osm_id,
+        after=flask.request.args.get("after", type=int),
+        fields=read_fields_param(),
+    )
+
+    def stream() -> typing.Iterator[str]:
+        for item in items:
+            yield json.dumps(item) + "\n"
+
+    response = flask.Response(
+        flask.stream_with_context(stream()), mimetype="application/x-ndjson"
+    )
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
 @app.route("/api/1/osm")
 def api_osm_objects():
     t0 = time()
     isa_filter = read_isa_filter_param()
-    objects = api.get_osm_with_wikidata_tag(read_bounds_param(), isa_filter=isa_filter)
+    bounds = read_bounds_param()
+    tolerance = read_tolerance_param()
+    if previous := read_previous_param():
+        ret = api.get_osm_objects_diff(
+            bounds, previous, isa_filter=isa_filter, tolerance=tolerance
+        )
+    else:
+        objects = api.get_osm_objects(
+            bounds, isa_filter=isa_filter, tolerance=tolerance
+        )
+        ret = {"objects": objects}
     t1 = time() - t0
-    return cors_jsonify(success=True, objects=objects, duration=t1)
+    return cors_jsonify(success=True, duration=t1, **ret)
 
 
 @app.route("/api/1/item/Q<int:item_id>")
@@ -544,6 +669,7 @@ def api_get_item_tags(item_id):
     t0 = time()
     item = model.Item.query.get(item_id)
     tags = api.get_item_tags(item)
+    database.session.commit()
     osm_list = sorted(tags.keys())
     t1 = time() - t0
 
@@ -552,25 +678,6 @@ def api_get_item_tags(item_id):
     )
 
 
-def expand_street_name(from_names):
-    ret = set(from_names)
-    for name in from_names:
-        if any(name.startswith(st) for st in ("St ", "St. ")):
-            first_space = name.find(" ")
-            ret.add("Saint" + name[first_space:])
-
-        if ", " in name:
-            for n in set(ret):
-                comma = n.find(", ")
-                ret.add(name[:comma])
-        elif "/" in name:
-            for n in set(ret):
-                ret.extend(part.strip() for part in n.split("/"))
-
-    ret.update({"The " + name for name in ret if not name.startswith("The ")})
-    return ret
-
-
 @app.route("/api/1/item/Q<int:item_id>/candidates")
 def api_find_osm_candidates(item_id):
     t0 = time()
@@ -583,39 +690,18 @@ def api_find_osm_candidates(item_id):
             success=True, qid=f"Q{item_id}", error="item has no coordinates"
         )
 
-    label = item.label()
-    item_is_street = item.is_street()
-    item_is_watercourse = item.is_watercourse()
-
-    if item_is_street:
-        max_distance = 5_000
-        limit = None
-        names = expand_street_name([label] + item.get_aliases())
-    elif item_is_watercourse:
-        max_distance = 20_000
-        limit = None
-        names = {label}
-    else:
-        max_distance = 1_000
-        limit = 40
-        names = None
-    nearby = api.find_osm_candidates(
-        item, limit=limit, max_distance=max_distance, names=names
+    knn = flask.request.args.get("mode") == "knn"
+    candidates, cached = candidate_cache.get_candidates(
+        item, knn=knn, tolerance=read_tolerance_param()
     )
 
-    if (item_is_street or item_is_watercourse) and not nearby:
-        # nearby = [osm for osm in nearby if street_name_match(label, osm)]
-
-        # try again without name filter
-        nearby = api.find_osm_candidates(item, limit=100, max_distance=1_000)
-
     t1 = time() - t0
     return cors_jsonify(
         success=True,
         qid=item.qid,
-        nearby=nearby,
         duration=t1,
-        max_distance=max_distance,
+        cached=cached,
+        **candidates,
     )
 
 
@@ -668,8 +754,9 @@ def api_search():
 @app.route("/api/1/polygon/<osm_type>/<int:osm_id>")
 def api_polygon(osm_type, osm_id):
     obj = model.Polygon.get_osm(osm_type, osm_id)
+    geojson = simplify.polygon_geojson(obj, read_tolerance_param())
     return cors_jsonify(
-        successful=True, osm_type=osm_type, osm_id=osm_id, geojson=obj.geojson()
+        successful=True, osm_type=osm_type, osm_id=osm_id, geojson=geojson
     )
 
 
@@ -929,6 +1016,10 @@ def process_edit(changeset_id, e):
     database.session.execute(
         update(cls).where(cls.src_id == osm.src_id).values(tags=new_tags)
     )
+    osm_wikidata.update_object(cls, osm.src_id)
+    osm_geometry.update_object(cls, osm.src_id)
+    candidate_cache.invalidate_osm_object(cls, osm.src_id)
+    tile_cache.invalidate_osm_object(cls, osm.src_id)
 
     db_edit = model.ChangesetEdit(
         changeset_id=changeset_id,